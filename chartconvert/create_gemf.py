@@ -24,6 +24,7 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import hashlib
 import os
 import struct
 import sys
@@ -36,7 +37,9 @@ import threading
 # logwriter must be a class having a log(string) method for writing infos
 # tiles are tuples (z,x,y)
 class GemfWriter(object):
-  def __init__(self,filename,logwriter=None):
+  #dedup: only store one copy of identical tiles (e.g. transparent, solid land or sea)
+  #       the offsets of duplicates point to this copy
+  def __init__(self,filename,logwriter=None,dedup=True):
     self.filename=filename
     self.headerComplete=False
     #each source is a dict of index,name,tiles (tiles being tuples z,x,y)
@@ -54,6 +57,10 @@ class GemfWriter(object):
     self.numtilesheader=0
     self.numtileswritten=0
     self.lock=threading.Lock()
+    self.dedup=dedup
+    self.storedtiles={} #hash of tile data -> (offset,len)
+    self.numduplicates=0
+    self.bytessaved=0
 
   def log(self,txt):
     if self.logwriter is not None:
@@ -220,6 +227,8 @@ class GemfWriter(object):
       self.filehandle.close()
     self.firsthandle.close()
     self.log("closeFile: file successfully closed after %d bytes, %d tiles (%d tiles defined in header)" % (self.bytesWritten,self.numtileswritten,self.numtilesheader))
+    if self.dedup:
+      self.log("closeFile: %d duplicate tiles, %d bytes saved" % (self.numduplicates,self.bytessaved))
 
   #helper functions for adding tiles
   #find a range for a tile
@@ -273,18 +282,22 @@ class GemfWriter(object):
     offset=self.getTileOffset(tile,source)
     if offset is None:
       raise Exception("GemfWriter %s: unknown tile %s:%s,%s,%s" %(self.filename,source,z,x,y))
-    try:
-      dlen=len(tiledata)
-      self.lock.acquire()
-      struct.pack_into("!ql",self.offsetbuffer,offset,self.bytesWritten,dlen)
-      #self.log("writing offset %d, len %d at buffer pos %d" %(self.bytesWritten,dlen,offset))
-      self.filehandle.write(tiledata)
-      self.bytesWritten+=dlen
-      self.lock.release()
+    dlen=len(tiledata)
+    key=hashlib.sha1(tiledata).digest() if self.dedup else None
+    with self.lock:
+      stored=self.storedtiles.get(key) if key is not None else None
+      if stored is not None and stored[1] == dlen:
+        struct.pack_into("!ql",self.offsetbuffer,offset,stored[0],dlen)
+        self.numduplicates+=1
+        self.bytessaved+=dlen
+      else:
+        struct.pack_into("!ql",self.offsetbuffer,offset,self.bytesWritten,dlen)
+        #self.log("writing offset %d, len %d at buffer pos %d" %(self.bytesWritten,dlen,offset))
+        self.filehandle.write(tiledata)
+        if key is not None:
+          self.storedtiles[key]=(self.bytesWritten,dlen)
+        self.bytesWritten+=dlen
       self.numtileswritten+=1
-    except:
-      self.lock.release()
-      raise
 
 
 #some simple test function
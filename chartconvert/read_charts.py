@@ -38,15 +38,19 @@
 #"lower" tile means tile of a lower zoomlevel
 
 
+import collections
 import io
 import logging
 import math
+import multiprocessing
 import os
 import queue
 import re
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -325,6 +329,13 @@ class ChartList(object):
     self.tlist=[]
     self.mercator=mercator
 
+  #the mercator (osr) cannot be pickled
+  #so lists send to merge processes do not have one
+  def __getstate__(self):
+    state=self.__dict__.copy()
+    state['mercator']=None
+    return state
+
   def isEmpty(self):
     return len(self.tlist) < 1
 
@@ -681,6 +692,14 @@ class BuildPyramid(object):
     self.pyramid=[]
     self.writer=writer
     self.layerdir=os.path.join(self.outdir,OUTTILES,self.layername)
+    self.numWritten=0
+
+  #for merge processes: the charts are set in the worker and the writer is local there
+  def __getstate__(self):
+    state=self.__dict__.copy()
+    state['layercharts']=None
+    state['writer']=None
+    return state
   def addZoomLevelTiles(self,tiles):
     self.pyramid.append(tiles)
   def getNumZoom(self):
@@ -706,6 +725,7 @@ class BuildPyramid(object):
 
   def writeTileStore(self,tileStore):
     ld("writing out tile %s",tileStore.getName())
+    self.numWritten+=1
     if self.writer is None:
       tileStore.write(self.layerdir)
     else:
@@ -877,6 +897,100 @@ class PyramidHandler(threading.Thread):
       pyramid.handlePyramid()
       ld("handler thread pyramid ready")
       self.queue.task_done()
+
+#------------------------------
+#process pool for merging pyramids
+#the workers create the tiles of a BuildPyramid and either write them
+#to the layer directory or to a temp file the parent process appends to the gemf file
+#(the parent is the only one writing to the gemf file)
+mergeWorkerCharts=None
+#header of a tile in the temp files: z,x,y,length of data
+TILE_HEADER=struct.Struct("<IIII")
+
+def initMergeWorker(workerOptions,layercharts):
+  global options,mergeWorkerCharts
+  options=workerOptions
+  mergeWorkerCharts=layercharts
+
+class TileCollector(object):
+  def __init__(self,fh):
+    self.fh=fh
+  def writeTile(self,layername,tilestore):
+    data=tilestore.getData()
+    self.fh.write(TILE_HEADER.pack(*tilestore.tile,len(data)))
+    self.fh.write(data)
+
+#read the tiles written by a TileCollector
+def readCollectedTiles(filename):
+  with open(filename,"rb") as fh:
+    while True:
+      header=fh.read(TILE_HEADER.size)
+      if len(header) < TILE_HEADER.size:
+        break
+      z,x,y,length=TILE_HEADER.unpack(header)
+      yield ((z,x,y),fh.read(length))
+
+#returns (number of tiles, name of the tile file or None if written to the layer dir)
+def runMergeJob(job):
+  buildpyramid,tmpdir=job
+  buildpyramid.layercharts=mergeWorkerCharts
+  if tmpdir is None:
+    buildpyramid.handlePyramid()
+    return (buildpyramid.numWritten,None)
+  fd,filename=tempfile.mkstemp(suffix=".tiles",dir=tmpdir)
+  try:
+    with os.fdopen(fd,"wb") as fh:
+      buildpyramid.writer=TileCollector(fh)
+      buildpyramid.handlePyramid()
+  except:
+    os.unlink(filename)
+    raise
+  return (buildpyramid.numWritten,filename)
+
+#run the pyramids of a layer in a process pool
+#only a few jobs are submitted ahead of the one being written
+#so the finished tile files waiting for the gemf writer stay limited
+#returns the number of created tiles
+def mergePyramidsInProcesses(buildpyramids,layercharts,layername,gemf,outdir):
+  numProcesses=int(options.processes)
+  log("waiting for generators with %d processes"%numProcesses)
+  numtiles=0
+  numjobs=len(buildpyramids)
+  numdone=0
+  percent=-1
+  tmpdir=None
+  if gemf is not None:
+    tmpdir=tempfile.mkdtemp(prefix="merge",dir=outdir)
+  try:
+    with multiprocessing.Pool(numProcesses,initializer=initMergeWorker,initargs=(options,layercharts)) as pool:
+      pending=collections.deque()
+      jobs=iter(buildpyramids)
+      while True:
+        for bp in jobs:
+          pending.append(pool.apply_async(runMergeJob,((bp,tmpdir),)))
+          if len(pending) >= 2*numProcesses:
+            break
+        if len(pending) < 1:
+          break
+        #write in the order of the pyramids, so the gemf file is always written in the same order
+        num,filename=pending.popleft().get()
+        numtiles+=num
+        if filename is not None:
+          for tile,data in readCollectedTiles(filename):
+            gemf.gemf.addTile(layername,tile,data)
+          os.unlink(filename)
+        numdone+=1
+        npercent=int(numdone*100/numjobs)
+        if npercent != percent and options.verbose != 0:
+          percent=npercent
+          sys.stdout.write("\r%2d%%" % percent)
+          sys.stdout.flush()
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir,ignore_errors=True)
+  if options.verbose != 0:
+    print()
+  return numtiles
     
 #------------------------------
 #handler class for all the projection stuff
@@ -1286,9 +1400,9 @@ def mergeChartTiles(outdir,layername,outtile,celist, alwaysPil=True):
   return outts
     
 #-------------------------------------
-#create the base zoom level tiles for a chart
-#using tiler_tools
-def generateBaseTiles(chartEntry,outdir):
+#prepare the creation of the base zoom level tiles for a chart
+#returns the gdal_tiler command or None if the tiles are up to date
+def getBaseTilesCommand(chartEntry,outdir):
   tdir=getTilesDir(chartEntry, outdir, False)
   if not options.update == 1:
     if os.path.isdir(tdir):
@@ -1307,7 +1421,7 @@ def generateBaseTiles(chartEntry,outdir):
           st=os.stat(marker)
           if st.st_mtime >= dstat.st_mtime:
             log("basetiles dir "+tilesdir+" is up to date, no need to regenerate")
-            return
+            return None
       log(" removing old dir "+tilesdir)
       shutil.rmtree(tilesdir,True)
   opath=getTilesDir(chartEntry,outdir,True)
@@ -1315,21 +1429,72 @@ def generateBaseTiles(chartEntry,outdir):
   if options.verbose == 2:
     args.append("-d")
   args.append(chartEntry.filename)
-  log("running "+" ".join(args))
   ld("gdal_tiler args:",args)
+  return args
+
+#-------------------------------------
+#create the base zoom level tiles for a chart
+#using tiler_tools
+def generateBaseTiles(chartEntry,outdir):
+  args=getBaseTilesCommand(chartEntry,outdir)
+  if args is None:
+    return
+  log("running "+" ".join(args))
   if subprocess.call(args) != 0:
     raise Exception("unable to convert chart "+chartEntry.filename)
 
+#-------------------------------------
+#estimate the number of pixels gdal_tiler will create for a chart
+def estimateBasePixels(chartEntry,mercator):
+  t_ul,t_lr=mercator.corner_tiles(chartEntry.getBaseZoomLevel(),chartEntry.bounds)
+  return (abs(t_lr[1]-t_ul[1])+1)*(abs(t_lr[2]-t_ul[2])+1)*TILESIZE*TILESIZE
+
 #-------------------------------------
 #create the base tiles from the chartlist
+#runs up to options.processes gdal_tiler processes in parallel
+#the charts are started with the largest (estimated pixels) first, each free slot
+#takes the next chart - so the small ones fill up the slots at the end
 def generateAllBaseTiles(outdir,mercator):
   chartlist=readChartList(outdir,mercator)
   ld("chartlist read:",str(chartlist))
   log("layers:"+str(layer_zoom_levels))
-  for chartEntry in chartlist.tlist:
-    log("creating base tiles for "+chartEntry.filename+" at zoom level "+str(chartEntry.getBaseZoomLevel()))
-    generateBaseTiles(chartEntry,outdir)
-    log("creating base tiles for "+chartEntry.filename+" finished")
+  numProcesses=int(options.processes)
+  if numProcesses < 1:
+    numProcesses=1
+  charts=sorted(chartlist.tlist,key=lambda ce: estimateBasePixels(ce,mercator),reverse=True)
+  log("creating base tiles for %d charts with %d processes"%(len(charts),numProcesses))
+  running={} #process -> chartEntry
+  failed=[]
+  numDone=0
+  start=time.time()
+  while len(charts) > 0 or len(running) > 0:
+    while len(charts) > 0 and len(running) < numProcesses and len(failed) == 0:
+      chartEntry=charts.pop(0)
+      args=getBaseTilesCommand(chartEntry,outdir)
+      if args is None:
+        numDone+=1
+        continue
+      log("creating base tiles for "+chartEntry.filename+" at zoom level "+str(chartEntry.getBaseZoomLevel()))
+      log("running "+" ".join(args))
+      running[subprocess.Popen(args)]=chartEntry
+    if len(failed) > 0:
+      charts=[]
+    if len(running) < 1:
+      continue
+    time.sleep(0.1)
+    for process in list(running.keys()):
+      rtc=process.poll()
+      if rtc is None:
+        continue
+      chartEntry=running.pop(process)
+      numDone+=1
+      if rtc != 0:
+        log("ERROR: gdal_tiler failed for %s with status %d"%(chartEntry.filename,rtc))
+        failed.append(chartEntry)
+      else:
+        log("creating base tiles for %s finished (%d/%d, %.0fs)"%(chartEntry.filename,numDone,len(chartlist.tlist),time.time()-start))
+  if len(failed) > 0:
+    raise Exception("unable to convert chart "+failed[0].filename)
 
 
 #get the min and maxzoom for a layer - considering some handling to fill 600px...
@@ -1444,11 +1609,13 @@ def mergeLayerTiles(chartlist,outdir,layerindex,tilespyramid,gemf,onlyOverview=F
       log("layer "+layername+" has no tiles")
       return (layerminzoom,layermaxzoom)
     #TODO: skip if we have no charts at all
-    requestQueue=queue.Queue(0)
-    for x in range(int(options.threads)):
-      t=PyramidHandler(requestQueue)
-      t.setDaemon(True)
-      t.start()
+    useProcesses=int(options.processes) > 1
+    if not useProcesses:
+      requestQueue=queue.Queue(0)
+      for x in range(int(options.threads)):
+        t=PyramidHandler(requestQueue)
+        t.setDaemon(True)
+        t.start()
     idx=len(tilespyramid)-1
     #in tilespyramid we now have all tiles for the layer min. zoom at index idx, maxZoom at index 0
     #now go top down
@@ -1459,7 +1626,8 @@ def mergeLayerTiles(chartlist,outdir,layerindex,tilespyramid,gemf,onlyOverview=F
     percent=-1
     numjobs=0
     numtiles=len(tilespyramid[idx])
-    for topleveltile in tilespyramid[idx]:
+    buildpyramids=[]
+    for topleveltile in sorted(tilespyramid[idx]):
       ld("handling toplevel tile ",topleveltile)
       
       buildpyramid=BuildPyramid(layercharts,layername,outdir,gemf)
@@ -1471,23 +1639,31 @@ def mergeLayerTiles(chartlist,outdir,layerindex,tilespyramid,gemf,onlyOverview=F
         buildpyramid.addZoomLevelTiles(nextlevel & tilespyramid[idx-buildidx])
         numtiles+=len(buildpyramid.getZoomLevelTiles(buildidx))
       ld("handling buildpyramid of len",numtiles)
-      requestQueue.put(buildpyramid)
+      buildpyramids.append(buildpyramid)
       numjobs+=1
       
     log("handling "+str(numminzoom)+" pyramids on min zoom "+str(layerminzoom)+" (having: "+str(numtiles)+" tiles)")
-    log("waiting for generators with "+str(options.threads)+" threads")
-    while not requestQueue.empty():
-      npercent=int(requestQueue.qsize()*100/numjobs)
-      if npercent != percent and options.verbose != 0:
-        percent=npercent
-        sys.stdout.write("\r%2d%%" % percent)
-        sys.stdout.flush()
-      time.sleep(0.05)
-    if options.verbose != 0:
-      print()
-    log("all merge jobs started for layer "+layername+", waiting for background threads to finish their jobs")
-    requestQueue.join()
-    log("tile merge finished for layer "+layername)
+    start=time.time()
+    if useProcesses:
+      numwritten=mergePyramidsInProcesses(buildpyramids,layercharts,layername,gemf,outdir)
+    else:
+      for buildpyramid in buildpyramids:
+        requestQueue.put(buildpyramid)
+      log("waiting for generators with "+str(options.threads)+" threads")
+      while not requestQueue.empty():
+        npercent=int(requestQueue.qsize()*100/numjobs)
+        if npercent != percent and options.verbose != 0:
+          percent=npercent
+          sys.stdout.write("\r%2d%%" % percent)
+          sys.stdout.flush()
+        time.sleep(0.05)
+      if options.verbose != 0:
+        print()
+      log("all merge jobs started for layer "+layername+", waiting for background threads to finish their jobs")
+      requestQueue.join()
+      numwritten=sum([bp.numWritten for bp in buildpyramids])
+    duration=time.time()-start
+    log("tile merge finished for layer %s: %d tiles in %.1fs, %.1f tiles/s"%(layername,numwritten,duration,numwritten/duration if duration > 0 else 0))
   #writing layer.xml
   order=0
   tilesets=""
@@ -1662,6 +1838,7 @@ def main(argv):
   parser.add_option("-o", "--outname", dest="outname", help="the name of the output gemf file (without gemf), when omitted and indir is given - use last dir of indir")
   parser.add_option("-b", "--basedir", dest="basedir", help="the output and work directory, defaults to %s" % (DEFAULT_OUTDIR))
   parser.add_option("-t", "--threads", dest="threads", help="number of worker threads, default 4")
+  parser.add_option("-j", "--processes", dest="processes", help="number of parallel processes for the base tiles (gdal_tiler) and the tile merge, default number of cpus, with 1 the merge uses --threads")
   parser.add_option("-a", "--add", dest="ttdir", help="directory where to search for tiler tools (if not set use environment TILERTOOLS or current dir)")
   parser.add_option("-f", "--force", action="store_const", const=0, dest="update", help="force update of existing charts (if not set, only necessary charts are generated")
   parser.add_option("-g", "--newgemf", action="store_const", const=1, dest="newgemf", help="use new gemf writer (do not write merged tiles separately)")
@@ -1687,6 +1864,8 @@ def main(argv):
     logger.addHandler(fh)
   if options.threads is None:
     options.threads=4
+  if options.processes is None:
+    options.processes=os.cpu_count() or 1
   if options.chartlist is not None:
     LISTFILE=options.chartlist
     ld("chartlist",LISTFILE)
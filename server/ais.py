@@ -925,9 +925,21 @@ field_groups = (
 # about the AIS format in the pseudoinstruction tables.
 
 from array import array
+import base64
 
 BITS_PER_BYTE = 8
 
+def _sixbit_value(code):
+    ch = code - 48
+    if ch > 40:
+        ch -= 8
+    return ch & 0x3f
+
+# Translation from AIVDM six-bit armoring to the base64 alphabet
+SIXBIT_TO_BASE64 = bytes.maketrans(
+    bytes(range(256)),
+    bytes(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"[_sixbit_value(c)] for c in range(256)))
+
 class BitVector(object):
     "Fast bit-vector class based on Python built-in array type."
     def __init__(self, data=None, length=None):
@@ -946,6 +958,23 @@ class BitVector(object):
             self.bitlen = length
     def from_sixbit(self, data, pad=0):
         "Initialize bit vector from AIVDM-style six-bit armoring."
+        if self.bitlen % 8 == 0:
+            # AIVDM armoring is just a different base64 alphabet,
+            # so translate it and let the C code do the bit shuffling
+            start = self.bitlen//8
+            nbits = 6 * len(data)
+            nbytes = (nbits + 7)//8
+            b64 = data.encode('latin-1', 'replace').translate(SIXBIT_TO_BASE64)
+            b64 += b'A' * (-len(b64) % 4)
+            packed = base64.b64decode(b64)[:nbytes]
+            self.bits.extend([0] * len(data))
+            existing = self.bits[start:start + nbytes]
+            if any(existing):
+                # keep the semantics of or-ing into existing bits
+                packed = (int.from_bytes(packed, 'big') | int.from_bytes(existing.tobytes(), 'big')).to_bytes(nbytes, 'big')
+            self.bits[start:start + nbytes] = array('B', packed)
+            self.bitlen += nbits - pad
+            return
         self.bits.extend([0] * len(data))
         for ch in data:
             ch = ord(ch) - 48
@@ -1036,6 +1065,141 @@ def aivdm_unpack(lc, data, offset, values, instructions):
             cooked.append([inst, value])
     return cooked
 
+# Precompiled unpacking for the frequent message types.
+#
+# The instruction tables above are flattened once into per-type field lists
+# with fixed bit offsets. A message is then converted into one big int and
+# every field is just a shift and a mask instead of a walk through the
+# instruction tree with per-byte loops.
+
+SIXBIT_CHARS = "@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^- !\"#$%&'()*+,-./0123456789:;<=>?"
+
+class CompiledField(object):
+    "A bitfield with a fixed offset in a compiled decoder."
+    def __init__(self, inst, offset):
+        self.inst = inst
+        self.offset = offset
+        self.width = inst.width
+
+    def step(self, total):
+        "The unpack step for a message normalized to total bits."
+        signbit = 1 << (self.width - 1) if self.inst.type == 'signed' else 0
+        # shifts for the characters of a string field (from the field value)
+        charshifts = tuple(range(self.width - 6, -1, -6)) if self.inst.type == 'string' else None
+        return (self.inst, self.inst.name, self.offset, total - self.offset - self.width,
+                (1 << self.width) - 1, signbit, charshifts, self.inst.validator)
+
+class CompiledDecoder(object):
+    "Flat list of fields, optionally ending with a dispatch to sub decoders."
+    def __init__(self, fields, dispatch=None, dispatch_offset=0):
+        self.fields = fields
+        self.dispatch = dispatch
+        self.dispatch_offset = dispatch_offset
+        self.subdecoders = {}
+        self.steps = ()
+
+    def end(self):
+        "The last bit covered by this decoder (including sub decoders)."
+        rt = 0
+        for fld in self.fields:
+            rt = max(rt, fld.offset + fld.width)
+        for sub in self.subdecoders.values():
+            rt = max(rt, sub.end())
+        return rt
+
+    def set_total(self, total):
+        "Compute the unpack steps for a message normalized to total bits."
+        self.steps = tuple([fld.step(total) for fld in self.fields])
+        for sub in self.subdecoders.values():
+            sub.set_total(total)
+
+def compile_instructions(instructions, offset=0):
+    "Flatten an instruction table, raise ValueError if this is not possible."
+    fields = []
+    for idx, inst in enumerate(instructions):
+        if inst.conditional is not None:
+            raise ValueError("conditional instructions cannot be compiled")
+        if isinstance(inst, spare):
+            offset += inst.width
+        elif isinstance(inst, dispatch):
+            if idx != len(instructions) - 1:
+                raise ValueError("dispatch must be the last instruction")
+            rt = CompiledDecoder(fields, inst, offset)
+            for key, subtype in inst.subtypes.items():
+                if subtype is None:
+                    raise ValueError("empty dispatch target")
+                rt.subdecoders[key] = compile_instructions(subtype, offset)
+            return rt
+        elif isinstance(inst, bitfield):
+            if inst.type not in ('unsigned', 'signed', 'string'):
+                raise ValueError("cannot compile field type %s" % inst.type)
+            fields.append(CompiledField(inst, offset))
+            offset += inst.width
+    return CompiledDecoder(fields)
+
+def compile_message_type(msgtype):
+    "Compile the header and the body of a message type into one decoder."
+    header = aivdm_decode[:-1]
+    body = aivdm_decode[-1].subtypes[msgtype]
+    if body is None:
+        raise ValueError("no instructions for type %d" % msgtype)
+    decoder = compile_instructions(tuple(header) + tuple(body))
+    decoder.total = decoder.end()
+    decoder.set_total(decoder.total)
+    return decoder
+
+# All message types that can be flattened (no raw data, no conditionals),
+# this includes the position and static data types 1-3, 5, 18, 19 and 24.
+# The others go through aivdm_unpack.
+compiled_decoders = {}
+for _msgtype in aivdm_decode[-1].subtypes:
+    try:
+        compiled_decoders[_msgtype] = compile_message_type(_msgtype)
+    except ValueError:
+        pass
+
+def _run_compiled(lc, fld_value, bitlen, values, decoder, cooked):
+    "Unpack all fields of a compiled decoder, return False when running out of data."
+    for (inst, name, offset, shift, mask, signbit, charshifts, validator) in decoder.steps:
+        if offset >= bitlen:
+            return False
+        value = (fld_value >> shift) & mask
+        if charshifts is not None:
+            value = "".join([SIXBIT_CHARS[(value >> s) & 0x3f] for s in charshifts])
+            value = value.split('@', 1)[0].rstrip()
+        elif value & signbit:
+            value -= mask + 1
+        values[name] = value
+        if validator and not validator(value):
+            raise AISUnpackingException(lc, name, value)
+        cooked.append([inst, value])
+    if decoder.dispatch is None:
+        return True
+    if decoder.dispatch_offset >= bitlen:
+        return False
+    sub = decoder.subdecoders[decoder.dispatch.compute(values[decoder.dispatch.fieldname])]
+    return _run_compiled(lc, fld_value, bitlen, values, sub, cooked)
+
+def aivdm_unpack_compiled(lc, data, values):
+    """Unpack a complete message, same result as
+    aivdm_unpack(lc, data, 0, values, aivdm_decode) but using the
+    precompiled decoders where possible."""
+    if len(data) < 6 or len(data.bits) < 1:
+        return aivdm_unpack(lc, data, 0, values, aivdm_decode)
+    decoder = compiled_decoders.get(data.bits[0] >> 2)
+    if decoder is None:
+        return aivdm_unpack(lc, data, 0, values, aivdm_decode)
+    raw = data.bits.tobytes()
+    nbits = 8 * len(raw)
+    if nbits < decoder.total:
+        # truncated buffer - leave the error handling to the interpreter
+        return aivdm_unpack(lc, data, 0, values, aivdm_decode)
+    # normalize to the bit length of the decoder
+    fld_value = int.from_bytes(raw, 'big') >> (nbits - decoder.total)
+    cooked = []
+    _run_compiled(lc, fld_value, len(data), values, decoder, cooked)
+    return cooked
+
 def packet_scanner(source):
     "Get a span of AIVDM packets with contiguous fragment numbers."
     payloads = {'A':'', 'B':''}
@@ -1120,7 +1284,7 @@ def parse_ais_messages(source, scaled=False, skiperr=False, verbose=0):
         bits.extend_to(168)
         # Magic recursive unpacking operation
         try:
-            cooked = aivdm_unpack(lc, bits, 0, values, aivdm_decode)
+            cooked = aivdm_unpack_compiled(lc, bits, values)
             # We now have a list of tuples containing unpacked fields
             # Collect some field groups into ISO8601 format
             for (offset, template, label, legend, formatter) in field_groups:
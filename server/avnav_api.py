@@ -81,6 +81,13 @@ class ConverterApi:
     @return:
     '''
     return 'unknown'
+  def getMaxParallel(self):
+    '''
+    the max number of conversions with this converter that AvNav will run in parallel
+    The overall number of parallel conversions is limited by the importer config
+    @return: 0 for no converter specific limit
+    '''
+    return 0
 
 
 class AVNApi(object):
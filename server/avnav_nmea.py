@@ -25,6 +25,8 @@
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
 
+import socket
+
 from avnav_store import *
 hasAisDecoder=False
 try:
@@ -273,6 +275,54 @@ class NMEAParser(object):
       return True
     return not hasPositiveCondition
 
+  @classmethod
+  def compileFilter(cls,filter):
+    '''
+    compile a filter list into a check function
+    with the same semantics as checkFilter
+    @param filter: the filter list
+    @return: a function line->bool, None if there is no filter
+    '''
+    if filter is None:
+      return None
+    #for each of positive/invers: (all $ sentences, set of $ sentence types, tuple of prefixes)
+    conditions={True:[False,set(),[]],False:[False,set(),[]]}
+    hasPositiveCondition=False
+    for f in filter:
+      invers=False
+      if f[0:1]=="^":
+        invers=True
+        f=f[1:]
+      else:
+        hasPositiveCondition=True
+      condition=conditions[invers]
+      if f[0:1]=='$':
+        if len(f) < 2:
+          condition[0]=True
+        else:
+          condition[1].add(f[1:4])
+        continue
+      condition[2].append(f)
+    posAll,posTypes,posPrefixes=conditions[False]
+    invAll,invTypes,invPrefixes=conditions[True]
+    posPrefixes=tuple(posPrefixes)
+    invPrefixes=tuple(invPrefixes)
+    def check(line):
+      okMatch=False
+      if line[0:1]=='$':
+        stype=line[3:6]
+        if invAll or stype in invTypes:
+          return False
+        okMatch=posAll or stype in posTypes
+      if invPrefixes and line.startswith(invPrefixes):
+        return False
+      if okMatch:
+        return True
+      if posPrefixes and line.startswith(posPrefixes):
+        return True
+      return not hasPositiveCondition
+    return check
+
   #compute the NMEA checksum
   @classmethod
   def nmeaChecksum(cls,part):
@@ -736,7 +786,7 @@ class NMEAParser(object):
       bits.extend_to(168)
       # Magic recursive unpacking operation
       try:
-          cooked = ais.aivdm_unpack(0, bits, 0, values, ais.aivdm_decode)
+          cooked = ais.aivdm_unpack_compiled(0, bits, values)
           # Apply the postprocessor stage
           cooked = ais.postprocess(cooked)
           expected = ais.lengths.get(values['msgtype'], None)
@@ -758,22 +808,117 @@ class NMEAParser(object):
           AVNLog.debug("exception %s while decoding AIS data %s",traceback.format_exc())
           return False
   
+  #(name,converter) for the decoder instructions
+  #filled on first use of an instruction
+  _aisFieldConverters={}
+
+  @classmethod
+  def _aisFieldConverter(cls,inst):
+    rt=cls._aisFieldConverters.get(inst)
+    if rt is None:
+      name=inst.name
+      tname=cls.aisFieldTranslations.get(name)
+      if tname is not None:
+        name=tname
+      rt=(name,AVNUtil.aisNativeConverter(name))
+      cls._aisFieldConverters[inst]=rt
+    return rt
+
   def storeAISdata(self,bitfield,source='internal',priority=0,timestamp=None):
+    '''
+    store the unpacked AIS fields
+    the values are converted directly from the native decoder values
+    (giving the same result as AVNUtil.convertAIS on their string representation)
+    '''
     rt={'class':'AIS'}
-    storeData=False
     for bfe in bitfield:
       try:
-        name=bfe[0].name
-        tname=self.aisFieldTranslations.get(name)
-        if tname is not None:
-          name=tname
-        val=str(bfe[1])
-        rt[name]=val
+        name,converter=self._aisFieldConverter(bfe[0])
       except:
         AVNLog.debug("exception in getting AIS message: %s",traceback.format_exc())
+        continue
+      try:
+        rt[name]=converter(bfe[1])
+      except:
+        rt[name]=None
     mmsi=rt.get('mmsi')
     if mmsi is None:
       AVNLog.debug("ignoring AIS data without mmsi, %s"%rt)
       return
-    self.navdata.setAisValue(mmsi,AVNUtil.convertAIS(rt),source=source,priority=priority,timestamp=timestamp)
-    
+    self.navdata.setAisValue(mmsi,AVNUtil.addAISDimensions(rt),source=source,priority=priority,timestamp=timestamp)
+
+
+class NMEALineFramer(object):
+  '''
+  split received bytes into lines
+  data is received directly into a reusable buffer,
+  an incomplete line at the end is kept for the next read
+  '''
+  def __init__(self,bufferSize=65536,maxLineLen=4096):
+    self.buffer=bytearray(bufferSize)
+    self.view=memoryview(self.buffer)
+    self.fill=0
+    self.maxLineLen=maxLineLen
+
+  def recvFrom(self,sock):
+    '''
+    receive from a socket into the free part of the buffer
+    socket like objects that are no socket.socket (e.g. bluetooth sockets)
+    are read with their recv method, as they may not provide recv_into
+    or handle timeouts in recv
+    @return: the number of bytes received, 0 on EOF
+    '''
+    if not isinstance(sock,socket.socket):
+      data=sock.recv(self.getFree())
+      self.addData(data)
+      return len(data)
+    num=sock.recv_into(self.view[self.fill:])
+    self.fill+=num
+    return num
+
+  def readFrom(self,device):
+    '''
+    read from a file like object (e.g. a serial device) into the buffer
+    @return: the number of bytes read
+    '''
+    num=device.readinto(self.view[self.fill:])
+    if num is None:
+      return 0
+    self.fill+=num
+    return num
+
+  def addData(self,data):
+    '''
+    add some bytes that have been read elsewhere
+    '''
+    num=len(data)
+    if self.fill+num > len(self.buffer):
+      raise Exception("line framer buffer overflow")
+    self.buffer[self.fill:self.fill+num]=data
+    self.fill+=num
+
+  def getFree(self):
+    return len(self.buffer)-self.fill
+
+  def getLines(self):
+    '''
+    get all complete lines (as str, line ends removed)
+    raises an exception if there is no line end within maxLineLen
+    '''
+    end=self.buffer.rfind(b'\n',0,self.fill)
+    if end < 0:
+      if self.fill > self.maxLineLen:
+        raise Exception("no line feed in long data")
+      return []
+    lines=str(self.view[0:end+1],'ascii','ignore').splitlines()
+    remain=self.fill-end-1
+    if remain > 0:
+      #the regions may overlap
+      self.buffer[0:remain]=bytes(self.view[end+1:self.fill])
+    self.fill=remain
+    if remain > self.maxLineLen:
+      raise Exception("no line feed in long data")
+    return lines
+
+  def clear(self):
+    self.fill=0
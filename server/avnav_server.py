@@ -302,6 +302,10 @@ def main(argv):
     handlerManager.startHandlers(navData)
     while not handlerManager.shouldStop:
       time.sleep(1)
+      try:
+        navData.expireAisData()
+      except Exception as e:
+        AVNLog.error("error expiring AIS data: %s",traceback.format_exc())
 
   except Exception as e:
     AVNLog.error("Exception in main %s",traceback.format_exc())
@@ -26,6 +26,7 @@
 ###############################################################################
 
 
+import heapq
 import time
 
 from avnav_util import *
@@ -38,8 +39,15 @@ class AVNStore(object):
   BASE_KEY_SKY = 'sky'
 
   AIS_AGE_KEY='age'
+  AIS_DISTANCE_KEY='distance'
+  #cell size (degrees) of the spatial index for AIS targets
+  AIS_GRID_SIZE=0.25
+  #max number of cells for a query - otherwise we do a full scan
+  AIS_GRID_MAX_CELLS=2000
 
   KEY_VERSION= BASE_KEY_GPS+".version"
+  #keys that trigger the position listeners
+  POSITION_KEYS=(BASE_KEY_GPS+".lat",BASE_KEY_GPS+".lon")
 
   # AIS messages we store
   knownAISTypes = (1, 2, 3, 5, 18, 19, 24)
@@ -71,9 +79,100 @@ class AVNStore(object):
         return None
       return self.value.get('mmsi')
 
+  class KeyNode(object):
+    '''
+    a node in a key tree, the path to the node are the parts of the key (split at .)
+    key is set if there is an entry for exactly this path
+    '''
+    def __init__(self):
+      self.children={}
+      self.key=None
+
+    @classmethod
+    def splitKey(cls,key):
+      #trailing dots do not create own levels
+      return key.rstrip('.').split('.')
+
+    def find(self,parts):
+      node=self
+      for part in parts:
+        node=node.children.get(part)
+        if node is None:
+          return None
+      return node
+
+    def add(self,key,parts=None):
+      node=self
+      for part in (parts if parts is not None else self.splitKey(key)):
+        child=node.children.get(part)
+        if child is None:
+          child=AVNStore.KeyNode()
+          node.children[part]=child
+        node=child
+      node.key=key
+      return node
+
+    def remove(self,key):
+      '''
+      remove a key and all nodes that become empty
+      '''
+      path=[]
+      node=self
+      for part in self.splitKey(key):
+        child=node.children.get(part)
+        if child is None:
+          return
+        path.append((node,part))
+        node=child
+      if node.key != key:
+        return
+      node.key=None
+      for parent,part in reversed(path):
+        if node.key is not None or len(node.children) > 0:
+          break
+        del parent.children[part]
+        node=parent
+
+    def matchWildcard(self,key):
+      '''
+      find a wildcard key in this tree that matches key
+      (same rules as AVNStore.wildCardMatch)
+      @return: the matching wildcard key or None
+      '''
+      parts=key.split('.')
+      numParts=len(parts)
+      stack=[(self,0,False)]
+      while len(stack) > 0:
+        node,idx,isWildcard=stack.pop()
+        if node.key is not None and (idx == numParts or isWildcard):
+          #a wildcard at the end also matches all remaining parts
+          return node.key
+        if idx >= numParts:
+          continue
+        child=node.children.get(parts[idx])
+        if child is not None:
+          stack.append((child,idx+1,False))
+        child=node.children.get('*')
+        if child is not None:
+          stack.append((child,idx+1,True))
+      return None
+
+  class Snapshot(object):
+    '''
+    an immutable view of all entries below a prefix
+    the data must not be modified by readers
+    '''
+    def __init__(self,version,data,validUntil):
+      self.version=version
+      self.data=data
+      #steady time when the first entry will expire
+      self.validUntil=validUntil
+
   CHANGE_COUNTER = ['alarm', 'leg', 'route','config']
   def __init__(self,expiryTime,aisExpiryTime,ownMMSI,useAisAge):
     self.__list={}
+    # tree of all keys in __list for prefix queries
+    self.__keyTree=AVNStore.KeyNode()
     self.__aisList={}
     self.__listLock=threading.Lock()
     self.__aisLock = threading.Lock()
@@ -88,9 +187,26 @@ class AVNStore(object):
     self.__approvedKeys=set()
     # store for the wildcard keys
     self.__wildcardKeys={}
+    # tree of the wildcard keys for matching
+    self.__wildcardTree=AVNStore.KeyNode()
     # all the key sources
     self.__keySources={}
     self.__lastAisSource=None
+    # spatial index: cell -> set of ais keys, ais key -> cell
+    self.__aisGrid={}
+    self.__aisCells={}
+    # expiry queue: heap of (timestamp,ais key)
+    # an item is pushed whenever the timestamp of an entry changes,
+    # items not matching the current timestamp are skipped when popped
+    self.__aisExpiry=[]
+    # version per top level prefix, incremented on every change below it
+    self.__versions={}
+    # version of the AIS data, incremented on every change
+    self.__aisVersion=0
+    # the last snapshot for a prefix
+    self.__snapshots={}
+    # callbacks for position changes, replaced on every change
+    self.__positionListeners=()
     self.__registerInternalKeys()
     for ck in self.CHANGE_COUNTER:
       self.updateChangeCounter(ck)
@@ -117,11 +233,40 @@ class AVNStore(object):
     return self.__expiryTime
   def getAisExpiryPeriod(self):
     return self.__aisExpiryTime
+  def __topPrefix(self,key):
+    pos=key.find('.')
+    if pos < 0:
+      return key
+    return key[0:pos]
+
+  def __changed(self,key):
+    '''
+    must be called with the list lock held
+    '''
+    top=self.__topPrefix(key)
+    self.__versions[top]=self.__versions.get(top,0)+1
+
+  def getVersion(self,prefix):
+    '''
+    get the current version of a top level prefix
+    @param prefix: the prefix, only the first part (until a .) is considered
+    '''
+    top=self.__topPrefix(prefix)
+    if top == self.BASE_KEY_AIS:
+      return self.__aisVersion
+    return self.__versions.get(top,0)
+
   def updateBaseConfig(self,expiry,aisExpiry,ownMMSI,useAisAge):
+    if expiry != self.__expiryTime:
+      with self.__listLock:
+        self.__snapshots.clear()
     self.__expiryTime=expiry
     self.__aisExpiryTime=aisExpiry
     self.__ownMMSI=ownMMSI
     self.__useAisAge=useAisAge
+    if ownMMSI != '':
+      with self.__aisLock:
+        self.__removeAis(AVNStore.BASE_KEY_AIS+"."+str(ownMMSI))
 
   def updateChangeCounter(self,name):
     if not name in self.CHANGE_COUNTER:
@@ -134,8 +279,10 @@ class AVNStore(object):
       if entry is None:
         entry=AVNStore.DataEntry(time.monotonic(),keepAlways=True)
         self.__list[listKey]=entry
+        self.__keyTree.add(listKey)
       else:
         entry.value+=1
+      self.__changed(listKey)
     except:
       pass
     self.__listLock.release()
@@ -161,6 +308,7 @@ class AVNStore(object):
           keylist=list(value.keys())
           isDict=True
         hasUpdate=False
+        positionUpdate=False
         for kext in keylist:
           if isDict:
             listKey=key+'.'+kext
@@ -177,13 +325,80 @@ class AVNStore(object):
               doUpdate=False
           if doUpdate:
             hasUpdate=True
+            if existing is None:
+              self.__keyTree.add(listKey)
+            if existing is None or existing.value != dataValue:
+              self.__changed(listKey)
             self.__list[listKey]=AVNStore.DataEntry(dataValue, keepAlways=keepAlways,priority=priority,source=source)
+            if listKey in self.POSITION_KEYS:
+              positionUpdate=True
           else:
             AVNLog.debug("AVNavData: keeping existing entry for %s",listKey)
-        return hasUpdate
       except :
         AVNLog.error("exception in writing data: %",traceback.format_exc())
         raise
+    if positionUpdate:
+      self.__notifyPositionListeners()
+    return hasUpdate
+
+  def setValues(self,values,source=None,keepAlways=False):
+    """
+    set a batch of values with one lock acquisition
+    position listeners are notified once after all values have been set
+    keys that are not registered are skipped (and logged)
+    @param values: iterable of (key,value,priority)
+                   dict values are expanded like in setValue
+    @param source: optional a source key
+    @return: the number of updated entries
+    """
+    numUpdates=0
+    positionUpdate=False
+    with self.__listLock:
+      now=time.monotonic()
+      for key,value,priority in values:
+        if type(value) == dict:
+          items=[(key+'.'+k,v) for k,v in value.items()]
+        else:
+          items=((key,value),)
+        for listKey,dataValue in items:
+          if not self.__allowedKey(listKey):
+            AVNLog.error("key %s is not registered in store",listKey)
+            continue
+          existing=self.__list.get(listKey)
+          if existing is not None and existing.priority > priority and not self.__isExpired(existing,now):
+            continue
+          if existing is None:
+            self.__keyTree.add(listKey)
+          if existing is None or existing.value != dataValue:
+            self.__changed(listKey)
+          self.__list[listKey]=AVNStore.DataEntry(dataValue,keepAlways=keepAlways,priority=priority,source=source,timestamp=now)
+          numUpdates+=1
+          if listKey in self.POSITION_KEYS:
+            positionUpdate=True
+    if positionUpdate:
+      self.__notifyPositionListeners()
+    return numUpdates
+
+  def registerPositionListener(self,callback):
+    '''
+    register a callback that is called (without parameters) whenever
+    the position (lat/lon) has been updated
+    the callback is called in the writer thread and must return quickly
+    '''
+    with self.__listLock:
+      if not callback in self.__positionListeners:
+        self.__positionListeners=self.__positionListeners+(callback,)
+
+  def unregisterPositionListener(self,callback):
+    with self.__listLock:
+      self.__positionListeners=tuple(l for l in self.__positionListeners if l != callback)
+
+  def __notifyPositionListeners(self):
+    for listener in self.__positionListeners:
+      try:
+        listener()
+      except:
+        AVNLog.error("error in position listener: %s",traceback.format_exc())
 
   def setAisValue(self,mmsi,data,source=None,priority=0,timestamp=None):
     """
@@ -201,12 +416,15 @@ class AVNStore(object):
     now=time.monotonic()
     with self.__aisLock:
       existing=self.__aisList.get(key)
+      lastTimestamp=None
       if existing is None:
         existing=AVNStore.AisDataEntry({'mmsi':mmsi},priority,timestamp=timestamp)
         self.__aisList[key]=existing
-      elif existing.priority > priority:
-        AVNLog.debug("ignore ais for %s due to higher prio %d",mmsi,existing.priority)
-        return
+      else:
+        lastTimestamp=existing.timestamp
+        if existing.priority > priority:
+          AVNLog.debug("ignore ais for %s due to higher prio %d",mmsi,existing.priority)
+          return
       if all(k in data for k in ("lat","lon")): # use timestamp is bound to dynamic data
         existing.timestamp = now if timestamp is None else timestamp
         if self.__useAisAge and "second" in data:
@@ -217,7 +435,11 @@ class AVNStore(object):
       else:
         del data["type"] # do not update type from static data
       existing.value.update(data) # update existing data with new data
+      self.__updateAisGrid(key,existing.value)
+      if existing.timestamp != lastTimestamp:
+        self.__scheduleAisExpiry(key,existing)
       self.__lastAisSource=source
+      self.__aisVersion+=1
 
   def addAisItem(self,mmsi,values,source,priority,timestamp=None):
     if self.__ownMMSI != '' and mmsi is not None and self.__ownMMSI == mmsi:
@@ -226,44 +448,239 @@ class AVNStore(object):
     key=AVNStore.BASE_KEY_AIS+"."+str(mmsi)
     with self.__aisLock:
       existing=self.__aisList.get(key)
+      lastTimestamp=None
       if existing is None:
         existing=AVNStore.AisDataEntry({'mmsi':mmsi},priority,timestamp=timestamp)
         self.__aisList[key]=existing
       else:
+        lastTimestamp=existing.timestamp
         if existing.priority > priority:
           AVNLog.debug("ignore ais for %s due to higher prio %d",mmsi,existing.priority)
           return
       for name,value in values.items():
         existing.add(name,value,timestamp=timestamp)
+      if 'lat' in values or 'lon' in values:
+        self.__updateAisGrid(key,existing.value)
+      if existing.timestamp != lastTimestamp:
+        self.__scheduleAisExpiry(key,existing)
       self.__lastAisSource=source
+      self.__aisVersion+=1
 
 
   def getAisData(self, asDict=False):
+    '''
+    get a snapshot of all AIS targets that are not expired
+    expired targets are purged by expireAisData
+    '''
     rt=[] if not asDict else {}
-    keysToRemove=[]
     now=time.monotonic()
-    self.__aisLock.acquire()
-    try:
-      for key in list(self.__aisList.keys()):
-        aisEntry=self.__aisList[key]
-        if self.__isAisExpired(aisEntry, now) or aisEntry.getMmsi() == self.__ownMMSI:
-          keysToRemove.append(key)
-        else:
+    with self.__aisLock:
+      try:
+        expiry=now - self.__aisExpiryTime
+        ownMMSI=self.__ownMMSI
+        for key,aisEntry in self.__aisList.items():
+          if aisEntry.timestamp < expiry or aisEntry.getMmsi() == ownMMSI:
+            continue
           val=aisEntry.value.copy()
           val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
           if asDict:
             rt[key] = val
           else:
             rt.append(val)
-      for rkey in keysToRemove:
-        del self.__aisList[rkey]
+      except:
+        AVNLog.error("error when reading AIS data %s",traceback.format_exc())
+        raise
+    return rt
+
+  def __scheduleAisExpiry(self,key,entry):
+    '''
+    add an AIS entry to the expiry queue
+    only call with the AIS lock held
+    '''
+    heapq.heappush(self.__aisExpiry,(entry.timestamp,key))
+    if len(self.__aisExpiry) > 2*len(self.__aisList)+1000:
+      #too many outdated items - rebuild
+      self.__aisExpiry=[(v.timestamp,k) for k,v in self.__aisList.items()]
+      heapq.heapify(self.__aisExpiry)
+
+  def expireAisData(self,now=None):
+    '''
+    purge all expired AIS targets
+    should be called periodically (from the main loop)
+    @return: the number of removed targets
+    '''
+    if now is None:
+      now=time.monotonic()
+    numRemoved=0
+    with self.__aisLock:
+      expiry=now - self.__aisExpiryTime
+      queue=self.__aisExpiry
+      while len(queue) > 0 and queue[0][0] < expiry:
+        timestamp,key=heapq.heappop(queue)
+        entry=self.__aisList.get(key)
+        if entry is None or entry.timestamp >= expiry:
+          continue
+        self.__removeAis(key)
+        numRemoved+=1
+    if numRemoved > 0:
+      AVNLog.debug("removed %d expired AIS targets",numRemoved)
+    return numRemoved
+
+  @classmethod
+  def __aisCell(cls,lat,lon):
+    return (math.floor(lat/cls.AIS_GRID_SIZE),
+            math.floor(lon/cls.AIS_GRID_SIZE) % round(360/cls.AIS_GRID_SIZE))
+
+  def __updateAisGrid(self,key,value):
+    '''
+    update the spatial index for an AIS entry
+    only call with the AIS lock held
+    '''
+    try:
+      cell=self.__aisCell(float(value.get('lat')),float(value.get('lon')))
     except:
-      AVNLog.error("error when reading AIS data %s",traceback.format_exc())
-      self.__aisLock.release()
-      raise
-    self.__aisLock.release()
+      cell=None
+    existing=self.__aisCells.get(key)
+    if existing == cell:
+      return
+    if existing is not None:
+      keys=self.__aisGrid.get(existing)
+      if keys is not None:
+        keys.discard(key)
+        if len(keys) < 1:
+          del self.__aisGrid[existing]
+    if cell is None:
+      self.__aisCells.pop(key,None)
+      return
+    self.__aisCells[key]=cell
+    keys=self.__aisGrid.get(cell)
+    if keys is None:
+      keys=set()
+      self.__aisGrid[cell]=keys
+    keys.add(key)
+
+  def __removeAis(self,key):
+    '''
+    remove an AIS entry (including the spatial index)
+    only call with the AIS lock held
+    '''
+    if self.__aisList.pop(key,None) is not None:
+      self.__aisVersion+=1
+    cell=self.__aisCells.pop(key,None)
+    if cell is not None:
+      keys=self.__aisGrid.get(cell)
+      if keys is not None:
+        keys.discard(key)
+        if len(keys) < 1:
+          del self.__aisGrid[cell]
+
+  def __aisKeysInBox(self,minLat,minLon,maxLat,maxLon):
+    '''
+    get the keys of all AIS entries from the cells touching the box
+    only call with the AIS lock held
+    @return: a set of keys, None if the box is too large for the index
+    '''
+    numLon=round(360/self.AIS_GRID_SIZE)
+    minLatCell,minLonCell=self.__aisCell(max(minLat,-90),minLon)
+    maxLatCell=math.floor(min(maxLat,90)/self.AIS_GRID_SIZE)
+    lonCells=math.floor(maxLon/self.AIS_GRID_SIZE)-math.floor(minLon/self.AIS_GRID_SIZE)+1
+    if lonCells >= numLon:
+      lonCells=numLon
+    if (maxLatCell-minLatCell+1)*lonCells > min(self.AIS_GRID_MAX_CELLS,len(self.__aisGrid)):
+      return None
+    rt=set()
+    for latCell in range(minLatCell,maxLatCell+1):
+      for idx in range(0,lonCells):
+        keys=self.__aisGrid.get((latCell,(minLonCell+idx) % numLon))
+        if keys is not None:
+          rt.update(keys)
+    return rt
+
+  def __getAisCandidates(self,boxes):
+    '''
+    get the (key,entry) tuples for AIS entries that could be within one of the boxes
+    only call with the AIS lock held
+    @param boxes: list of (minLat,minLon,maxLat,maxLon)
+    '''
+    keys=set()
+    for box in boxes:
+      boxKeys=self.__aisKeysInBox(*box)
+      if boxKeys is None:
+        return list(self.__aisList.items())
+      keys.update(boxKeys)
+    rt=[]
+    for key in keys:
+      entry=self.__aisList.get(key)
+      if entry is not None:
+        rt.append((key,entry))
     return rt
 
+  def __getFilteredAis(self,boxes,check):
+    rt=[]
+    now=time.monotonic()
+    with self.__aisLock:
+      for key,aisEntry in self.__getAisCandidates(boxes):
+        if self.__isAisExpired(aisEntry, now) or aisEntry.getMmsi() == self.__ownMMSI:
+          continue
+        value=aisEntry.value
+        try:
+          ok=check(value)
+        except:
+          AVNLog.debug("unable to check ais data: %s",traceback.format_exc())
+          ok=None
+        if ok is None:
+          continue
+        val=value.copy()
+        val[self.AIS_AGE_KEY]=now-aisEntry.timestamp
+        if ok is not True:
+          val[self.AIS_DISTANCE_KEY]=ok
+        rt.append(val)
+    return rt
+
+  def getAisDataInBox(self,lowerleft,upperright):
+    '''
+    get all AIS targets within a bounding box
+    only the cells of the spatial index touching the box will be checked
+    @param lowerleft: (lat,lon)
+    @param upperright: (lat,lon)
+    @return: a list of AIS values
+    '''
+    def check(value):
+      lat=float(value.get('lat'))
+      lon=float(value.get('lon'))
+      if lowerleft[0] <= lat <= upperright[0] and lowerleft[1] <= lon <= upperright[1]:
+        return True
+      return None
+    return self.__getFilteredAis([(lowerleft[0],lowerleft[1],upperright[0],upperright[1])],check)
+
+  def getAisDataByDistance(self,centers,distance):
+    '''
+    get all AIS targets within a distance of one of the centers
+    only the cells of the spatial index around the centers will be checked
+    @param centers: list of (lat,lon)
+    @param distance: distance in NM
+    @return: a list of AIS values with the distance (in m) to the first matching center
+    '''
+    boxes=[]
+    dlat=distance/60.0
+    for center in centers:
+      coslat=math.cos(math.radians(min(abs(center[0])+dlat,90)))
+      if coslat < 1e-6:
+        dlon=180
+      else:
+        dlon=min(dlat/coslat,180)
+      boxes.append((center[0]-dlat,center[1]-dlon,center[0]+dlat,center[1]+dlon))
+    def check(value):
+      pos=(value.get('lat'),value.get('lon'))
+      mdist=None
+      for center in centers:
+        mdist=AVNUtil.distance(pos,center)
+        if mdist <= distance:
+          return mdist*AVNUtil.NM #have this in m
+      AVNLog.debug("filtering out %s due to distance %f",str(value.get('mmsi')),mdist)
+      return None
+    return self.__getFilteredAis(boxes,check)
+
   def getSingleValue(self,key,includeInfo=False):
     rt=None
     with self.__listLock:
@@ -285,52 +702,118 @@ class AVNStore(object):
     @param prefix: the prefix
     @param levels: the number of levels to be returned (default: all)
     @return: a dict with all entries, keys having the prefix removed
+             the caller owns the returned dict
     """
     if prefix == self.BASE_KEY_AIS:
       rt=self.getAisData(True)
       return rt
-    prefix=prefix+"."
-    plen=len(prefix)
+    if levels is not None:
+      with self.__listLock:
+        rt,validUntil=self.__collect(prefix,levels)
+      return rt
+    return self.__copyData(self.getSnapshot(prefix).data)
+
+  @classmethod
+  def __copyData(cls,data):
     rt={}
+    for k,v in data.items():
+      if type(v) == dict:
+        v=cls.__copyData(v)
+      rt[k]=v
+    return rt
+
+  def getSnapshot(self,prefix,version=None):
+    """
+    get a snapshot of all entries with a certain prefix
+    (same structure as getDataByPrefix)
+    the snapshot is shared between all readers and must not be modified
+    it is only rebuilt if the data has changed or an entry has expired
+    @param prefix: the prefix (not ais)
+    @param version: if set, return None if the version is still the same
+    @return: a Snapshot or None
+    """
+    snapshot=self.__snapshots.get(prefix)
+    if snapshot is None \
+        or snapshot.version != self.__versions.get(self.__topPrefix(prefix),0) \
+        or snapshot.validUntil <= time.monotonic():
+      snapshot=self.__buildSnapshot(prefix)
+    if version is not None and snapshot.version == version:
+      return None
+    return snapshot
+
+  def __collect(self,prefix,levels=None):
+    '''
+    build the nested dict for all entries below prefix
+    only the sub tree of the prefix is visited, expired entries are removed
+    must be called with the list lock held
+    @param levels: max depth below the prefix (None: all)
+    @return: (dict,validUntil) - validUntil being the time the first entry expires (or None)
+    '''
+    node=self.__keyTree.find(prefix.split('.'))
+    if node is None:
+      return {},None
+    now=time.monotonic()
+    expiry=now-self.__expiryTime
+    validUntil=None
+    keysToRemove=[]
+    rt={}
+    #dicts for compound keys without an own value: (parent,name,dict)
+    compound=[]
+    stack=[(node,rt,1)]
+    while len(stack) > 0:
+      node,current,level=stack.pop()
+      for name,child in node.children.items():
+        value=None
+        hasValue=False
+        if child.key is not None:
+          entry=self.__list.get(child.key)
+          if entry is not None:
+            if not entry.keepAlways and entry.timestamp < expiry:
+              keysToRemove.append(child.key)
+            else:
+              if not entry.keepAlways:
+                expires=entry.timestamp+self.__expiryTime
+                if validUntil is None or expires < validUntil:
+                  validUntil=expires
+              value=entry.value
+              hasValue=True
+        if len(child.children) > 0 and (levels is None or level < levels):
+          #compound key - a value at the same level is kept as 'value'
+          if not hasValue:
+            sub={}
+            compound.append((current,name,sub))
+          elif type(value) == dict:
+            sub=value.copy()
+          else:
+            sub={'value':value}
+          current[name]=sub
+          stack.append((child,sub,level+1))
+        elif hasValue:
+          current[name]=value
+    if len(keysToRemove) > 0:
+      for key in keysToRemove:
+        del self.__list[key]
+        self.__keyTree.remove(key)
+      self.__changed(prefix)
+    #drop compound keys that only contained expired or cut off entries
+    #children have been added after their parents
+    for parent,name,sub in reversed(compound):
+      if len(sub) < 1:
+        del parent[name]
+    return rt,validUntil
+
+  def __buildSnapshot(self,prefix):
+    top=self.__topPrefix(prefix)
     with self.__listLock:
       try:
-        now=time.monotonic()
-        keysToRemove=[]
-        for key in list(self.__list.keys()):
-          if not key.startswith(prefix):
-            continue
-          entry=self.__list[key]
-          if self.__isExpired(entry, now):
-            keysToRemove.append(key)
-          else:
-            nkey=key[plen:]
-            if nkey.find(".") >= 0:
-              nkey=re.sub('\.*$','',nkey)
-            if nkey.find(".") >= 0:
-              #compound key
-              keyparts=nkey.split(".")
-              numparts=len(keyparts)
-              current=rt
-              for i in range(0,numparts-1):
-                if current.get(keyparts[i]) is None:
-                  current[keyparts[i]]={}
-                nextV=current[keyparts[i]]
-                if not type(nextV) == dict:
-                  #AVNLog.error("inconsistent data , found normal value and dict with key %s"%(".".join(keyparts[0:i])))
-                  current[keyparts[i]]={'value':nextV}
-                  current=current[keyparts[i]]
-                else:
-                  current=nextV
-              if type(current) == dict:
-                current[keyparts[-1]]=entry.value
-            else:
-              rt[nkey]=entry.value
-        for rkey in keysToRemove:
-          del self.__list[rkey]
+        rt,validUntil=self.__collect(prefix)
+        snapshot=AVNStore.Snapshot(self.__versions.get(top,0),rt,
+                                   validUntil if validUntil is not None else float('inf'))
+        self.__snapshots[prefix]=snapshot
+        return snapshot
       except:
         AVNLog.error("error getting value with prefix %s: %s"%(prefix,traceback.format_exc()))
         raise
-      return rt
 
   #delete all entries from the list (e.g. when we have to set the time)
   def reset(self):
@@ -342,9 +825,17 @@ class AVNStore(object):
           for k in keysToRemove:
             try:
                 del self.__list[k]
+                self.__keyTree.remove(k)
             except:
                 pass
+          for k in set(map(self.__topPrefix,keysToRemove)):
+            self.__changed(k)
+      with self.__aisLock:
           self.__aisList.clear()
+          self.__aisGrid.clear()
+          self.__aisCells.clear()
+          self.__aisExpiry.clear()
+          self.__aisVersion+=1
 
   def getAisCounter(self):
     return len(self.__aisList)
@@ -392,10 +883,9 @@ class AVNStore(object):
       return True
     if key in self.__approvedKeys:
       return True
-    for wildcard in list(self.__wildcardKeys.keys()):
-      if self.wildCardMatch(key, wildcard):
-        self.__approvedKeys.add(key)
-        return True
+    if self.__wildcardTree.matchWildcard(key) is not None:
+      self.__approvedKeys.add(key)
+      return True
     return False
 
   def isKeyRegistered(self,key,source=None):
@@ -419,9 +909,9 @@ class AVNStore(object):
     for existing in list(self.__registeredKeys.keys()):
       if existing == key or key.startswith(existing):
         raise Exception("key %s already registered from %s:%s" % (key,existing,self.__registeredKeys[existing]))
-    for existing in list(self.__wildcardKeys.keys()):
-      if self.wildCardMatch(key, existing):
-        raise Exception("key %s matches wildcard from %s:%s" % (key, existing, self.__wildcardKeys[existing]))
+    existing=self.__wildcardTree.matchWildcard(key)
+    if existing is not None:
+      raise Exception("key %s matches wildcard from %s:%s" % (key, existing, self.__wildcardKeys[existing]))
     if self.__isWildCard(key):
       for existing in list(self.__registeredKeys.keys()):
         if self.wildCardMatch(existing, key):
@@ -444,6 +934,7 @@ class AVNStore(object):
     self.__keySources[key]=source
     if self.__isWildCard(key):
       self.__wildcardKeys[key]=keyDescription
+      self.__wildcardTree.add(key,key.split('.'))
     else:
       self.__registeredKeys[key] = keyDescription
 
@@ -481,6 +481,46 @@ class AVNUtil(object):
     "to_starboard": int,  # D
   }
 
+  # converters for the native (already decoded) values from the AIS unpacker
+  # they must give the same results as ais_converters applied to str(value)
+  ais_native_converters = {
+    "mmsi": str,
+    "lat": lambda v: v / 600000,
+    "lon": lambda v: v / 600000,
+    "speed": lambda v: v / 10 * AVNUtil.NM / 3600,
+    "course": lambda v: v / 10,
+    "turn": lambda v: round(copysign((v / 4.733) ** 2, v))
+    if abs(v) < 128
+    else None,
+    "draught": lambda v: v / 10,
+  }
+
+  @classmethod
+  def aisNativeConverter(cls, name):
+    """
+    get the converter for a native AIS value
+    @param name: the (translated) field name
+    @return: a function value->converted value
+    """
+    rt = cls.ais_native_converters.get(name)
+    if rt is not None:
+      return rt
+    if cls.ais_converters.get(name) is int:
+      def checkInt(v):
+        return v if type(v) is int else int(v)
+      return checkInt
+    if name in cls.ais_converters:
+      return cls.ais_converters[name]
+    return str
+
+  @classmethod
+  def addAISDimensions(cls, aisdata):
+    try:
+      aisdata["beam"] = aisdata["to_port"] + aisdata["to_starboard"]
+      aisdata["length"] = aisdata["to_bow"] + aisdata["to_stern"]
+    except: pass
+    return aisdata
+
   @classmethod
   def convertAIS(cls, aisdata):
     "convert ais raw values to real values"
@@ -494,12 +534,7 @@ class AVNUtil(object):
       except:
         rt[k] = None  # explicitly map invalid data to none
 
-    try:
-      rt["beam"] = rt["to_port"] + rt["to_starboard"]
-      rt["length"] = rt["to_bow"] + rt["to_stern"]
-    except: pass
-
-    return rt
+    return cls.addAISDimensions(rt)
   
   #parse an ISO8601 t8ime string
   #see http://stackoverflow.com/questions/127803/how-to-parse-iso-formatted-date-in-python
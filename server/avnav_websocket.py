@@ -134,6 +134,14 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
     else:
       self._send_message(self._opcode_text, message)
 
+  def send_queue_size(self):
+    '''
+    the number of messages waiting to be sent
+    '''
+    if self.send_queue_len() > 0:
+      return len(self.queue.data)
+    return 0
+
   def close_ws(self):
     if self.send_queue_len() > 0:
       self.queue.clear()
@@ -27,6 +27,7 @@
 # read gemf files and provide them for access via http
 # see http://www.cgtk.co.uk/gemf
 import sys
+import mmap
 import os
 import struct
 import threading
@@ -36,10 +37,36 @@ import create_overview
 from avnav_util import AVNLog, ChartFile
 
 
+class PreadFile(object):
+  '''
+  read only access to a file with os.pread
+  used for parts that cannot be mapped (e.g. address space on 32 bit systems)
+  supports slicing like a memory map
+  without os.pread (windows) we use seek+read with a lock per file
+  '''
+  def __init__(self,handle):
+    self.handle=handle
+    self.fd=handle.fileno()
+    self.lock=None if hasattr(os,'pread') else threading.Lock()
+  def __getitem__(self,item):
+    if self.lock is None:
+      return os.pread(self.fd,item.stop-item.start,item.start)
+    with self.lock:
+      self.handle.seek(item.start)
+      return self.handle.read(item.stop-item.start)
+
+
 class GemfFile(ChartFile):
+  #the spatial index for ranges of one zoom level
+  #uses buckets of 2^^shift tiles, the shift is increased until
+  #the number of bucket entries is below this factor * number of ranges
+  MAX_BUCKET_FACTOR=4
   def __init__(self,filename):
     self.filename=filename
     self.handles=[]
+    #read only memory maps (or PreadFile) for all handles
+    #all tile reads go through them, so we do not need any lock
+    self.maps=[]
     self.sources=[]
     # a dict of ranges sorted by sources
     # each entry is a dict of zoom levels, containing the range entries, each being a tuple of xmin,xmax,ymin,ymax,offset
@@ -49,7 +76,8 @@ class GemfFile(ChartFile):
     self.isOpen=False
     self.numsources=0
     self.rangenum=0
-    self.lock=threading.Lock()
+    # source -> zoom -> (shift, dict (x>>shift,y>>shift) -> list of ranges)
+    self.rangeindex={}
   #open the file and read the header
   def open(self):
     if self.isOpen:
@@ -119,6 +147,45 @@ class GemfFile(ChartFile):
     for h in self.handles:
       st=os.fstat(h.fileno())
       self.lengthes.append(st.st_size)
+      if st.st_size > 0:
+        try:
+          self.maps.append(mmap.mmap(h.fileno(),0,access=mmap.ACCESS_READ))
+        except (OSError,ValueError) as e:
+          AVNLog.info("unable to map %s (%s), using pread",h.name,str(e))
+          self.maps.append(PreadFile(h))
+      else:
+        self.maps.append(b'')
+    for sname,zooms in self.sourceranges.items():
+      self.rangeindex[sname]={}
+      for zoom,rangelist in zooms.items():
+        self.rangeindex[sname][zoom]=self.buildRangeIndex(rangelist)
+
+  @classmethod
+  def buildRangeIndex(cls,rangelist):
+    '''
+    build a bucket index for a list of ranges
+    @param rangelist: list of tuples (xmin,xmax,ymin,ymax,offset)
+    @return: (shift, dict bucket -> ranges)
+    '''
+    shift=0
+    maxEntries=cls.MAX_BUCKET_FACTOR*len(rangelist)+64
+    while shift < 31:
+      numEntries=0
+      for r in rangelist:
+        numEntries+=((r[1]>>shift)-(r[0]>>shift)+1)*((r[3]>>shift)-(r[2]>>shift)+1)
+      if numEntries <= maxEntries:
+        break
+      shift+=1
+    buckets={}
+    for r in rangelist:
+      for bx in range(r[0]>>shift,(r[1]>>shift)+1):
+        for by in range(r[2]>>shift,(r[3]>>shift)+1):
+          bucket=buckets.get((bx,by))
+          if bucket is None:
+            bucket=[]
+            buckets[(bx,by)]=bucket
+          bucket.append(r)
+    return (shift,buckets)
 
 
   #find a range for a tile
@@ -130,7 +197,10 @@ class GemfFile(ChartFile):
       return None
     try:
       z,x,y=tile
-      rangelist=self.sourceranges[source][z]
+      shift,buckets=self.rangeindex[source][z]
+      rangelist=buckets.get((x>>shift,y>>shift))
+      if rangelist is None:
+        return None
       for range in rangelist:
         if x < range[0] or x > range[1] or y < range[2] or y > range[3]:
           continue
@@ -150,22 +220,14 @@ class GemfFile(ChartFile):
     idxr=idxx*ynum+idxy;
     #each range entry has 12 bytes (offset 8 , len 4)
     offset=12*idxr+rdata[4]
-    try:
-      self.lock.acquire()
-      self.handles[0].seek(offset)
-      buf=self.handles[0].read(12)
-      self.lock.release()
-      offset,flen=struct.unpack_from("!ql",buf,0)
-      return (offset,flen)
-    except:
-      self.lock.release()
-      raise
+    offset,flen=struct.unpack("!ql",self.maps[0][offset:offset+12])
+    return (offset,flen)
  
-  #find the file and offset to fetch data
+  #find the map and offset to fetch data
   def getFileAndOffset(self,offset):
     for i in range(len(self.lengthes)):
       if offset < self.lengthes[i]:
-        return (self.handles[i],offset)
+        return (self.maps[i],offset)
       offset-=self.lengthes[i]
     return (None,None)
 
@@ -173,19 +235,10 @@ class GemfFile(ChartFile):
     offset,flen=self.getTileOffsetLen(tile,source)
     if offset is None or flen is None:
       return None
-    try:
-      #todo: handle multiple locks
-      fhandle,foffset=self.getFileAndOffset(offset)
-      if fhandle is None or foffset is None:
-        return None
-      self.lock.acquire()
-      fhandle.seek(foffset)
-      buf=fhandle.read(flen)
-      self.lock.release()
-      return buf
-    except:
-      self.lock.release()
-      raise
+    fmap,foffset=self.getFileAndOffset(offset)
+    if fmap is None or foffset is None:
+      return None
+    return fmap[foffset:foffset+flen]
 
   #get a list of sources and their assigned ranges
   def getSources(self):
@@ -210,10 +263,21 @@ class GemfFile(ChartFile):
   def close(self):
     if not self.isOpen:
       return
+    self.isOpen=False
+    maps=self.maps
+    self.maps=[]
+    for m in maps:
+      if isinstance(m,mmap.mmap):
+        try:
+          m.close()
+        except BufferError:
+          #still in use by a reader, will be freed with the last reference
+          pass
     for h in self.handles:
       h.close()
     self.handles=[]
     self.lengthes=[]
+    self.rangeindex={}
     self.ranges=[]
     self.sources=[]
     self.rangenum=0
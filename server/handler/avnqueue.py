@@ -40,12 +40,203 @@ class NmeaEntry(object):
     self.subsource=subsource
 
 
+class NmeaHistory(object):
+  '''
+  a ring buffer of NmeaEntry with a fixed capacity (maxlist)
+  the entry for a sequence is stored at sequence % maxlist
+  '''
+  def __init__(self,maxlist,condition=None):
+    self.condition=condition if condition is not None else threading.Condition()
+    self.history=[]
+    self.historyLen=0
+    #sequence semantics:
+    #the last entry in the ring has the sequence stored here
+    #the first entry has self.sequence-self.historyLen+1
+    #so if there is one entry in the list
+    #current sequence and first sequence are identical
+    self.sequence=1
+    self.maxlist=0
+    self.resize(maxlist)
+
+  def _firstSequence(self):
+    '''
+    get the first sequence
+    only call when the list is locked
+    @return:
+    '''
+    return self.sequence-self.historyLen+1
+
+  def _slice(self,startSequence,num):
+    '''
+    get num entries starting at startSequence
+    only call when the list is locked and the range is in the ring
+    '''
+    start=startSequence % self.maxlist
+    end=start+num
+    if end <= self.maxlist:
+      return self.history[start:end]
+    return self.history[start:]+self.history[:end-self.maxlist]
+
+  def _firstNotOlder(self,startSequence,allowedAge):
+    '''
+    binary search for the first sequence >= startSequence
+    with an entry not older then allowedAge
+    only call when the list is locked
+    @return: the sequence, self.sequence+1 if all entries are too old
+    '''
+    history=self.history
+    maxlist=self.maxlist
+    lo=startSequence
+    hi=self.sequence+1
+    if lo >= hi or history[lo % maxlist].timestamp >= allowedAge:
+      return lo
+    while lo < hi:
+      mid=(lo+hi)//2
+      if history[mid % maxlist].timestamp < allowedAge:
+        lo=mid+1
+      else:
+        hi=mid
+    return lo
+
+  def resize(self,maxlist):
+    '''
+    change the capacity of the ring
+    keeps the newest entries
+    '''
+    with self.condition:
+      if maxlist == self.maxlist:
+        return
+      keep=min(self.historyLen,maxlist)
+      entries=self._slice(self.sequence-keep+1,keep) if keep > 0 else []
+      self.maxlist=maxlist
+      self.history=[None]*maxlist
+      self.historyLen=keep
+      for idx in range(0,keep):
+        seq=self.sequence-keep+1+idx
+        self.history[seq % maxlist]=entries[idx]
+
+  def add(self,entry):
+    '''
+    append an entry and wake up waiting readers
+    @return: the number of entries in the ring
+    '''
+    with self.condition:
+      self.sequence+=1
+      self.history[self.sequence % self.maxlist]=entry
+      if self.historyLen < self.maxlist:
+        self.historyLen+=1
+      self.condition.notify_all()
+      return self.historyLen
+
+  def addList(self,entries):
+    '''
+    append a list of entries and wake up waiting readers once
+    @return: the number of entries in the ring
+    '''
+    with self.condition:
+      for entry in entries:
+        self.sequence+=1
+        self.history[self.sequence % self.maxlist]=entry
+      self.historyLen=min(self.maxlist,self.historyLen+len(entries))
+      self.condition.notify_all()
+      return self.historyLen
+
+  def wakeUp(self):
+    with self.condition:
+      self.condition.notify_all()
+
+  def fetch(self,sequence,maxEntries,waitTime,maxAge):
+    '''
+    fetch entries with a sequence higher then the provided one
+    wait up to waitTime if nothing is available
+    @return: (numErrors,lastSequence,[entries])
+    '''
+    seq=0
+    rtlist=[]
+    if sequence is None:
+      sequence=0
+    stop = time.monotonic() + waitTime
+    numErrors=0
+    with self.condition:
+      if sequence <= 0:
+        #if a new connection is opened - always wait for a new entry before sending out
+        #sequence = 0 or sequence = None is a new connection
+        #self.sequence starts at 1
+        sequence=self.sequence+1
+      else:
+        #we expect at least the next sequence from what we had
+        sequence+=1
+      try:
+        while len(rtlist) < 1:
+          seq=self.sequence
+          if seq >= sequence:
+            # we now try to get entries from the starting sequence to the topmost
+            # but not more then maxEntries
+            # and not older then maxAge
+            startSequence=self._firstSequence()
+            if (sequence >= startSequence):
+              #good we still have our expected sequence in the queue
+              startSequence=sequence
+            else:
+              #our requested sequence is not in the list any more
+              numErrors=startSequence-sequence
+            allowedAge=time.monotonic()-maxAge #maybe better related to return point
+            firstSequence=self._firstNotOlder(startSequence,allowedAge)
+            numErrors+=firstSequence-startSequence
+            if firstSequence <= self.sequence:
+              #something to return
+              numrt=self.sequence-firstSequence+1
+              if numrt > maxEntries:
+                numrt=maxEntries
+              seq=firstSequence+numrt-1
+              rtlist=self._slice(firstSequence,numrt)
+              break
+            #if we did not find anything
+            #we start the next time at the topmost sequence+1
+            sequence=self.sequence+1
+            seq=sequence #we return this if nothing found
+          if len(rtlist) < 1:
+            wait = stop - time.monotonic()
+            if wait <= 0:
+              break
+            self.condition.wait(wait)
+      except Exception as e:
+        pass
+    return (numErrors,seq,rtlist)
+
+
+class NmeaChannel(NmeaHistory):
+  '''
+  a pre-filtered subscription on the queue
+  all consumers with the same filter and blacklist share one channel
+  entries are classified once when they are added to the queue
+  and consumers wait on the channel's own condition
+  '''
+  def __init__(self,maxlist,nmeaFilter=None,blackList=None):
+    super().__init__(maxlist)
+    self.key=self.computeKey(nmeaFilter,blackList)
+    self.refCount=0
+    self._filterCheck=NMEAParser.compileFilter(nmeaFilter)
+    self._blackList=frozenset(blackList) if blackList is not None else None
+
+  @classmethod
+  def computeKey(cls,nmeaFilter,blackList):
+    return (tuple(nmeaFilter) if nmeaFilter is not None else None,
+            frozenset(blackList) if blackList is not None else None)
+
+  def matches(self,entry:NmeaEntry):
+    if self._blackList is not None and entry.source in self._blackList:
+      return False
+    if self._filterCheck is not None and not self._filterCheck(entry.data):
+      return False
+    return True
+
 
 #a Worker for feeding data trough gpsd (or directly to the navdata)
 class AVNQueue(AVNWorker):
   P_MAXLIST=WorkerParameter('maxList',default=300,type=WorkerParameter.T_NUMBER,
                             description='number of nmea records to be queued',
-                            rangeOrList=[10,3000])
+                            rangeOrList=[10,10000])
   P_SLEEP=WorkerParameter('feederSleep',default=0.5,type=WorkerParameter.T_FLOAT,
                           editable=False)
   P_NAME=WorkerParameter('name',default='main',type=WorkerParameter.T_STRING,
@@ -74,22 +265,16 @@ class AVNQueue(AVNWorker):
     super().__init__(cfgparam)
     self.type=AVNWorker.Type.FEEDER
     self.listlock=threading.Condition()
-    self.history=[]
-    #sequence semantics:
-    #the last entry in the list has the sequence stored here
-    #the first entry has self.sequence-len(self.history)+1
-    #so if there is one entry in the list
-    #current sequence and first sequence are identical
-    self.sequence=1
+    self.history=NmeaHistory(self.P_MAXLIST.fromDict(self.param),self.listlock)
+    #the subscription channels by their filter/blacklist key
+    #only modified when holding listlock
+    self.channels={}
     self.readConfig()
 
-  def _firstSequence(self):
-    '''
-    get the first sequence
-    only call when the list is locked
-    @return:
-    '''
-    return self.sequence-len(self.history)+1
+  @property
+  def sequence(self):
+    return self.history.sequence
+
   def updateConfig(self, param, child=None):
     rt=super().updateConfig(param, child)
     self.readConfig()
@@ -99,16 +284,42 @@ class AVNQueue(AVNWorker):
     self.maxlist = self.P_MAXLIST.fromDict(self.param)
     self.waitTime= self.P_SLEEP.fromDict(self.param)
     self.maxAge= self.P_AGE.fromDict(self.param)
+    with self.listlock:
+      self.history.resize(self.maxlist)
+      for channel in self.channels.values():
+        channel.resize(self.maxlist)
 
   def stop(self):
     super().stop()
-    self.listlock.acquire()
-    try:
-      self.listlock.notifyAll()
-    finally:
-      self.listlock.release()
+    self.wakeUp()
 
+  def subscribe(self,nmeaFilter=None,blackList=None):
+    '''
+    get a subscription channel for a filter/blacklist combination
+    consumers with the same combination share a channel
+    call unsubscribe when done
+    @param nmeaFilter: an nmeafilter (list) or None
+    @param blackList: a list of source names to be omitted or None
+    @return: the NmeaChannel
+    '''
+    key=NmeaChannel.computeKey(nmeaFilter,blackList)
+    with self.listlock:
+      channel=self.channels.get(key)
+      if channel is None:
+        channel=NmeaChannel(self.maxlist,nmeaFilter,blackList)
+        self.channels[key]=channel
+        AVNLog.debug("new queue channel filter=%s, blacklist=%s",nmeaFilter,blackList)
+      channel.refCount+=1
+      return channel
 
+  def unsubscribe(self,channel:NmeaChannel):
+    if channel is None:
+      return
+    with self.listlock:
+      channel.refCount-=1
+      if channel.refCount <= 0 and self.channels.get(channel.key) == channel:
+        del self.channels[channel.key]
+        AVNLog.debug("removed queue channel %s",str(channel.key))
 
   def addNMEA(self, entry,source=None,addCheckSum=False,omitDecode=False,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,subsource=None):
     """
@@ -131,20 +342,47 @@ class AVNQueue(AVNWorker):
         entry=entry+"\r\n"
     nentry=NmeaEntry(entry,source,omitDecode,sourcePriority,subsource=subsource)
     with self.listlock:
-      self.sequence+=1
-      if len(self.history) >= self.maxlist:
-        self.history.pop(0)
-      self.history.append(nentry)
-      hl=len(self.history)
+      hl=self.history.add(nentry)
+      for channel in self.channels.values():
+        if channel.matches(nentry):
+          channel.add(nentry)
       rt=True
-      self.listlock.notify_all()
     AVNLog.debug("addNMEA history=%d data=%s",hl,entry)
     return rt
 
+  def addNMEABatch(self,entries,source=None,omitDecode=False,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,subsource=None):
+    """
+    add a list of NMEA records (e.g. all lines from one read) to our internal queue
+    the list lock is only taken once and readers are only woken up once
+    @param entries: the records
+    @param source: the source where the records come from
+    @return: the number of records added
+    """
+    nentries=[]
+    for entry in entries:
+      if len(entry) < 5:
+        AVNLog.debug("addNMEA: ignoring short data %s",entry)
+        continue
+      if not entry[-2:]=="\r\n":
+        entry=entry+"\r\n"
+      nentries.append(NmeaEntry(entry,source,omitDecode,sourcePriority,subsource=subsource))
+    if len(nentries) < 1:
+      return 0
+    with self.listlock:
+      hl=self.history.addList(nentries)
+      for channel in self.channels.values():
+        matching=[nentry for nentry in nentries if channel.matches(nentry)]
+        if len(matching) > 0:
+          channel.addList(matching)
+    AVNLog.debug("addNMEABatch history=%d, %d records",hl,len(nentries))
+    return len(nentries)
+
   def wakeUp(self):
     super().wakeUp()
     with self.listlock:
-      self.listlock.notifyAll()
+      self.history.wakeUp()
+      for channel in self.channels.values():
+        channel.wakeUp()
 
   #fetch entries from the history
   #only return entries with higher sequence
@@ -171,19 +409,12 @@ class AVNQueue(AVNWorker):
     @param omitsubsource: if set do not fetch records from this subsource
     @return:
     '''
-    seq=0
-    rtlist=[]
     if maxAge is None:
       maxAge=self.maxAge
     if waitTime <=0:
       waitTime=0.1
     if maxEntries< 0:
       maxEntries=0
-    if sequence is None:
-      sequence=0
-    now=time.monotonic()
-    stop = now + waitTime
-    numErrors=0
     def shouldInclude(item: NmeaEntry):
       if omitsubsource is not None and item.subsource is not None and item.subsource == omitsubsource:
         return False
@@ -194,53 +425,7 @@ class AVNQueue(AVNWorker):
         if item.source in blackList:
           return False
       return True
-    with self.listlock:
-      if sequence <= 0:
-        #if a new connection is opened - always wait for a new entry before sending out
-        #sequence = 0 or sequence = None is a new connection
-        #self.sequence starts at 1
-        sequence=self.sequence+1
-      else:
-        #we expect at least the next sequence from what we had
-        sequence+=1
-      try:
-        while len(rtlist) < 1:
-          seq=self.sequence
-          if seq >= sequence:
-            # we now try to get entries from the starting sequence to the topmost
-            # but not more then maxEntries
-            # and not older then maxAge
-            startSequence=self._firstSequence()
-            if (sequence >= startSequence):
-              #good we still have our expected sequence in the queue
-              startPoint=sequence-startSequence
-            else:
-              #our requested sequence is not in the list any more
-              numErrors=startSequence-sequence
-              startPoint=0
-            allowedAge=time.monotonic()-maxAge #maybe better related to return point
-            while startPoint < len(self.history) and self.history[startPoint].timestamp < allowedAge:
-              numErrors+=1
-              startPoint+=1
-            if startPoint < len(self.history):
-              #something to return
-              numrt=len(self.history)-startPoint
-              if numrt > maxEntries:
-                numrt=maxEntries
-              seq=startSequence+startPoint+numrt-1
-              rtlist=self.history[startPoint:startPoint+numrt]
-              break
-            #if we did not find anything
-            #we start the next time at the topmost sequence+1
-            sequence=self.sequence+1
-            seq=sequence #we return this if nothing found
-          if len(rtlist) < 1:
-            wait = stop - time.monotonic()
-            if wait <= 0:
-              break
-            self.listlock.wait(wait)
-      except Exception as e:
-        pass
+    (numErrors,seq,rtlist)=self.history.fetch(sequence,maxEntries,waitTime,maxAge)
     if len(rtlist) < 1:
       if returnError:
         return (numErrors,seq,rtlist)
@@ -307,12 +492,28 @@ class Fetcher:
     self._returnErrors=returnErrors
     self._sequence=None
     self._sumKey=sumKey
+    self._nmeaSum=None
+    self._nmeaErrors=None
     if sumKey is not None:
       self._nmeaSum=MovingSum()
       self._nmeaErrors=MovingSum()
     self._ownsubsource=ownsubsource
+    self._channel=None
+    self._subscribe()
+
+  def _subscribe(self):
+    oldChannel=self._channel
+    self._channel=self._queue.subscribe(self._nmeaFilter,self._blackList)
+    self._queue.unsubscribe(oldChannel)
+    self._sequence=None
 
   def __del__(self):
+    self.close()
+
+  def close(self):
+    if self._channel is not None:
+      self._queue.unsubscribe(self._channel)
+      self._channel=None
     if self._sumKey is not None:
       self._info.deleteInfo(self._sumKey)
 
@@ -326,6 +527,7 @@ class Fetcher:
                   returnErrors=None,
                   ownsubsource=None
                   ):
+    resubscribe=False
     if maxEntries is not None:
       self._maxEntries=maxEntries
     if includeSource is not None:
@@ -334,29 +536,46 @@ class Fetcher:
       self._waitTime=waitTime
     if nmeaFilter is not None:
       self._nmeaFilter=self._split(nmeaFilter)
+      resubscribe=True
     if maxAge is not None:
       self._maxAge=maxAge
     if returnErrors is not None:
       self._returnErrors=returnErrors
     if blackList is not None:
       self._blackList=self._split(blackList)
+      resubscribe=True
     if ownsubsource is not None:
       self._ownsubsource=ownsubsource if ownsubsource !='' else None
+    if resubscribe and self._channel is not None:
+      if self._channel.key != NmeaChannel.computeKey(self._nmeaFilter,self._blackList):
+        self._subscribe()
 
   def fetch(self,maxEntries=None,
                        waitTime=None,
                        maxAge=None):
-    (numErrors,self._sequence,nmeaList)=self._queue.fetchFromHistory(
-      sequence=self._sequence,
-      includeSource=self._includeSource,
-      waitTime=self._waitTime if waitTime is None else waitTime,
-      maxAge=self._maxAge if maxAge is None else maxAge,
-      nmeafilter=self._nmeaFilter,
-      blackList=self._blackList,
-      returnError=True,
-      maxEntries=self._maxEntries if maxEntries is None else maxEntries,
-      omitsubsource=self._ownsubsource
+    if self._channel is None:
+      self._subscribe()
+    if waitTime is None:
+      waitTime=self._waitTime
+    if waitTime <= 0:
+      waitTime=0.1
+    if maxEntries is None:
+      maxEntries=self._maxEntries
+    if maxEntries < 0:
+      maxEntries=0
+    (numErrors,self._sequence,entries)=self._channel.fetch(
+      self._sequence,
+      maxEntries,
+      waitTime,
+      self._maxAge if maxAge is None else maxAge
       )
+    ownsubsource=self._ownsubsource
+    if ownsubsource is not None:
+      entries=[el for el in entries if el.subsource is None or el.subsource != ownsubsource]
+    if self._includeSource:
+      nmeaList=entries
+    else:
+      nmeaList=[el.data for el in entries]
     if self._nmeaErrors is not None:
       self._nmeaErrors.add(numErrors)
     if self._nmeaSum is not None:
@@ -379,4 +598,4 @@ class Fetcher:
     if self._nmeaSum.shouldUpdate():
       self._info.setInfo(self._sumKey,
                   "%.4g/s, err=%d/10s"%(self._nmeaSum.avg(), self._nmeaErrors.val()),
-                  WorkerStatus.NMEA if self._nmeaSum.val()>0 else WorkerStatus.INACTIVE)
\ No newline at end of file
+                  WorkerStatus.NMEA if self._nmeaSum.val()>0 else WorkerStatus.INACTIVE)
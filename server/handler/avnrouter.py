@@ -289,6 +289,8 @@ class AVNRouter(AVNDirectoryHandlerBase):
     self.activatedAlarms={} #we keep in mind if WE have already set (or reset) an alarm
                             #independently of others already clearing the alarm
                             #so we re-enable it only after we cleared once
+    #alarms are changed from the compute thread and the main loop
+    self.__alarmLock=threading.RLock()
 
     self.startWp = None
     self.endWp = None
@@ -296,6 +298,14 @@ class AVNRouter(AVNDirectoryHandlerBase):
     self.__legLock=threading.Lock()
     self.__writeLegLock=threading.Lock() #alayws lock this first!
     self.approachStarted=None
+    #incremented on every leg change
+    self.__legVersion=0
+    #the versions (gps,leg) we did the last computation for
+    self.__computedVersions=None
+    #(key,WpData) of the last computation
+    self.__wpData=None
+    self.__computeCondition=threading.Condition()
+    self.__computeRequested=False
 
 
 
@@ -321,6 +331,10 @@ class AVNRouter(AVNDirectoryHandlerBase):
             newLeg=f(newLeg,leg)
         changed=(oldLeg == None and newLeg is not None) or not oldLeg.equal(newLeg)
         self.currentLeg=newLeg     
+        if changed:
+          self.__legVersion+=1
+      if changed:
+        self.requestCompute()
       if changed or forceWrite:
         self.navdata.updateChangeCounter(self.LEG_CHANGE_KEY)
         ts=0
@@ -381,11 +395,86 @@ class AVNRouter(AVNDirectoryHandlerBase):
       AVNLog.info("no current leg %s found"%(self.currentLegFileName,))
       self.setCurrentLeg(AVNRoutingLeg({}))
     self.computeApproach()
+    mainThread=self.currentThread
+    #a separate listener object for each loop - bound methods compare equal
+    #and the listener of a stopping loop must not remove the one of a restarted loop
+    def positionListener():
+      self.requestCompute()
+    self.navdata.registerPositionListener(positionListener)
+    computeThread=threading.Thread(target=self.computeLoop,args=(mainThread,positionListener),
+                                   name="%s-compute"%self.getName())
+    computeThread.daemon=True
+    computeThread.start()
     AVNLog.info("router main loop started")
 
+  def requestCompute(self):
+    '''
+    trigger a computation (called on new position fixes and leg changes)
+    '''
+    with self.__computeCondition:
+      self.__computeRequested=True
+      self.__computeCondition.notify_all()
+
+  def stop(self):
+    super().stop()
+    #wake up the compute loop to let it finish
+    self.requestCompute()
+
+  def computeLoop(self,mainThread,positionListener):
+    '''
+    compute the routing data once per new fix or leg change
+    at least every interval to detect a lost position
+    runs until the main thread of the router stops
+    '''
+    while self.currentThread is mainThread:
+      with self.__computeCondition:
+        if not self.__computeRequested:
+          self.__computeCondition.wait(self.getSleepTime())
+        self.__computeRequested=False
+      if self.currentThread is not mainThread:
+        break
+      try:
+        self.compute()
+      except:
+        AVNLog.warn("exception in router computation %s, retrying", traceback.format_exc())
+    self.navdata.unregisterPositionListener(positionListener)
+    AVNLog.info("router computation stopped")
+
+  def compute(self):
+    '''
+    compute RMB/APB, anchor and approach from one position snapshot
+    skipped if neither the gps data nor the leg changed
+    (except for a running early waypoint switch that depends on the time)
+    '''
+    snapshot=self.navdata.getSnapshot(AVNStore.BASE_KEY_GPS)
+    versions=(snapshot.version,self.__legVersion)
+    if versions == self.__computedVersions and self.approachStarted is None:
+      return
+    self.__computedVersions=versions
+    curGps=snapshot.data
+    hasRMB=False
+    leg=self.getCurrentLeg()
+    try:
+      if leg is not None and leg.getAnchorDistance() is not None:
+        self.computeAnchor(curGps)
+      else:
+        self.startStopAlarm(False, self.ALARMS.anchor)
+        self.startStopAlarm(False, self.ALARMS.gps)
+        computeRMB = self.getBoolParam("computeRMB")
+        computeAPB = self.getBoolParam("computeAPB")
+        if computeRMB or computeAPB:
+          hasRMB = self.computeRMB(computeRMB, computeAPB, self.__getWpData(snapshot))
+    except Exception as e:
+      AVNLog.warn("exception in computeRMB %s, retrying", traceback.format_exc())
+    try:
+      self.computeApproach(curGps)
+    except:
+      AVNLog.warn("exception in computeApproach %s, retrying", traceback.format_exc())
+    if (not hasRMB):
+      self.setInfo("autopilot", "no autopilot data", WorkerStatus.INACTIVE)
+
   def periodicRun(self):
     hasLeg = False
-    hasRMB = False
     currentLeg=None
     nonexist=False
     modeText='rhumb line' if self.P_RHUMBLINE.fromDict(self.param) else 'great circle'
@@ -420,26 +509,8 @@ class AVNRouter(AVNDirectoryHandlerBase):
       AVNLog.debug(routerInfo)
       self.setInfo("leg", routerInfo
                    , WorkerStatus.RUNNING)
-    try:
-      if leg is not None and leg.getAnchorDistance() is not None:
-        self.computeAnchor()
-      else:
-        self.startStopAlarm(False, self.ALARMS.anchor)
-        self.startStopAlarm(False, self.ALARMS.gps)
-        computeRMB = self.getBoolParam("computeRMB")
-        computeAPB = self.getBoolParam("computeAPB")
-        if computeRMB or computeAPB:
-          hasRMB = self.computeRMB(computeRMB, computeAPB)
-    except Exception as e:
-      AVNLog.warn("exception in computeRMB %s, retrying", traceback.format_exc())
-    try:
-      self.computeApproach()
-    except:
-      AVNLog.warn("exception in computeApproach %s, retrying", traceback.format_exc())
     if (not hasLeg):
       self.setInfo("leg", "no leg", WorkerStatus.INACTIVE)
-    if (not hasRMB):
-      self.setInfo("autopilot", "no autopilot data", WorkerStatus.INACTIVE)
     try:
       lat = self.navdata.getSingleValue(AVNStore.BASE_KEY_GPS+".lat")
       lon = self.navdata.getSingleValue(AVNStore.BASE_KEY_GPS+".lon")
@@ -449,24 +520,34 @@ class AVNRouter(AVNDirectoryHandlerBase):
       pass
     AVNLog.debug("router main loop")
 
-  def startStopAlarm(self,start,name=ALARMS.waypoint):
+  def startStopAlarm(self,start,name=ALARMS.waypoint,onlyIfInactive=False):
+    '''
+    start or stop an alarm
+    @param onlyIfInactive: only start the alarm if we did not already start it
+    @return: True if the alarm has been started
+    '''
     alert = self.findHandlerByName("AVNAlarmHandler")
     if alert is None:
-      return
-    try:
-      if start:
-        if self.activatedAlarms.get(name) is None:
-          AVNLog.info("starting alarm %s",name)
-        self.activatedAlarms[name]=True
-        alert.startAlarm(name)
-      else:
-        if self.activatedAlarms.get(name) is not None:
-          AVNLog.info("stopping alarm %s",name)
-          del self.activatedAlarms[name]
-        alert.stopAlarm(name,ownOnly=True)
-      self.setInfo('alarm',"%s alarm %s"%('set' if start else 'unset',name),WorkerStatus.NMEA)
-    except Exception as e:
-      self.setInfo('alarm','unable to handle alarm %s:%s'%(name,str(e)),WorkerStatus.ERROR)
+      return False
+    started=False
+    with self.__alarmLock:
+      try:
+        if start:
+          if self.activatedAlarms.get(name) is None:
+            AVNLog.info("starting alarm %s",name)
+          elif onlyIfInactive:
+            return False
+          self.activatedAlarms[name]=True
+          started=True
+          alert.startAlarm(name)
+        else:
+          if self.activatedAlarms.pop(name,None) is not None:
+            AVNLog.info("stopping alarm %s",name)
+          alert.stopAlarm(name,ownOnly=True)
+        self.setInfo('alarm',"%s alarm %s"%('set' if start else 'unset',name),WorkerStatus.NMEA)
+      except Exception as e:
+        self.setInfo('alarm','unable to handle alarm %s:%s'%(name,str(e)),WorkerStatus.ERROR)
+    return started
 
 
   def _inQuadrant(self,courseStart,course):
@@ -486,7 +567,7 @@ class AVNRouter(AVNDirectoryHandlerBase):
     return False
 
   #compute whether we are approaching the waypoint
-  def computeApproach(self):
+  def computeApproach(self,curGps=None):
     leg=self.getCurrentLeg()
     if leg is None:
       AVNLog.debug("currentLeg is None")
@@ -501,11 +582,11 @@ class AVNRouter(AVNDirectoryHandlerBase):
     if leg.isMob():
       AVNLog.debug("currentLeg MOB")
       self.startStopAlarm(False, self.ALARMS.waypoint)
-      if self.activatedAlarms.get(self.ALARMS.mob) is None:
-        self.startStopAlarm(True, self.ALARMS.mob)
+      self.startStopAlarm(True, self.ALARMS.mob,onlyIfInactive=True)
       return
     self.startStopAlarm(False,self.ALARMS.mob)
-    curGps=self.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS,1)
+    if curGps is None:
+      curGps=self.navdata.getSnapshot(AVNStore.BASE_KEY_GPS).data
     lat=curGps.get('lat')
     lon=curGps.get('lon')
     if lat is None or lon is None:
@@ -532,8 +613,7 @@ class AVNRouter(AVNDirectoryHandlerBase):
       self.lastDistanceToCurrent=None
       self.lastDistanceToNext=None
       return
-    if self.activatedAlarms.get(self.ALARMS.waypoint) is None:
-      self.startStopAlarm(True, self.ALARMS.waypoint)
+    if self.startStopAlarm(True, self.ALARMS.waypoint,onlyIfInactive=True) or self.approachStarted is None:
       self.approachStarted=time.time()
     #we have approach
     def setApproach(leg,x):
@@ -652,16 +732,29 @@ class AVNRouter(AVNDirectoryHandlerBase):
     if self.navdata is None:
       #called when uninitialized
       return None
-    curGps=self.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS,1)
+    return self.__getWpData(self.navdata.getSnapshot(AVNStore.BASE_KEY_GPS))
+
+  def __getWpData(self,snapshot) -> WpData:
+    '''
+    get the WpData for a gps snapshot
+    it is only recomputed if the gps data or the leg have changed
+    '''
+    useRhumbLine=self.P_RHUMBLINE.fromDict(self.param)
+    key=(snapshot.version,self.__legVersion,useRhumbLine)
+    cached=self.__wpData
+    if cached is not None and cached[0] == key:
+      return cached[1]
+    curGps=snapshot.data
     lat=curGps.get('lat')
     lon=curGps.get('lon')
     speed=curGps.get('speed')
     course=curGps.get('track')
-    wpData=WpData(self.getCurrentLeg(),lat,lon,speed or 0,course,useRhumLine=self.P_RHUMBLINE.fromDict(self.param))
+    wpData=WpData(self.getCurrentLeg(),lat,lon,speed or 0,course,useRhumLine=useRhumbLine)
+    self.__wpData=(key,wpData)
     return wpData
   #compute an RMB record and write this into the queue
   #if we have an active leg
-  def computeRMB(self,computeRMB,computeAPB):
+  def computeRMB(self,computeRMB,computeAPB,wpData=None):
     hasRMB=False
     #do the computation of some route data
     nmeaData="$GPRMB,A,,,,,,,,,,,,V,D*19\r\n"
@@ -673,7 +766,8 @@ class AVNRouter(AVNDirectoryHandlerBase):
         self.WpNr+=1
 
       if self.startWp is not None and self.endWp is not None:
-        wpData=self.getWpData()
+        if wpData is None:
+          wpData=self.getWpData()
 
         if wpData is not None and wpData.validData:
           AVNLog.debug("compute route data from %s to %s",str(self.startWp),str(self.endWp))
@@ -745,16 +839,18 @@ class AVNRouter(AVNDirectoryHandlerBase):
   def updateConfig(self, param, child=None):
     rt=super().updateConfig(param, child)
     self.navdata.updateChangeCounter(self.LEG_CHANGE_KEY)
+    self.__computedVersions=None
+    self.requestCompute()
     return rt
 
-  def computeAnchor(self):
-    curGps = self.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS,1)
+  def computeAnchor(self,curGps=None):
+    if curGps is None:
+      curGps = self.navdata.getSnapshot(AVNStore.BASE_KEY_GPS).data
     lat = curGps.get('lat')
     lon = curGps.get('lon')
     if lat is None or lon is None:
       self.startStopAlarm(False,self.ALARMS.anchor)
-      if self.activatedAlarms.get(self.ALARMS.gps) is None:
-        self.startStopAlarm(True,self.ALARMS.gps)
+      self.startStopAlarm(True,self.ALARMS.gps,onlyIfInactive=True)
       return
     self.startStopAlarm(False,self.ALARMS.gps)
     leg=self.getCurrentLeg()
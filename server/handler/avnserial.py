@@ -52,6 +52,8 @@ import avnav_handlerList
 
 class SerialReader(object):
   BAUDRATES=[921600,460800,230400,115200,57600,38400,19200,9600,4800]
+  #size of the receive buffer
+  RECEIVE_SIZE=16384
   P_XONOFF=WorkerParameter('xonxoff', False,type=WorkerParameter.T_BOOLEAN)
   P_RTSCTS=WorkerParameter('rtscts',False,type=WorkerParameter.T_BOOLEAN)
   P_FILTER=AVNWorker.FILTER_PARAM
@@ -206,9 +208,20 @@ class SerialReader(object):
         self.device=None
     return self.device
   
-  def readLine(self,serialDevice,timeout):
-    #if not os.name=='posix':
-    return serialDevice.readline(300)
+  def readData(self,serialDevice,framer):
+    '''
+    wait for data (up to the device timeout) and read
+    everything that is available into the framer
+    @return: the number of bytes read
+    '''
+    data=serialDevice.read(1)
+    if len(data) < 1:
+      return 0
+    waiting=min(serialDevice.in_waiting,framer.getFree()-1)
+    if waiting > 0:
+      data+=serialDevice.read(waiting)
+    framer.addData(data)
+    return len(data)
 
 
   #the run method - just try forever  
@@ -273,7 +286,7 @@ class SerialReader(object):
         numerrors = 0
         hasNMEA = False
         MAXLEN = 500
-        buffer = b''
+        framer = NMEALineFramer(self.RECEIVE_SIZE, MAXLEN)
         nmeaSum = MovingSum()
         def nmeaInfo():
           if nmeaSum.shouldUpdate():
@@ -283,17 +296,14 @@ class SerialReader(object):
         while not self.doStop:
           nmeaSum.add(0)
           nmeaInfo()
-          bytes = b''
+          lines = []
           try:
-            bytes = self.readLine(self.device, timeout)
-            if len(buffer) > 0:
-              bytes = buffer + bytes
-              buffer = ''
-            if len(bytes) > 0 and bytes.find(b"\n") < 0:
-              if len(bytes) < MAXLEN:
-                buffer = bytes
-                continue
-              raise Exception("no newline in serial data")
+            if self.readData(self.device, framer) > 0:
+              if not isOpen:
+                AVNLog.info("successfully opened %s", self.device.name)
+                isOpen = True
+              self.status = True
+              lines = framer.getLines()
           except Exception as e:
             AVNLog.debug("Exception %s in serial read, close and reopen %s", traceback.format_exc(), portname)
             try:
@@ -302,23 +312,16 @@ class SerialReader(object):
             except:
               pass
             break
-          if not bytes is None and len(bytes) > 0:
-            if not isOpen:
-              AVNLog.info("successfully opened %s", self.device.name)
-              isOpen = True
-            self.status = True
-            data = bytes.decode('ascii', 'ignore').translate(NMEAParser.STRIPCHARS)
+          records = []
+          tooManyErrors = False
+          for data in lines:
+            data = data.translate(NMEAParser.STRIPCHARS)
             if maxerrors > 0 or not hasNMEA:
               if not self.startpattern.match(data):
                 if maxerrors > 0:
                   numerrors += 1
                   if numerrors > maxerrors:
-                    # hmm - seems that we do not see any NMEA data
-                    AVNLog.debug("did not see any NMEA data for %d lines - close and reopen", maxerrors)
-                    try:
-                      self.device.close()
-                    except:
-                      pass
+                    tooManyErrors = True
                     break
                   continue
               else:
@@ -330,8 +333,18 @@ class SerialReader(object):
               lastTime = time.monotonic()
               if not NMEAParser.checkFilter(data, filter):
                 continue
-              nmeaSum.add(1)
-              self.queue.addNMEA(data, source=self.sourceName, sourcePriority=priority)
+              records.append(data)
+          if len(records) > 0:
+            nmeaSum.add(len(records))
+            self.queue.addNMEABatch(records, source=self.sourceName, sourcePriority=priority)
+          if tooManyErrors:
+            # hmm - seems that we do not see any NMEA data
+            AVNLog.debug("did not see any NMEA data for %d lines - close and reopen", maxerrors)
+            try:
+              self.device.close()
+            except:
+              pass
+            break
           if (time.monotonic() - lastTime) > porttimeout:
             self.infoHandler.setInfo(INAME,"timeout", WorkerStatus.ERROR)
             self.device.close()
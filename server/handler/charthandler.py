@@ -24,9 +24,12 @@
 #  parts from this software (AIS decoding) are taken from the gpsd project
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py
 ###############################################################################
+import collections
+import hashlib
 import io
 import json
 import shutil
+import threading
 import urllib.request, urllib.parse, urllib.error
 
 
@@ -74,6 +77,38 @@ class XmlChartFile(ChartFile):
     return "xml %s"%self.filename
 
 
+class TileCache(object):
+  '''
+  LRU cache for tile data shared by all charts
+  limited by the size of the cached data
+  '''
+  def __init__(self,maxBytes):
+    self.maxBytes=maxBytes
+    self.size=0
+    self.entries=collections.OrderedDict()
+    self.lock=threading.Lock()
+
+  def get(self,key):
+    with self.lock:
+      rt=self.entries.get(key)
+      if rt is not None:
+        self.entries.move_to_end(key)
+      return rt
+
+  def add(self,key,data):
+    if len(data) > self.maxBytes:
+      return
+    with self.lock:
+      existing=self.entries.pop(key,None)
+      if existing is not None:
+        self.size-=len(existing)
+      self.entries[key]=data
+      self.size+=len(data)
+      while self.size > self.maxBytes:
+        k,v=self.entries.popitem(last=False)
+        self.size-=len(v)
+
+
 class ChartDescription(AVNDirectoryListEntry):
     INT_PREFIX = "int"  # prefix for mbtiles,gemf
     OVL_EXT = ".cfg"
@@ -276,6 +311,7 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
     self.externalProviders={}
     self.importer=None
     AVNDirectoryHandlerBase.__init__(self, param,'chart')
+    self.tileCache=TileCache(self.getFloatParam('tileCache')*1024*1024)
   @classmethod
   def getConfigName(cls):
     return "AVNChartHandler"
@@ -285,7 +321,8 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
       return None
     return {
             'period': 5, #how long to sleep between 2 checks
-            'upzoom': 2 #zoom up in charts
+            'upzoom': 2, #zoom up in charts
+            'tileCache': 32 #size of the tile cache in MB
     }
 
 
@@ -499,11 +536,21 @@ class AVNChartHandler(AVNDirectoryHandlerBase):
       return True
     if len(parts) != 5:
       raise Exception("invalid request to chart file %s: %s" %(chartDescription.name,path))
-    data=chartDescription.getChart().getTileData((int(parts[2]),int(parts[3]),int(parts[4].replace(".png",""))),parts[1])
-    if data is None:
-      handler.send_error(404,"File %s not found"%(path))
+    tile=(int(parts[2]),int(parts[3]),int(parts[4].replace(".png","")))
+    chart=chartDescription.getChart()
+    #the chart file time and the change count identify the chart content
+    key=(chartDescription.name,chartDescription.time,chart.getChangeCount(),parts[1])+tile
+    etag='"%s"'%hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+    if handler.checkNotModified(etag):
       return True
-    handler.writeData(data, "image/png", )
+    data=self.tileCache.get(key)
+    if data is None:
+      data=chart.getTileData(tile,parts[1])
+      if data is None:
+        handler.send_error(404,"File %s not found"%(path))
+        return True
+      self.tileCache.add(key,data)
+    handler.writeData(data, "image/png", etag=etag, lastModified=chartDescription.time)
     return True
 
   def getChartDescriptionByKey(self, chartKey, requestIp="localhost"):
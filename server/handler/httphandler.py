@@ -1,3 +1,5 @@
+import collections
+import gzip
 import http.server
 import io
 import cgi
@@ -6,6 +8,7 @@ import os
 import posixpath
 import re
 import threading
+import time
 import traceback
 import urllib.request, urllib.parse, urllib.error
 import urllib.parse
@@ -46,9 +49,68 @@ class Encoder(json.JSONEncoder):
     return super(Encoder, self).default(o)
 
 
+class NavResponse(object):
+  '''
+  an already encoded json response
+  that can be sent to multiple clients
+  '''
+  #do not compress smaller responses
+  MIN_GZIP=512
+  def __init__(self,rtj):
+    self.rtj=rtj
+    self.data=rtj.encode('utf-8')
+    self.created=time.monotonic()
+    self.__gzipped=None
+
+  def getGzipped(self):
+    '''
+    get the gzipped data, None if the response is too small
+    '''
+    if len(self.data) < self.MIN_GZIP:
+      return None
+    if self.__gzipped is None:
+      self.__gzipped=gzip.compress(self.data,compresslevel=5)
+    return self.__gzipped
+
+
+class NavResponseCache(object):
+  '''
+  cache for encoded responses of the frequently polled requests
+  the key must contain the store versions the response depends on
+  '''
+  def __init__(self,maxEntries=20):
+    self.maxEntries=maxEntries
+    self.entries=collections.OrderedDict()
+    self.lock=threading.Lock()
+
+  def get(self,key,creator,maxAge=None):
+    '''
+    get a cached response or create it
+    @param key: the cache key (a tuple)
+    @param creator: a function returning the json string
+    @param maxAge: if set, entries older than this (in seconds) will be recreated
+    @return: a NavResponse
+    '''
+    with self.lock:
+      rt=self.entries.get(key)
+      if rt is not None:
+        if maxAge is None or (time.monotonic()-rt.created) < maxAge:
+          self.entries.move_to_end(key)
+          return rt
+    rt=NavResponse(creator())
+    with self.lock:
+      self.entries[key]=rt
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxEntries:
+        self.entries.popitem(last=False)
+    return rt
+
+
 class AVNHTTPHandler(HTTPWebSocketsHandler):
   wsHandler: WebSocketHandler
   protocol_version = "HTTP/1.1" #necessary for websockets!
+  #max age (seconds) of a cached AIS response
+  AIS_RESPONSE_AGE=1
   def __init__(self,request,client_address,server):
     #allow write buffering
     #see https://lautaportti.wordpress.com/2011/04/01/basehttprequesthandler-wastes-tcp-packets/
@@ -228,16 +290,36 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
       return self.server.plainUrlToPath(path)
 
 
+  def acceptsGzip(self):
+    accept=self.headers.get('Accept-Encoding')
+    if accept is None:
+      return False
+    return 'gzip' in accept
+
   #send a json encoded response
+  #rtj can be a string or a NavResponse
   def sendNavResponse(self,rtj,requestParam=None):
     if not rtj is None:
       self.send_response(200)
+      wbytes=None
       if requestParam is not None and not requestParam.get('callback') is None:
+        if isinstance(rtj,NavResponse):
+          rtj=rtj.rtj
         rtj="%s(%s);"%(requestParam.get('callback'),rtj)
         self.send_header("Content-type", "text/javascript")
       else:
         self.send_header("Content-type", "application/json")
-      wbytes=rtj.encode('utf-8')
+      if isinstance(rtj,NavResponse):
+        wbytes=rtj.data
+        if self.acceptsGzip():
+          zbytes=rtj.getGzipped()
+          if zbytes is not None:
+            wbytes=zbytes
+            self.send_header("Content-Encoding","gzip")
+        self.send_header("Vary","Accept-Encoding")
+        rtj=rtj.rtj
+      else:
+        wbytes=rtj.encode('utf-8')
       self.send_header("Content-Length", str(len(wbytes)))
       self.send_header("Last-Modified", self.date_time_string())
       self.send_header("Cache-Control", "no-store")
@@ -362,7 +444,6 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
   #return AIS targets
   #parameter: lat,lon,distance (in NM) - limit to this distance
   def handleAISRequest(self,requestParam):
-    rt=self.server.navdata.getAisData()
     lat=None
     lon=None
     lat1=None
@@ -380,69 +461,56 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
         lon1=float(rq)
     except:
       pass
-    frt=[]
-    if not lat is None and not lon is None and not dist is None:
-      dest=(lat,lon)
-      AVNLog.debug("limiting AIS to lat=%f,lon=%f,dist=%f",lat,lon,dist)
-      dest1=None
-      if lat1 is not None and lon1 is not None:
-        dest1=(lat1,lon1)
-        AVNLog.debug("additional AIS range lat=%f,lon=%f,dist=%f",lat1,lon1,dist)
-      for entry in rt:
-        try:
-          fentry=entry
-          mdist=AVNUtil.distance((fentry.get('lat'),fentry.get('lon')), dest)
-          inRange=False
-          if mdist<=dist:
-            inRange=True
-          else:
-            if dest1 is not None:
-              mdist=AVNUtil.distance((fentry.get('lat'),fentry.get('lon')), dest1)
-              if mdist<=dist:
-                inRange=True
-          if inRange:
-            fentry['distance']=mdist*AVNUtil.NM #have this in m
-            frt.append(fentry)
-          else:
-            AVNLog.debug("filtering out %s due to distance %f",str(fentry['mmsi']),mdist)
-        except:
-          AVNLog.debug("unable to convert ais data: %s",traceback.format_exc())
-    else:
-      for entry in rt:
-        try:
-          frt.append(entry)
-        except Exception as e:
-          AVNLog.debug("unable to convert ais data: %s",traceback.format_exc())
-    return json.dumps(frt,cls=Encoder)
+    def create():
+      if not lat is None and not lon is None and not dist is None:
+        centers=[(lat,lon)]
+        AVNLog.debug("limiting AIS to lat=%f,lon=%f,dist=%f",lat,lon,dist)
+        if lat1 is not None and lon1 is not None:
+          centers.append((lat1,lon1))
+          AVNLog.debug("additional AIS range lat=%f,lon=%f,dist=%f",lat1,lon1,dist)
+        frt=self.server.navdata.getAisDataByDistance(centers,dist)
+      else:
+        frt=self.server.navdata.getAisData()
+      return json.dumps(frt,cls=Encoder)
+    #the AIS version changes with every AIS message and the age of the targets
+    #changes even without new data - so clients share a response for AIS_RESPONSE_AGE
+    return self.server.navResponseCache.get(('ais',lat,lon,dist,lat1,lon1),
+                                            create,maxAge=self.AIS_RESPONSE_AGE)
 
   def handleGpsRequest(self,requestParam):
-    rtv=self.server.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS)
-    return json.dumps(rtv,cls=Encoder)
+    snapshot=self.server.navdata.getSnapshot(AVNStore.BASE_KEY_GPS)
+    return self.server.navResponseCache.get(('gps',snapshot.version),
+                                            lambda: json.dumps(snapshot.data,cls=Encoder))
 
   def handleNmeaStatus(self, requestParam):
-    rtv = self.server.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS)
-    # we depend the status on the mode: no mode - red (i.e. not connected), mode: 1- yellow, mode 2+lat+lon - green
-    status = "red"
-    if rtv.get("lat") is not None and rtv.get('lon') is not None:
-      status = "green"
-    info = self.server.navdata.getSingleValue(AVNStore.BASE_KEY_GPS + ".lat",includeInfo=True)  # we just want the last source of position
+    navdata=self.server.navdata
+    rtv=navdata.getSnapshot(AVNStore.BASE_KEY_GPS).data
+    info = navdata.getSingleValue(AVNStore.BASE_KEY_GPS + ".lat",includeInfo=True)  # we just want the last source of position
     src='unknown'
     if info is not None:
       src=info.source
-    satInview = rtv.get('satInview')
+    #the key contains only what is reported - the store versions change with every message
+    key=('nmeaStatus',
+         rtv.get("lat") is not None and rtv.get('lon') is not None,
+         rtv.get('satInview'),rtv.get('satUsed'),src,
+         navdata.getAisCounter(),navdata.getLastAisSource())
+    return self.server.navResponseCache.get(key,lambda: self.createNmeaStatus(*key[1:]))
+
+  def createNmeaStatus(self, hasPosition, satInview, satUsed, src, numAis, aisSrc):
+    # we depend the status on the mode: no mode - red (i.e. not connected), mode: 1- yellow, mode 2+lat+lon - green
+    status = "red"
+    if hasPosition:
+      status = "green"
     if satInview is None:
       satInview=0
-    satUsed   = rtv.get('satUsed')
     if satUsed is None:
       satUsed=0
     statusNmea = {"status": status, "source": src, "info": "Sat %d visible/%d used" % (int(satInview), int(satUsed))}
 
     status = "red"
-    numAis = self.server.navdata.getAisCounter()
     if numAis > 0:
       status = "green"
-    src = self.server.navdata.getLastAisSource()
-    statusAis = {"status": status, "source": src, "info": "%d targets" % (numAis)}
+    statusAis = {"status": status, "source": aisSrc, "info": "%d targets" % (numAis)}
     rt = {"status": "OK","data":{"nmea": statusNmea, "ais": statusAis}}
     return json.dumps(rt,cls=Encoder)
 
@@ -516,7 +584,12 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
       self.wfile.write(buf)
       self.wfile.write(b'\r\n')
 
-  def writeData(self,data,mimeType):
+  def writeData(self,data,mimeType,etag=None,lastModified=None):
+    '''
+    write data as response
+    @param etag: if set, send an ETag and let the client revalidate (see checkNotModified)
+    @param lastModified: timestamp, defaults to now
+    '''
     self.send_response(200)
     self.send_header("Content-type", mimeType)
     wbytes=None
@@ -525,10 +598,34 @@ class AVNHTTPHandler(HTTPWebSocketsHandler):
     else:
       wbytes=data.encode('utf-8')
     self.send_header("Content-Length", str(len(wbytes)))
-    self.send_header("Last-Modified", self.date_time_string())
+    self.send_header("Last-Modified", self.date_time_string(lastModified))
+    if etag is not None:
+      self.send_header("ETag",etag)
+      self.send_header("Cache-Control","no-cache")
     self.end_headers()
     self.wfile.write(wbytes)
 
+  def checkNotModified(self,etag):
+    '''
+    check If-None-Match of the request against etag
+    and send a 304 response if it matches
+    @return: True if the 304 response has been sent
+    '''
+    inm=self.headers.get('If-None-Match')
+    if inm is None:
+      return False
+    for tag in inm.split(','):
+      tag=tag.strip()
+      if tag.startswith('W/'):
+        tag=tag[2:]
+      if tag == etag or tag == '*':
+        self.send_response(304)
+        self.send_header("ETag",etag)
+        self.send_header("Cache-Control","no-cache")
+        self.end_headers()
+        return True
+    return False
+
   def writeFromDownload(self,download: AVNDownload,filename:str=None,noattach:bool=False):
     self.send_response(200)
     size = download.getSize()
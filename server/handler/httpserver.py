@@ -34,7 +34,7 @@ from typing import Dict, Any
 
 import gemf_reader
 
-from httphandler import AVNHTTPHandler, WebSocketHandler
+from httphandler import AVNHTTPHandler, WebSocketHandler, NavResponseCache
 
 try:
   import create_overview
@@ -134,6 +134,7 @@ class AVNHttpServer(socketserver.ThreadingMixIn,http.server.HTTPServer, AVNWorke
     self.externalHandlers={} #prefixes that will be handled externally
     self.webSocketHandlers={}
     self.requestHandler=RequestHandlerClass
+    self.navResponseCache=NavResponseCache()
   
   def run(self):
     self.freeAllUsedResources()
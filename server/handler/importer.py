@@ -23,6 +23,7 @@
 #
 ###############################################################################
 import hashlib
+import heapq
 import json
 import shutil
 
@@ -68,18 +69,28 @@ class ExternalConverter(ConverterApi):
       return self._converter.allowSubDir()
     return super().allowSubDir()
 
+  def getMaxParallel(self):
+    if hasattr(self._converter,'getMaxParallel'):
+      return self._converter.getMaxParallel()
+    return super().getMaxParallel()
+
 
 class InternalConverter(ConverterApi):
+  #max number of files in the fingerprint cache
+  MAX_FINGERPRINTS=10000
   def __init__(self,knownExtensions:list,chartDir:str):
     self._extensions=list(map(lambda x: "."+x.upper(),knownExtensions))
     self._logger=AVNLog
     self._chartdir=chartDir
+    #filename -> (mtime,size,count,md5 input)
+    self._fingerprints={}
   def _canHandle(self,fn):
     (name,ext)=os.path.splitext(fn)
     return ext.upper() in self._extensions
-  def _addMd5(self,md5,fn):
+  def _addMd5(self,md5,fn,st=None):
     md5.update(fn.encode(errors='ignore'))
-    st=os.stat(fn.encode(errors='ignore'))
+    if st is None:
+      st=os.stat(fn.encode(errors='ignore'))
     md5.update(str(st.st_mtime).encode(errors='ignore'))
     md5.update(str(st.st_size).encode(errors='ignore'))
   def _handleZipFile(self,md5,fn):
@@ -99,12 +110,33 @@ class InternalConverter(ConverterApi):
     except Exception as e:
       self._logger.error("unable to handle zipfile %s:%s"%(fn,traceback.format_exc()))
       return 0
+  class _Md5Input:
+    '''
+    collect the input for an md5 to be cached
+    '''
+    def __init__(self):
+      self.data=[]
+    def update(self,data):
+      self.data.append(data)
   def _handleFile(self,md5,fn):
     if self._canHandle(fn):
+      st=os.stat(fn.encode(errors='ignore'))
+      cached=self._fingerprints.get(fn)
+      if cached is not None and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        md5.update(cached[3])
+        return cached[2]
+      fileMd5=self._Md5Input()
       if fn.upper().endswith('.ZIP'):
-        return self._handleZipFile(md5,fn)
-      self._addMd5(md5,fn)
-      return 1
+        rt=self._handleZipFile(fileMd5,fn)
+      else:
+        self._addMd5(fileMd5,fn,st)
+        rt=1
+      data=b''.join(fileMd5.data)
+      if len(self._fingerprints) >= self.MAX_FINGERPRINTS:
+        self._fingerprints.clear()
+      self._fingerprints[fn]=(st.st_mtime,st.st_size,rt,data)
+      md5.update(data)
+      return rt
     return 0
   def _handleDir(self,md5,dir):
     rt=0
@@ -141,14 +173,20 @@ class InternalConverter(ConverterApi):
 
 class GdalConverter(InternalConverter):
   EXTENSIONS=['kap','map','geo','eap']
-  def __init__(self, converterPath:str,chartDir:str,workDir:str):
+  def __init__(self, converterPath:str,chartDir:str,workDir:str,getProcesses=None):
+    '''
+    @param getProcesses: function returning the number of processes for one conversion
+    '''
     super().__init__(self.EXTENSIONS,chartDir)
     self._converter=converterPath
     self._workdir=workDir
+    self._getProcesses=getProcesses
 
   def getConverterCommand(self, input, outname):
+    #read_charts defaults to all cpus - keep background conversions small
+    processes=self._getProcesses() if self._getProcesses is not None else 1
     return [sys.executable,self._converter,"-o",self.getOutFileOrDir(outname),
-            "-b",os.path.join(self._workdir,outname),"-g","-t","1",input]
+            "-b",os.path.join(self._workdir,outname),"-g","-t","1","-j",str(processes),input]
 
   def getName(self):
     return 'builtin-gdal'
@@ -157,8 +195,8 @@ class GdalConverter(InternalConverter):
     return True
 
 class GdalZipConverter(GdalConverter):
-  def __init__(self, converterPath: str, chartDir: str, workDir: str):
-    super().__init__(converterPath, chartDir, workDir)
+  def __init__(self, converterPath: str, chartDir: str, workDir: str,getProcesses=None):
+    super().__init__(converterPath, chartDir, workDir,getProcesses)
 
   def getName(self):
     return 'builtin-gdal-zip'
@@ -237,6 +275,7 @@ class ConversionCandidate:
     self.timestamp=time.monotonic()
     self.result=ConversionResult(None)
     self.running=False
+    self.runningSince=None
   def isDir(self):
     return os.path.isdir(self.realName)
   def update(self,other):
@@ -248,6 +287,7 @@ class ConversionCandidate:
     self.timestamp=other.timestamp
     self.result=other.result
     self.running=other.running
+    self.runningSince=other.runningSince
   def md5changed(self):
     return self.currentmd5 != self.result.md5
   def hasChanged(self,other):
@@ -299,6 +339,8 @@ class ConversionCandidate:
     if st is None:
       st=self.getState()
     if st == self.State.CONVERTING:
+      if self.runningSince is not None:
+        return "converting %d files since %ds"%(self.score,time.monotonic()-self.runningSince)
       return "converting %d files"%self.score
     if st == self.State.DONENC:
       return "no converter yet but converted at %s"%self.result.dateStr()
@@ -321,6 +363,15 @@ class ConversionCandidate:
     if self.converter is None:
       return 'NONE'
     return self.converter.getName()
+  def getMaxParallel(self):
+    if self.converter is None:
+      return 0
+    return self.converter.getMaxParallel()
+  def getPriority(self):
+    '''
+    sort key for waiting conversions: smaller imports first, then in order of detection
+    '''
+    return (self.score,self.timestamp,self.name)
 
 class Conversion:
   def __init__(self,process,candidate:ConversionCandidate):
@@ -356,6 +407,12 @@ class AVNImporter(AVNWorker):
                              description='time to wait in seconds before a conversion is started after detecting a change of a directory (settle time)')
   P_SCANINTERVAL=WorkerParameter('scanInterval', 0, type=WorkerParameter.T_NUMBER,
                              description='seconds between import dir scan, 0 to disable automatic scan')
+  P_MAXCONVERSIONS=WorkerParameter('maxConversions', 1, type=WorkerParameter.T_NUMBER,
+                             description='max number of conversions running in parallel',
+                             rangeOrList=[1,64])
+  P_PROCESSES=WorkerParameter('converterProcesses', 1, type=WorkerParameter.T_NUMBER,
+                             description='number of processes used by one chart conversion (gdal)',
+                             rangeOrList=[1,64])
   @classmethod
   def getConfigName(cls):
     return "AVNImporter"
@@ -370,7 +427,9 @@ class AVNImporter(AVNWorker):
       cls.P_WORKDIR,    #working directory
       cls.P_WAITTIME,
       cls.P_FWAITTIME,
-      cls.P_SCANINTERVAL
+      cls.P_SCANINTERVAL,
+      cls.P_MAXCONVERSIONS,
+      cls.P_PROCESSES
     ]
     return rt
 
@@ -397,7 +456,7 @@ class AVNImporter(AVNWorker):
     self.importDir=None
     self.lastTimeStamps={}    #a dictionary of timestamps - key is the directory/filename, value the last read timestamp
     self.candidateTimes={}    #dictionary with candidates for conversion - same layout as lastTimeStamps
-    self.runningConversion=None # type: Conversion
+    self.runningConversions={} # type: dict[str,Conversion]
     self.chartbase=None
     self.importDir=AVNHandlerManager.getDirWithDefault(self.param, self.P_IMPORTDIR.name, 'import')
     self.workDir=AVNHandlerManager.getDirWithDefault(self.param, self.P_WORKDIR.name, 'work')
@@ -425,8 +484,9 @@ class AVNImporter(AVNWorker):
     if self.chartbase is None or not os.path.isdir(self.chartbase):
       AVNLog.error("chartbase directory not found, stopping converter")
       return
-    self.converters.append(GdalConverter(os.path.join(self.converterDir,"read_charts.py"),self.chartbase,self.workDir))
-    self.converters.append(GdalZipConverter(os.path.join(self.converterDir,"read_charts.py"),self.chartbase,self.workDir))
+    getProcesses=lambda: self.getWParam(self.P_PROCESSES)
+    self.converters.append(GdalConverter(os.path.join(self.converterDir,"read_charts.py"),self.chartbase,self.workDir,getProcesses))
+    self.converters.append(GdalZipConverter(os.path.join(self.converterDir,"read_charts.py"),self.chartbase,self.workDir,getProcesses))
     self.converters.append(MbtilesConverter(os.path.join(self.converterDir,"convert_mbtiles.py"),self.chartbase))
     self.converters.append(NavipackConverter(os.path.join(self.converterDir,"convert_navipack.py"),self.chartbase))
     if not os.path.isdir(self.importDir):
@@ -468,56 +528,51 @@ class AVNImporter(AVNWorker):
       fwaittime=self.getWParam(self.P_FWAITTIME)
       AVNLog.debug("mainloop")
       currentCandidates=self.readImportDir()
+      running=self.runningConversions
+      for k in currentCandidates:
+        conversion=running.get(k.name)
+        if conversion is not None:
+          k.running=True
+          k.runningSince=conversion.timestamp
       self.candidates=currentCandidates
       foundNames=set()
-      if self.runningConversion is None:
-        self.setInfo(self.INFO_MAIN,"scanning",WorkerStatus.NMEA)
-        now=time.monotonic()
-        for k in currentCandidates:
-          foundNames.add(k.name)
-          if not k.couldConvert():
-            try:
-              del waitingCandidates[k.name]
-            except:
-              pass
-            continue
-          existing=waitingCandidates.get(k.name)
-          startConversion=False
-          if existing is not None:
-            if existing.hasChanged(k):
-              waitingCandidates[k.name]=k
-            else:
-              wt=waittime if k.isDir() else fwaittime
-              if (existing.timestamp+wt) < now:
-                startConversion=True
-                waitingCandidates[k.name]=k
-          else:
+      readyCandidates=[]
+      self.setInfo(self.INFO_MAIN,"scanning",WorkerStatus.NMEA)
+      now=time.monotonic()
+      for k in currentCandidates:
+        foundNames.add(k.name)
+        if k.running or not k.couldConvert():
+          try:
+            del waitingCandidates[k.name]
+          except:
+            pass
+          continue
+        existing=waitingCandidates.get(k.name)
+        if existing is not None:
+          if existing.hasChanged(k):
             waitingCandidates[k.name]=k
-          if not startConversion:
-            continue
-          rs=self.startConversion(k)
-          if not rs:
-            try:
-              del waitingCandidates[k.name]
-            except:
-              pass
           else:
-            break
-        #remove any waiting entries that are not there any more
-        candidateKeys=list(waitingCandidates.keys())
-        for ckey in candidateKeys:
-          if not ckey in foundNames:
-            try:
-              del waitingCandidates[ckey]
-            except:
-              pass
-      else:
-        AVNLog.debug("conversion(s) running, skip check")
-        for k in currentCandidates:
-          if k.name == self.runningConversion.candidate.name:
-            k.running=True
-      candidate=self.checkConversionFinished()
-      if candidate is not None:
+            wt=waittime if k.isDir() else fwaittime
+            if (existing.timestamp+wt) < now:
+              readyCandidates.append(k)
+        else:
+          waitingCandidates[k.name]=k
+      #remove any waiting entries that are not there any more
+      candidateKeys=list(waitingCandidates.keys())
+      for ckey in candidateKeys:
+        if not ckey in foundNames:
+          try:
+            del waitingCandidates[ckey]
+          except:
+            pass
+      started=self.startConversions(readyCandidates)
+      for k in started:
+        try:
+          del waitingCandidates[k.name]
+        except:
+          pass
+      finished=self.checkConversionsFinished()
+      for candidate in finished:
         try:
           del waitingCandidates[candidate.name]
         except:
@@ -526,10 +581,11 @@ class AVNImporter(AVNWorker):
           if ac.name == candidate.name:
             ac.update(candidate)
       self._syncInfo(self.candidates)
-      if candidate is not None:
+      self._syncConverterInfo(len(readyCandidates)-len(started))
+      if len(finished) > 0:
         #immediately scan again as we could start the next
         continue
-      if self.runningConversion is not None or len(waitingCandidates.keys())> 0:
+      if len(self.runningConversions) > 0 or len(waitingCandidates.keys())> 0:
         self.setInfo(self.INFO_MAIN,"scanning",WorkerStatus.NMEA)
         self.wait(min(waittime,fwaittime)/5)
       else:
@@ -538,8 +594,18 @@ class AVNImporter(AVNWorker):
           idlewait=24*3600 #1day
         self.setInfo(self.INFO_MAIN,"pausing for %d seconds"%idlewait,WorkerStatus.STARTED)
         self.wait(idlewait)
-    if self.runningConversion is not None:
-      self.runningConversion.stop()
+    self.stopConversion()
+
+  def _syncConverterInfo(self,numQueued):
+    running=sorted(self.runningConversions.values(),key=lambda c: c.timestamp)
+    if len(running) < 1:
+      return
+    now=time.monotonic()
+    info="running %d/%d: %s"%(len(running),self.getWParam(self.P_MAXCONVERSIONS),
+                             ", ".join(["%s (%ds)"%(c.candidate.name,now-c.timestamp) for c in running]))
+    if numQueued > 0:
+      info+=", %d queued"%numQueued
+    self.setInfo(self.INFO_CONVERTER,info,WorkerStatus.NMEA)
 
   def allExtensions(self,fullInfo=False):
     extensions=[]
@@ -649,9 +715,34 @@ class AVNImporter(AVNWorker):
     return rt
 
 
+  def startConversions(self,candidates):
+    '''
+    start conversions for ready candidates in the order of their priority
+    as long as the overall and the converter specific limits allow
+    @param candidates: the candidates that are ready for conversion
+    @return: the list of candidates that have been handled (started or failed to start)
+    '''
+    rt=[]
+    maxConversions=self.getWParam(self.P_MAXCONVERSIONS)
+    queue=[(c.getPriority(),c) for c in candidates]
+    heapq.heapify(queue)
+    while len(queue) > 0 and len(self.runningConversions) < maxConversions:
+      prio,candidate=heapq.heappop(queue)
+      maxParallel=candidate.getMaxParallel()
+      if maxParallel is not None and maxParallel > 0:
+        converterName=candidate.getConverterName()
+        numRunning=0
+        for conversion in self.runningConversions.values():
+          if conversion.candidate.getConverterName() == converterName:
+            numRunning+=1
+        if numRunning >= maxParallel:
+          continue
+      self.startConversion(candidate)
+      rt.append(candidate)
+    return rt
+
   def startConversion(self,candidate:ConversionCandidate):
     AVNLog.info("starting conversion for %s",candidate.name)
-    now=time.time()
     self.setInfo(self.INFO_CONVERTER,"running for %s"%(candidate.name),WorkerStatus.NMEA)
     cmd=candidate.converter.getConverterCommand(candidate.getFileOrDir(),candidate.name)
     po=self.runConverter(candidate.name,cmd)
@@ -659,41 +750,57 @@ class AVNImporter(AVNWorker):
       AVNLog.error("unable to start conversion for %s - don't know how to handle it",candidate.name)
       self.setInfo(self.INFO_CONVERTER,"start for %s failed - don't know how to handle"%(candidate.name,),WorkerStatus.ERROR)
       return False
+    conversion=Conversion(po,candidate)
     candidate.running=True
-    self.runningConversion=Conversion(po,candidate)
+    candidate.runningSince=conversion.timestamp
+    #copy on write as the api reads this without locking
+    self.runningConversions={**self.runningConversions,candidate.name:conversion}
+    return True
 
-  def checkConversionFinished(self):
-    if self.runningConversion is None:
-      return
-    if not self.runningConversion.running:
-      self.setInfo(self.INFO_CONVERTER,"killed for %s"%(self.runningConversion.candidate.name),WorkerStatus.ERROR)
-      candidate=self.runningConversion.candidate
-      self.runningConversion=None
+  def checkConversionsFinished(self):
+    '''
+    check all running conversions
+    @return: the list of candidates with finished conversions
+    '''
+    rt=[]
+    for conversion in list(self.runningConversions.values()):
+      candidate=self.checkConversionFinished(conversion)
+      if candidate is not None:
+        remaining=self.runningConversions.copy()
+        remaining.pop(candidate.name,None)
+        self.runningConversions=remaining
+        rt.append(candidate)
+    return rt
+
+  def checkConversionFinished(self,conversion:Conversion):
+    if not conversion.running:
+      self.setInfo(self.INFO_CONVERTER,"killed for %s"%(conversion.candidate.name),WorkerStatus.ERROR)
+      candidate=conversion.candidate
+      candidate.running=False
       self.saveLastResult(candidate.name, ConversionResult(None,"killed"))
       return candidate
-    rtc=self.runningConversion.process.poll()
+    rtc=conversion.process.poll()
     if rtc is None:
-      AVNLog.debug("converter for %s still running",self.runningConversion.candidate.name)
+      AVNLog.debug("converter for %s still running",conversion.candidate.name)
       return
     else:
-      AVNLog.info("finished conversion for %s with return code %d",self.runningConversion.candidate.name,rtc)
-      result=ConversionResult(self.runningConversion.candidate.currentmd5)
+      AVNLog.info("finished conversion for %s with return code %d",conversion.candidate.name,rtc)
+      result=ConversionResult(conversion.candidate.currentmd5)
       if rtc == 0:
-        outname=self.runningConversion.candidate.getOutName()
+        outname=conversion.candidate.getOutName()
         if not os.path.exists(outname):
           result.error="%s not created"%(outname)
           rtc=1
       else:
         result.error="failed with status %d"%rtc
       if rtc == 0:
-          self.setInfo(self.INFO_CONVERTER,"successful for %s"%(self.runningConversion.candidate.name),WorkerStatus.STARTED)
+          self.setInfo(self.INFO_CONVERTER,"successful for %s"%(conversion.candidate.name),WorkerStatus.STARTED)
       else:
-          self.setInfo(self.INFO_CONVERTER,"failed for %s"%(self.runningConversion.candidate.name),WorkerStatus.ERROR)
-      candidate=self.runningConversion.candidate
+          self.setInfo(self.INFO_CONVERTER,"failed for %s"%(conversion.candidate.name),WorkerStatus.ERROR)
+      candidate=conversion.candidate
       candidate.result=result
       candidate.running=False
       self.saveLastResult(candidate.name, result)
-      self.runningConversion=None # type: Conversion
       return candidate
 
   #delete an import dir/file
@@ -705,9 +812,19 @@ class AVNImporter(AVNWorker):
     if candidate is not None:
       self.deleteImportByCandidate(candidate)
   def stopConversion(self,name=None):
-    running=self.runningConversion
-    if running is not None and (name is None or running.candidate.name == name) and running.running:
-      running.stop()
+    for running in list(self.runningConversions.values()):
+      if (name is None or running.candidate.name == name) and running.running:
+        running.stop()
+
+  def getCurrentConversion(self):
+    '''
+    get the last started conversion that is still running
+    '''
+    rt=None
+    for running in list(self.runningConversions.values()):
+      if running.running and (rt is None or running.timestamp > rt.timestamp):
+        rt=running
+    return rt
 
   def deleteImportByCandidate(self,candidate):
     try:
@@ -914,9 +1031,9 @@ class AVNImporter(AVNWorker):
         candidate=None
         rt=None
         if name == '_current':
-          running=self.runningConversion
-          if running is not None and running.running:
-            candidate=self.runningConversion.candidate
+          running=self.getCurrentConversion()
+          if running is not None:
+            candidate=running.candidate
           if candidate is None:
             rt=AVNDownloadError("no conversion running")
         else:
@@ -934,13 +1051,18 @@ class AVNImporter(AVNWorker):
         handler.writeFromDownload(rt)
         return None
       if command == 'cancel':
-        running=self.runningConversion
-        if running is None or not running.running:
+        if self.getCurrentConversion() is None:
           return AVNUtil.getReturnData(error="no conversion running")
         name=AVNUtil.getHttpRequestParam(requestparam,"name",False)
-        if name is not None and name != (ConversionCandidate.KPRFX+running.candidate.name):
-          return AVNUtil.getReturnData(error="%s not running any more"%name)
-        self.stopConversion(running.candidate.name)
+        if name is not None:
+          #cancel a single conversion, otherwise all
+          candidate=self.findCandidate(name)
+          running=self.runningConversions.get(candidate.name) if candidate is not None else None
+          if running is None or not running.running:
+            return AVNUtil.getReturnData(error="%s not running any more"%name)
+          self.stopConversion(candidate.name)
+        else:
+          self.stopConversion()
         self.wakeUp()
         return AVNUtil.getReturnData()
       if command == 'restart':
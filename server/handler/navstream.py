@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+# vim: ts=2 sw=2 et ai
+###############################################################################
+# Copyright (c) 2012,2021 Andreas Vogel andreas@wellenvogel.net
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+#  parts from this software (AIS decoding) are taken from the gpsd project
+#  so refer to this BSD licencse also (see ais.py) or omit ais.py
+###############################################################################
+import json
+import threading
+import time
+import traceback
+
+import avnav_handlerList
+from avnav_store import AVNStore
+from avnav_util import AVNLog, AVNUtil
+from avnav_worker import AVNWorker, WorkerParameter, WorkerStatus
+from httphandler import WebSocketHandler, Encoder
+
+
+class NavStreamConnection(WebSocketHandler):
+  '''
+  a websocket client subscribed to the navigation data
+  the first message is a snapshot of gps and ais data:
+    {"type":"snapshot","gps":{...},"ais":[...]}
+  afterwards only changes are sent:
+    {"type":"delta","gps":{"changed":{...},"removed":[...]},
+                    "ais":{"changed":[...],"removed":[mmsi,...]}}
+  changed ais targets are always sent completely,
+  the age of unchanged targets has to be computed by the client
+  the client can change the subscription by sending
+    {"interval":2,"bbox":[minLat,minLon,maxLat,maxLon],"gps":true,"ais":true}
+  '''
+  def __init__(self,handler,stream,interval=1,bbox=None,gps=True,ais=True):
+    super().__init__(handler)
+    self.stream=stream
+    self.lock=threading.Lock()
+    self.interval=interval
+    self.bbox=bbox
+    self.gps=gps
+    self.ais=ais
+    self.nextSend=0
+    #the state the client has received
+    self.gpsData=None
+    self.gpsVersion=None
+    self.aisTargets=None
+    self.aisVersion=None
+    self.aisFilter=None
+
+  def on_ws_connected(self):
+    super().on_ws_connected()
+    self.stream.wakeUp()
+
+  def on_ws_closed(self):
+    super().on_ws_closed()
+    self.stream.removeConnection(self)
+
+  def on_ws_message(self, message):
+    try:
+      request=json.loads(message)
+      with self.lock:
+        if 'interval' in request:
+          self.interval=self.stream.checkInterval(request['interval'])
+        if 'bbox' in request:
+          self.bbox=self.stream.checkBbox(request['bbox'])
+        if 'gps' in request:
+          self.gps=request['gps'] is True
+          if not self.gps:
+            self.gpsData=None
+            self.gpsVersion=None
+        if 'ais' in request:
+          self.ais=request['ais'] is True
+          if not self.ais:
+            self.aisTargets=None
+            self.aisVersion=None
+        self.nextSend=0
+      self.stream.wakeUp()
+    except Exception as e:
+      AVNLog.error("invalid navstream request %s: %s",message,str(e))
+
+  def close(self):
+    self.handler.close_ws()
+
+  def __gpsDelta(self,navdata):
+    snapshot=navdata.getSnapshot(AVNStore.BASE_KEY_GPS,self.gpsVersion)
+    if snapshot is None:
+      return None
+    last=self.gpsData
+    self.gpsData=snapshot.data
+    self.gpsVersion=snapshot.version
+    if last is None:
+      return snapshot.data
+    changed={}
+    for k,v in snapshot.data.items():
+      if last.get(k) != v:
+        changed[k]=v
+    removed=[k for k in last if not k in snapshot.data]
+    if len(changed) < 1 and len(removed) < 1:
+      return None
+    return {'changed':changed,'removed':removed}
+
+  def __aisDelta(self,navdata):
+    if self.aisTargets is not None and self.aisFilter == self.bbox and \
+        navdata.getVersion(AVNStore.BASE_KEY_AIS) == self.aisVersion:
+      return None
+    version,targets,delta=self.stream.getAisDelta(navdata,self.bbox,
+                                                  self.aisFilter,self.aisVersion,self.aisTargets)
+    self.aisTargets=targets
+    self.aisVersion=version
+    self.aisFilter=self.bbox
+    return delta
+
+  def update(self,navdata,now):
+    '''
+    send the changes since the last update
+    @return: the number of bytes sent
+    '''
+    if not self.connected:
+      return 0
+    with self.lock:
+      self.nextSend=now+self.interval
+      if self.handler.send_queue_size() > self.stream.MAX_PENDING:
+        #slow client - deltas will be merged into the next update
+        return 0
+      isSnapshot=(self.gps and self.gpsData is None) or (self.ais and self.aisTargets is None)
+      rt={'type':'snapshot' if isSnapshot else 'delta'}
+      if self.gps:
+        delta=self.__gpsDelta(navdata)
+        if delta is not None:
+          rt['gps']=delta
+      if self.ais:
+        delta=self.__aisDelta(navdata)
+        if delta is not None:
+          rt['ais']=delta
+    if len(rt) < 2 and not isSnapshot:
+      return 0
+    message=json.dumps(rt,cls=Encoder)
+    self.send_message(message)
+    return len(message)
+
+
+class AisSnapshot(object):
+  '''
+  the AIS targets within a bbox at one AIS version
+  targets: mmsi -> value (without the age), ages: mmsi -> age at timestamp
+  '''
+  def __init__(self,navdata,bbox,version):
+    self.version=version
+    self.timestamp=time.monotonic()
+    if bbox is not None:
+      data=navdata.getAisDataInBox(bbox[0:2],bbox[2:4])
+    else:
+      data=navdata.getAisData()
+    self.targets={}
+    self.ages={}
+    for value in data:
+      mmsi=value.get('mmsi')
+      if mmsi is None:
+        continue
+      age=value.pop(AVNStore.AIS_AGE_KEY,None)
+      self.targets[mmsi]=value
+      if age is not None:
+        self.ages[mmsi]=age
+
+  def toSend(self,mmsi,now):
+    rt=self.targets[mmsi].copy()
+    age=self.ages.get(mmsi)
+    if age is not None:
+      rt[AVNStore.AIS_AGE_KEY]=age+now-self.timestamp
+    return rt
+
+  def diff(self,last):
+    '''
+    @param last: the targets of an earlier snapshot, None for a full update
+    @return: a list of all targets for a full update, a dict with changed and removed otherwise,
+             None if nothing has changed
+    '''
+    now=time.monotonic()
+    changed=[self.toSend(mmsi,now) for mmsi,value in self.targets.items()
+             if last is None or last.get(mmsi) != value]
+    if last is None:
+      return changed
+    removed=[mmsi for mmsi in last if not mmsi in self.targets]
+    if len(changed) < 1 and len(removed) < 1:
+      return None
+    return {'changed':changed,'removed':removed}
+
+
+class AVNNavStreamHandler(AVNWorker):
+  '''
+  push navigation and AIS data to websocket clients
+  instead of polling request=gps and request=ais
+  url: /navstream?interval=1&bbox=minLat,minLon,maxLat,maxLon
+  '''
+  PREFIX='/navstream'
+  #max number of messages in the send queue of a client
+  MAX_PENDING=2
+  #max time between 2 checks
+  MAX_WAIT=1
+  MIN_INTERVAL_PARAM=WorkerParameter('minInterval',0.5,type=WorkerParameter.T_FLOAT,
+                                     description="min time (s) between 2 updates for a client")
+  MAX_CLIENTS_PARAM=WorkerParameter('maxClients',20,type=WorkerParameter.T_NUMBER,
+                                    description="max number of connected clients")
+
+  def __init__(self, cfgparam):
+    super().__init__(cfgparam)
+    self.connections=[]
+    self.lock=threading.Lock()
+    self.bytesSent=0
+    #AIS snapshots (per bbox) and diffs shared by the clients
+    #only valid for aisCacheVersion, only used from the run thread
+    self.aisSnapshots={}
+    self.aisDiffs={}
+    self.aisCacheVersion=None
+
+  @classmethod
+  def autoInstantiate(cls):
+    return True
+
+  @classmethod
+  def canEdit(cls):
+    return True
+
+  @classmethod
+  def canDisable(cls):
+    return True
+
+  @classmethod
+  def preventMultiInstance(cls):
+    return True
+
+  @classmethod
+  def getConfigParam(cls, child=None):
+    return [
+      cls.MIN_INTERVAL_PARAM,
+      cls.MAX_CLIENTS_PARAM
+    ]
+
+  def updateConfig(self, param, child=None):
+    rt=super().updateConfig(param, child)
+    minInterval=self.MIN_INTERVAL_PARAM.fromDict(self.param)
+    with self.lock:
+      connections=self.connections.copy()
+    for connection in connections:
+      connection.interval=max(connection.interval,minInterval)
+    return rt
+
+  def stop(self):
+    super().stop()
+    self.closeAll()
+
+  def closeAll(self):
+    with self.lock:
+      connections=self.connections
+      self.connections=[]
+    for connection in connections:
+      try:
+        connection.close()
+      except:
+        pass
+
+  def checkInterval(self,interval):
+    return min(max(float(interval),self.MIN_INTERVAL_PARAM.fromDict(self.param)),60)
+
+  def checkBbox(self,bbox):
+    if bbox is None:
+      return None
+    if isinstance(bbox,str):
+      bbox=bbox.split(',')
+    if len(bbox) != 4:
+      raise Exception("invalid bbox %s, expected minLat,minLon,maxLat,maxLon"%str(bbox))
+    return tuple(float(v) for v in bbox)
+
+  def getAisDelta(self,navdata,bbox,lastBbox,lastVersion,lastTargets):
+    '''
+    get the AIS changes for a client
+    the snapshot is computed once per AIS version and bbox,
+    the diff once per AIS version, bbox and the state of the client
+    @return: (version,targets,delta)
+    '''
+    version=navdata.getVersion(AVNStore.BASE_KEY_AIS)
+    if version != self.aisCacheVersion:
+      self.aisSnapshots={}
+      self.aisDiffs={}
+      self.aisCacheVersion=version
+    snapshot=self.aisSnapshots.get(bbox)
+    if snapshot is None:
+      snapshot=AisSnapshot(navdata,bbox,version)
+      self.aisSnapshots[bbox]=snapshot
+    if lastTargets is None:
+      lastBbox=None
+      lastVersion=None
+    key=(bbox,lastBbox,lastVersion)
+    delta=self.aisDiffs.get(key)
+    if delta is None:
+      delta=(snapshot.diff(lastTargets),)
+      self.aisDiffs[key]=delta
+    return (snapshot.version,snapshot.targets,delta[0])
+
+  def removeConnection(self,connection):
+    with self.lock:
+      self.connections=[c for c in self.connections if c != connection]
+
+  def setStatus(self):
+    with self.lock:
+      numClients=len(self.connections)
+    self.setInfo('main',"%d clients, %d bytes sent"%(numClients,self.bytesSent),
+                 WorkerStatus.NMEA if numClients > 0 else WorkerStatus.RUNNING)
+
+  def run(self):
+    self.setStatus()
+    lastStatus=0
+    while not self.shouldStop():
+      now=time.monotonic()
+      nextRun=now+self.MAX_WAIT
+      for connection in self.connections:
+        if connection.nextSend <= now:
+          try:
+            self.bytesSent+=connection.update(self.navdata,now)
+          except Exception as e:
+            AVNLog.error("error sending navstream update: %s",traceback.format_exc())
+            self.removeConnection(connection)
+            connection.close()
+            continue
+        if connection.nextSend < nextRun:
+          nextRun=connection.nextSend
+      if now >= (lastStatus+5):
+        self.setStatus()
+        lastStatus=now
+      waitTime=nextRun-time.monotonic()
+      if waitTime > 0:
+        self.wait(waitTime)
+    self.closeAll()
+
+  def getHandledCommands(self):
+    return {
+      'websocket':self.PREFIX
+    }
+
+  def handleApiRequest(self, type, command, requestparam, **kwargs):
+    if type != 'websocket':
+      raise Exception("can only handle websocket requests")
+    handler=kwargs.get('handler')
+    if handler is None:
+      raise Exception("need the request handler for websocket requests")
+    interval=AVNUtil.getHttpRequestParam(requestparam,'interval')
+    interval=self.checkInterval(interval if interval is not None else 1)
+    bbox=self.checkBbox(AVNUtil.getHttpRequestParam(requestparam,'bbox'))
+    gps=AVNUtil.getHttpRequestFlag(requestparam,'gps',True)
+    ais=AVNUtil.getHttpRequestFlag(requestparam,'ais',True)
+    with self.lock:
+      if len(self.connections) >= self.MAX_CLIENTS_PARAM.fromDict(self.param):
+        raise Exception("too many navstream clients")
+      connection=NavStreamConnection(handler,self,interval=interval,bbox=bbox,gps=gps,ais=ais)
+      self.connections=self.connections+[connection]
+    AVNLog.info("new navstream client interval=%f, bbox=%s",interval,str(bbox))
+    self.setStatus()
+    return connection
+
+avnav_handlerList.registerHandler(AVNNavStreamHandler)
@@ -226,6 +226,7 @@ class SerialWriter(SerialReader):
       filter=filterstr.split(',')
     source=self.sourceName
     priority=AVNWorker.PRIORITY_PARAM_DESCRIPTION.fromDict(self.param)
+    framer=NMEALineFramer(self.RECEIVE_SIZE,300)
     while not self.doStop:
       try:
         if self.device is not None:
@@ -233,26 +234,29 @@ class SerialWriter(SerialReader):
             self.infoHandler.setInfo(INAME,
                                      "%.4g/s"%nmeaSum.avg(),
                                      WorkerStatus.NMEA if nmeaSum.val()>0 else WorkerStatus.INACTIVE)
-          bytes=self.device.readline(300)
+          num=self.readData(self.device,framer)
           if self.doStop:
             AVNLog.info("Stopping reader of combined reader/writer %s",str(self.param['port']))
             self.infoHandler.deleteInfo(INAME)
             return
-          if bytes is None or len(bytes)==0:
+          if num == 0:
             #if there is no data at all we simply take all the time we have...
             AVNLog.debug("unable to read data, retrying ")
             with self.lock:
               self.lock.wait(0.1)
             continue
-          data=bytes.decode('ascii','ignore')
-          if len(data) < 5:
-            AVNLog.debug("ignore short data %s",data)
-          else:
-            if not NMEAParser.checkFilter(data,filter):
-              AVNLog.debug("ignore line %s due to not matching filter",data)
-              continue
-            nmeaSum.add(1)
-            self.queue.addNMEA(data,source=source,sourcePriority=priority,subsource=self._getSubSourceName())
+          records=[]
+          for data in framer.getLines():
+            if len(data) < 5:
+              AVNLog.debug("ignore short data %s",data)
+            else:
+              if not NMEAParser.checkFilter(data,filter):
+                AVNLog.debug("ignore line %s due to not matching filter",data)
+                continue
+              records.append(data)
+          if len(records) > 0:
+            nmeaSum.add(len(records))
+            self.queue.addNMEABatch(records,source=source,sourcePriority=priority,subsource=self._getSubSourceName())
         else:
           with self.lock:
             self.lock.wait(0.5)
@@ -261,6 +265,7 @@ class SerialWriter(SerialReader):
         with self.lock:
           self.lock.wait(0.5)
         nmeaSum.clear()
+        framer.clear()
 
     
         
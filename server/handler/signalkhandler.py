@@ -90,7 +90,7 @@ import traceback
 import urllib.parse
 import urllib.request
 import uuid
-from functools import reduce
+from functools import reduce, lru_cache
 
 from alarmhandler import AVNAlarmHandler, AlarmConfig
 from avnav_nmea import NMEAParser
@@ -147,6 +147,14 @@ def timeToTs(tm):
   except Exception as e:
     AVNLog.error("unable to parse timestamp %s:%s",str(tm),traceback.format_exc())
 
+#the values of a delta (and most values of a query) share the same timestamp
+@lru_cache(maxsize=64)
+def cachedTimeToTs(tm):
+  '''
+  timeToTs for a timestamp string, caching the last results
+  '''
+  return timeToTs(tm)
+
 class AE(object):
   def __init__(self,path,converter=None):
     self.path=path
@@ -155,6 +163,12 @@ class AE(object):
     value=data
     if type(value) is dict:
       value=value.get('value')
+    return self.convert(value)
+
+  def convert(self,value):
+    '''
+    convert a plain value (e.g. from a delta)
+    '''
     if value is None:
       return value
     if self.converter is not None:
@@ -272,6 +286,14 @@ AISPATHMAP={
   'aid_type': AE('atonType',converter=convertAisAtonType)
 }
 
+#SK path -> list of (our key,AE) for AIS deltas
+#values at the top level of a vessel (e.g. name) are sent with an empty path
+#and a dict with the names as keys
+AISDELTAMAP={}
+for k,e in AISPATHMAP.items():
+  AISDELTAMAP.setdefault(e.path,[]).append((k,e))
+AIS_CONTEXTS=['vessels.','atons.']
+
 class Config(object):
   def __init__(self,param):
     self.skHost=AVNSignalKHandler.P_HOST.fromDict(param)
@@ -282,6 +304,7 @@ class Config(object):
     self.proxyMode=AVNSignalKHandler.P_CHARTPROXYMODE.fromDict(param)
     self.decode=AVNSignalKHandler.P_DIRECT.fromDict(param)
     self.aisFetchPeriod=AVNSignalKHandler.P_AISPERIOD.fromDict(param) if AVNSignalKHandler.P_AIS.fromDict(param) else 0
+    self.aisStreaming=self.aisFetchPeriod > 0 and AVNSignalKHandler.P_AISSTREAM.fromDict(param)
     self.user=AVNSignalKHandler.P_USERNAME.fromDict(param)
     self.password=AVNSignalKHandler.P_PASSWORD.fromDict(param)
     self.write=AVNSignalKHandler.P_WRITE.fromDict(param)
@@ -312,6 +335,18 @@ class MappingEntry(object):
     self.priority=priority
 
 
+class PathHandler(object):
+  '''
+  compiled handling for a SK path
+  storeKey: the key in our store
+  mapping: MappingEntry for a decoded value (if not a dict)
+  children: list of (name,MappingEntry) for decoded values if the value is a dict
+  '''
+  def __init__(self,storeKey,mapping=None,children=None):
+    self.storeKey=storeKey
+    self.mapping=mapping
+    self.children=children or []
+
 class InfoSetter(object):
   def __init__(self,name,writer):
     self.name=name
@@ -665,6 +700,9 @@ class AVNSignalKHandler(AVNWorker):
   P_AISPERIOD=WorkerParameter('aisQueryPeriod',type=WorkerParameter.T_NUMBER,default=10,
                               description="query period for AIS (in s)",
                               condition={P_AIS.name:True})
+  P_AISSTREAM=WorkerParameter('aisStreaming',type=WorkerParameter.T_BOOLEAN,default=False,
+                                description="subscribe to AIS changes via websocket, only query all targets on connect",
+                                condition={P_AIS.name:True})
   P_WRITE=WorkerParameter('sendData',type=WorkerParameter.T_BOOLEAN,default=False,
                           description='send data to signalk. This includes waypoint info and notifications')
   P_USERNAME=WorkerParameter('userName',type=WorkerParameter.T_STRING,default='admin',
@@ -722,7 +760,7 @@ class AVNSignalKHandler(AVNWorker):
             cls.P_AISPERIOD,cls.P_PERIOD,cls.P_CHARTS,cls.P_CHARTPERIOD,cls.P_CHARTPROXYMODE, cls.P_MIGRATED,
             cls.P_UUID,cls.P_IGNORE_TS]
     if hasWebsockets:
-      rt+=[cls.P_WRITE,cls.P_USERNAME,cls.P_PASSWORD,cls.P_SENDWP,cls.P_NOTIFY,cls.P_NOTIFY_RECEIVE,cls.P_NOTIFY_WHITE,cls.P_NOTIFY_BLACK,cls.P_WEBSOCKETRETRY]
+      rt+=[cls.P_AISSTREAM,cls.P_WRITE,cls.P_USERNAME,cls.P_PASSWORD,cls.P_SENDWP,cls.P_NOTIFY,cls.P_NOTIFY_RECEIVE,cls.P_NOTIFY_WHITE,cls.P_NOTIFY_BLACK,cls.P_WEBSOCKETRETRY]
     return rt
 
   @classmethod
@@ -758,6 +796,12 @@ class AVNSignalKHandler(AVNWorker):
     self.webSocket=None
     self.writeSocket=None
     self.timeSocket=None
+    #set when the AIS subscription on the websocket is active
+    self.aisSubscribed=False
+    #set when the AIS subscription is (re)established and all targets must be queried
+    self.aisResync=False
+    self.aisDeltaCount=0
+    self.aisSelf=None
     self.firstWebsocketMessage=False
     self.skCharts=[]
     #compute a time offset from our time to the SK time
@@ -772,6 +816,7 @@ class AVNSignalKHandler(AVNWorker):
     self.ownWpOffSent=False #set if we have sent the own WP off to SK (great Circle)
     self.ownWpOffSentRl=False #last wp off rhumb line
     self.ownMMSI=None
+    self.pathHandlers={}
 
 
 
@@ -826,6 +871,25 @@ class AVNSignalKHandler(AVNWorker):
             priority=0
           selfMappings[skKey]=MappingEntry(k.getKey(),k.signalKConversion,self.config.priority*10+priority)
     self.selfMap=selfMappings
+    self.pathHandlers={}
+
+  MAX_PATHHANDLERS=2000
+  def compilePath(self,path):
+    '''
+    create the PathHandler for a SK path
+    (to be rebuilt by createMappings on config changes)
+    '''
+    mapping=None
+    children=None
+    if self.config.decode:
+      mapping=self.selfMap.get(path)
+      prefix=path+"."
+      plen=len(prefix)
+      children=[(k[plen:],m) for k,m in self.selfMap.items() if k.startswith(prefix) and k.find('.',plen) < 0]
+    handler=PathHandler(self.PATH+"."+path,mapping,children)
+    if len(self.pathHandlers) < self.MAX_PATHHANDLERS:
+      self.pathHandlers[path]=handler
+    return handler
 
   def closeWebSockets(self):
     for sock in [self.webSocket,self.writeSocket,self.timeSocket]:
@@ -837,6 +901,7 @@ class AVNSignalKHandler(AVNWorker):
     self.webSocket=None
     self.writeSocket=None
     self.timeSocket=None
+    self.aisSubscribed=False
 
   CHARTHANDLER_PREFIX="signalk"
   def run(self):
@@ -868,23 +933,28 @@ class AVNSignalKHandler(AVNWorker):
 
   PATH="gps.signalk"
 
-  def decodeSelf(self,path,value):
-    mapping=self.selfMap.get(path)
-    if mapping is None:
-      return
-    if mapping.converter is not None:
-      value=mapping.converter(value)
-    AVNLog.debug("setting %s:%s from SK %s",mapping.localPath,str(value),path)
-    self.navdata.setValue(mapping.localPath,value,source=self.sourceName,priority=mapping.priority)
-
-  def setValue(self,path,value,timestamp=None):
-    self.navdata.setValue(self.PATH+"."+path,value,source=self.sourceName,priority=self.config.priority*10,timestamp=timestamp)
-    if self.config.decode:
-      if not type(value) is dict:
-        self.decodeSelf(path,value)
-      else:
-        for k,v in value.items():
-          self.decodeSelf(path+"."+k,v)
+  def addValue(self,path,value,values):
+    '''
+    collect the store entries for a SK value
+    @param values: list of (key,value,priority) for AVNStore.setValues
+    '''
+    handler=self.pathHandlers.get(path)
+    if handler is None:
+      handler=self.compilePath(path)
+    values.append((handler.storeKey,value,self.config.priority*10))
+    if type(value) is dict:
+      for name,mapping in handler.children:
+        if name in value:
+          v=value[name]
+          values.append((mapping.localPath,mapping.converter(v) if mapping.converter is not None else v,mapping.priority))
+    elif handler.mapping is not None:
+      mapping=handler.mapping
+      values.append((mapping.localPath,mapping.converter(value) if mapping.converter is not None else value,mapping.priority))
+
+  def setValue(self,path,value):
+    values=[]
+    self.addValue(path,value,values)
+    self.navdata.setValues(values,source=self.sourceName)
 
   def fetchAisData(self,baseUrl):
     url=baseUrl+'vessels/'
@@ -930,10 +1000,7 @@ class AVNSignalKHandler(AVNWorker):
             value=e.getValue(av)
             if value is not None:
               aisdata[k]=value
-          if newestTs is not None:
-            if self.timeOffset is not None:
-              newestTs-=self.timeOffset
-          monotonicTs = AVNUtil.utctomonotonic(newestTs) if newestTs is not None else None
+          monotonicTs=self.aisTsToMonotonic(newestTs)
           if monotonicTs is not None and monotonicTs < oldest:
             AVNLog.debug("ignore ais mmsi=%s - to old",mmsi)
             continue
@@ -946,6 +1013,77 @@ class AVNSignalKHandler(AVNWorker):
     except Exception as ex:
       self.setInfo(self.I_AIS,'error reading ais data from %s:%s'%(url,str(ex)),WorkerStatus.ERROR)
 
+  def aisTsToMonotonic(self,ts):
+    if ts is None:
+      return None
+    if self.timeOffset is not None:
+      ts-=self.timeOffset
+    return AVNUtil.utctomonotonic(ts)
+
+  def subscribeAis(self,data,socket):
+    '''
+    subscribe to all vessels and atons on the websocket
+    called with the hello message, all targets will be queried once afterwards
+    without the own context we cannot separate the AIS deltas - keep the REST query
+    '''
+    self.aisSelf=data.get('self')
+    if self.aisSelf is None:
+      AVNLog.info("no self context in hello message, cannot subscribe to AIS")
+      return
+    for context in AIS_CONTEXTS:
+      socket.send(json.dumps({
+        'context':context+'*',
+        'subscribe':[{'path':'*','policy':'instant'}]
+      }))
+    self.aisResync=True
+    self.aisSubscribed=True
+
+  def aisDeltaMessage(self,data,context):
+    '''
+    AIS deltas from the subscription to all vessels and atons
+    only the changed paths are mapped and written to the store
+    '''
+    pos=context.find('mmsi:')
+    if pos < 0 or not context.startswith(tuple(AIS_CONTEXTS)):
+      return
+    mmsi=context[pos+5:]
+    if mmsi == '' or (self.ownMMSI is not None and mmsi == self.ownMMSI):
+      return
+    updates=data.get('updates')
+    if updates is None:
+      return
+    oldest=time.monotonic()-self.navdata.getAisExpiryPeriod()
+    for update in updates:
+      values=update.get('values')
+      if values is None:
+        continue
+      monotonicTs=None
+      if not self.config.ignoreTs:
+        timestamp=update.get('timestamp')
+        monotonicTs=self.aisTsToMonotonic(cachedTimeToTs(timestamp) if type(timestamp) is str else None)
+        if monotonicTs is not None and monotonicTs < oldest:
+          continue
+      aisdata={}
+      for item in values:
+        path=item.get('path')
+        value=item.get('value')
+        if path == '':
+          if type(value) is dict:
+            for vk,vv in value.items():
+              for k,e in AISDELTAMAP.get(vk,()):
+                av=e.convert(vv)
+                if av is not None:
+                  aisdata[k]=av
+          continue
+        for k,e in AISDELTAMAP.get(path,()):
+          av=e.convert(value)
+          if av is not None:
+            aisdata[k]=av
+      if len(aisdata) > 0:
+        aisdata.pop('mmsi',None)
+        self.navdata.addAisItem(mmsi,aisdata,self.sourceName,self.config.priority*10,timestamp=monotonicTs)
+        self.aisDeltaCount+=1
+
   def sendAlarms(self):
     '''
     send out notifications towards SK
@@ -1010,6 +1148,7 @@ class AVNSignalKHandler(AVNWorker):
     self.createMappings()
     if self.config.aisFetchPeriod == 0:
       self.setInfo(self.I_AIS,'disabled',WorkerStatus.INACTIVE)
+    self.aisSelf=None
 
     if self.config.chartQueryPeriod == 0:
       self.setInfo(self.I_CHARTS,'disabled',WorkerStatus.INACTIVE)
@@ -1125,6 +1264,7 @@ class AVNSignalKHandler(AVNWorker):
                 if self.webSocket is None:
                   self.webSocket=WebSocketHandler(InfoSetter(self.I_WEBSOCKET,self),
                                                   websocketUrl,self.webSocketMessage)
+                self.aisSubscribed=False
                 self.webSocket.open()
                 lastWebsocket=now
           if self.config.write:
@@ -1204,7 +1344,22 @@ class AVNSignalKHandler(AVNWorker):
             except Exception as e:
               self.skCharts=[]
               AVNLog.debug("exception while reading chartlist %s",traceback.format_exc())
-          if self.config.aisFetchPeriod > 0 and lastAisFetch < (now - self.config.aisFetchPeriod):
+          #while the subscription is not active we fall back to the periodic query
+          aisStreamActive=self.config.aisStreaming and useWebsockets and self.aisSubscribed and \
+                          self.webSocket is not None and self.webSocket.isConnected()
+          if aisStreamActive:
+            if self.aisResync:
+              #the subscription is active - get all targets once
+              self.aisResync=False
+              try:
+                self.fetchAisData(apiUrl)
+              except Exception as e:
+                self.setInfo(self.I_AIS,'error in fetch %s'%str(e),WorkerStatus.ERROR)
+              lastAisFetch=now
+            elif lastAisFetch < (now - self.config.aisFetchPeriod):
+              self.setInfo(self.I_AIS,'streaming, %d updates'%self.aisDeltaCount,WorkerStatus.NMEA)
+              lastAisFetch=now
+          elif self.config.aisFetchPeriod > 0 and lastAisFetch < (now - self.config.aisFetchPeriod):
             try:
               self.fetchAisData(apiUrl)
             except Exception as e:
@@ -1232,7 +1387,7 @@ class AVNSignalKHandler(AVNWorker):
     '''
     if timestampstr is None:
       return None
-    timeStamp=timeToTs(timestampstr)
+    timeStamp=cachedTimeToTs(timestampstr) if type(timestampstr) is str else timeToTs(timestampstr)
     if self.timeOffset is not None:
       timeStamp+=self.timeOffset
     return AVNUtil.utctomonotonic(timeStamp)
@@ -1365,10 +1520,22 @@ class AVNSignalKHandler(AVNWorker):
       to=socket.getTimeOffset()
       if to is not None:
         self.timeOffset=to
+      if self.config.aisStreaming:
+        self.subscribeAis(data,socket)
+    context=data.get('context')
+    if context is not None and self.aisSubscribed and context != self.aisSelf:
+      #a delta from the AIS subscription, errors must not close the connection
+      try:
+        self.aisDeltaMessage(data,context)
+      except:
+        AVNLog.error("error decoding AIS delta %s:%s",str(data),traceback.format_exc())
+      return
     try:
       updates=data.get('updates')
       if updates is None:
         return
+      #all values of the message are written in one batch
+      storeValues=[]
       for update in updates:
         values=update.get('values')
         timestampStr=update.get('timestamp')
@@ -1389,7 +1556,9 @@ class AVNSignalKHandler(AVNWorker):
                 self.handleNotifications({skAlarm.psKey():skAlarm},False)
             else:
               if value is not None:
-                self.setValue(path,value)
+                self.addValue(path,value,storeValues)
+      if len(storeValues) > 0:
+        self.navdata.setValues(storeValues,source=self.sourceName)
     except:
       AVNLog.error("error decoding %s:%s",str(data),traceback.format_exc())
       try:
@@ -1629,15 +1798,18 @@ class AVNSignalKHandler(AVNWorker):
     self.setInfo(self.I_CHARTS,'read %d charts'%len(newList),WorkerStatus.NMEA)
 
   def iterateToValue(self,node,prefix,callback):
-    if not type(node) is dict:
-      return
-    if 'value' in node:
-      callback(prefix,node.get('value'),node.get('$source'),node.get('timestamp'))
-      return
-    for k,v in node.items():
-      if type(v) is dict:
-        path=k if prefix is None else prefix+"."+k
-        self.iterateToValue(v,path,callback)
+    stack=[(node,prefix)]
+    while len(stack) > 0:
+      node,prefix=stack.pop()
+      if not type(node) is dict:
+        continue
+      if 'value' in node:
+        callback(prefix,node.get('value'),node.get('$source'),node.get('timestamp'))
+        continue
+      children=[(v,k if prefix is None else prefix+"."+k) for k,v in node.items() if type(v) is dict]
+      #keep the order of the recursive walk
+      children.reverse()
+      stack.extend(children)
 
 
   def storeData(self,node,priority):
@@ -1651,13 +1823,16 @@ class AVNSignalKHandler(AVNWorker):
         for k,v in item.items():
           self.iterateToValue(v,'notifications.'+k,storeNotification)
       self.handleNotifications(alarmList.skList,True)
+    storeValues=[]
+    oldest=time.monotonic()-self.navdata.getExpiryPeriod()
     def store(path,value,source,timestampstr):
       timestamp=self.timestampToMonotonic(timestampstr) if not self.config.ignoreTs else time.monotonic()
-      if self.checkOutdated(timestamp):
+      if timestamp < oldest:
         AVNLog.debug('ignore outdated value %s',path)
         return
-      self.setValue(path, value,timestamp=timestamp)
+      self.addValue(path,value,storeValues)
     self.iterateToValue(node,None,store)
+    self.navdata.setValues(storeValues,source=self.sourceName)
 
   def getLocalToken(self,user):
     allowedTypes=['readwrite','admin']
@@ -41,6 +41,9 @@ class SocketReader(object):
   P_STRIP_LEADING = WorkerParameter('stripLeading', False, type=WorkerParameter.T_BOOLEAN,
                                 description="strip anything before $ or ! in received lines")
   START_PATTERN=re.compile('[$!]')
+  #bytes we try to receive with one read
+  RECEIVE_SIZE=65536
+  MAX_LINE_LEN=4096
   def __init__(self,socket,queue:AVNQueue,setInfo:InfoHandler,shouldStop=None,sourcePriority=NMEAParser.DEFAULT_SOURCE_PRIORITY,stripLeading=False):
     self.queue=queue
     self.socket=socket
@@ -71,6 +74,25 @@ class SocketReader(object):
       return line
     return line[match.span()[0]:]
 
+  def filterLines(self,lines,pattern,filterA):
+    '''
+    clean up received lines and only return valid NMEA records matching the filter
+    @param lines: the received lines
+    @param pattern: the NMEA start pattern (AVNUtil.getNMEACheck)
+    @param filterA: the filter as list (or None)
+    '''
+    records=[]
+    for l in lines:
+      l=l.translate(NMEAParser.STRIPCHARS)
+      l=self._removeLeading(l)
+      if pattern.match(l):
+        if not NMEAParser.checkFilter(l, filterA):
+          continue
+        records.append(l)
+      else:
+        AVNLog.debug("ignoring unknown data %s",l)
+    return records
+
   def readSocket(self,sourceName,filter=None,timeout=None,minTime=None,ownsource=None):
     INAME='reader'
     nmeaSum=MovingSum()
@@ -92,14 +114,14 @@ class SocketReader(object):
       pass
     AVNLog.info("%s established, start reading",peer)
     self.infoHandler.setInfo(INAME, "receiving %s"%(peer,), WorkerStatus.RUNNING)
-    buffer=""
+    framer=NMEALineFramer(self.RECEIVE_SIZE,self.MAX_LINE_LEN)
     try:
       sock.settimeout(1)
       lastReceived=time.time()
       while sock.fileno() >= 0 and not self.shouldStop():
         nmeaSum.add(0)
         try:
-          data = sock.recv(1024)
+          num = framer.recvFrom(sock)
           lastReceived=time.time()
         except socket.timeout:
           if timeout is not None:
@@ -111,40 +133,23 @@ class SocketReader(object):
               raise Exception("no data received within timeout of %s seconds"%str(timeout))
           nmeaInfo(peer)
           continue
-        if len(data) == 0:
+        if num == 0:
           AVNLog.info("connection lost")
           break
-        buffer=buffer+data.decode('ascii','ignore')
-        lines=buffer.splitlines(True)
-        if lines[-1][-1]=='\n':
-          #last one ends with nl
-          for l in lines:
-            l=l.translate(NMEAParser.STRIPCHARS)
-            l=self._removeLeading(l)
-            if pattern.match(l):
-              if not NMEAParser.checkFilter(l, filterA):
-                continue
-              nmeaSum.add(1)
-              self.queue.addNMEA(l,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
-              if minTime is not None:
-                time.sleep(minTime/1000)
-            else:
-              AVNLog.debug("ignoring unknown data %s",l)
-          buffer=''
-        else:
-          for i in range(len(lines)-1):
-            line=lines[i].translate(NMEAParser.STRIPCHARS)
-            line=self._removeLeading(line)
-            if pattern.match(line):
-              nmeaSum.add(1)
-              self.queue.addNMEA(line,source=sourceName,sourcePriority=self.sourcePriority)
-            else:
-              AVNLog.debug("ignoring unknown data %s",lines[i])
-          if len(lines) > 0:
-            buffer=lines[-1]
-        if len(buffer) > 4096:
-          AVNLog.debug("no line feed in long data, stopping")
+        try:
+          lines=framer.getLines()
+        except Exception as e:
+          AVNLog.debug("%s, stopping",str(e))
           break
+        records=self.filterLines(lines,pattern,filterA)
+        if len(records) > 0:
+          nmeaSum.add(len(records))
+          if minTime:
+            for l in records:
+              self.queue.addNMEA(l,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
+              time.sleep(minTime/1000)
+          else:
+            self.queue.addNMEABatch(records,source=sourceName,sourcePriority=self.sourcePriority,subsource=ownsource)
         nmeaInfo(peer)
       sock.shutdown(socket.SHUT_RDWR)
       sock.close()
@@ -189,6 +194,9 @@ class SocketReader(object):
           self.socket.getpeername()
     except Exception as e:
       AVNLog.info("exception in client connection %s", traceback.format_exc())
+    finally:
+      #release the queue subscription, do not rely on the garbage collector
+      fetcher.close()
     AVNLog.info("client disconnected or stop received")
     try:
       self.stop()
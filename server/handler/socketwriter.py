@@ -24,6 +24,8 @@
 #  parts from this software (AIS decoding) are taken from the gpsd project
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
+import collections
+import selectors
 import socket
 
 from avnavavahi import AVNAvahi
@@ -34,6 +36,61 @@ from avnav_nmea import *
 from avnav_worker import *
 
 
+class MultiplexClient(object):
+  '''
+  a client connection handled by the multiplexer
+  data to be sent is queued as chunks, if more then maxBuffer bytes
+  are waiting the oldest chunks are dropped
+  '''
+  def __init__(self,sock,addr,reader:SocketReader,subsource,ownsource,maxBuffer):
+    self.sock=sock
+    self.addr=addr
+    self.reader=reader
+    self.subsource=subsource
+    self.ownsource=ownsource
+    self.maxBuffer=maxBuffer
+    self.framer=None
+    self.chunks=collections.deque()
+    self.offset=0 #already sent bytes of the first chunk
+    self.pending=0
+    self.dropped=0
+    self.events=0
+
+  def enqueue(self,data):
+    if len(data) < 1:
+      return
+    self.chunks.append(data)
+    self.pending+=len(data)
+    #never drop a partially sent chunk
+    while self.pending > self.maxBuffer and len(self.chunks) > 1:
+      drop=1 if self.offset > 0 else 0
+      if drop >= len(self.chunks)-1:
+        break
+      removed=self.chunks[drop]
+      del self.chunks[drop]
+      self.pending-=len(removed)
+      self.dropped+=1
+
+  def flush(self):
+    '''
+    send as much as possible without blocking
+    @return: True if all data has been sent
+    '''
+    while len(self.chunks) > 0:
+      first=self.chunks[0]
+      try:
+        num=self.sock.send(memoryview(first)[self.offset:])
+      except BlockingIOError:
+        return False
+      self.pending-=num
+      self.offset+=num
+      if self.offset < len(first):
+        return False
+      self.chunks.popleft()
+      self.offset=0
+    return True
+
+
 #a worker to output data via a socket
 
 class AVNSocketWriter(AVNWorker):
@@ -57,6 +114,11 @@ class AVNSocketWriter(AVNWorker):
                                condition={P_READ.name:True})
   P_MINTIME=WorkerParameter('minTime',50,type=WorkerParameter.T_FLOAT,
                             description='if this is set, wait this time before reading new data (ms)')
+  P_MULTIPLEX=WorkerParameter('multiplex',False,type=WorkerParameter.T_BOOLEAN,
+                              description='handle all clients in one thread (minTime is ignored)')
+  P_CLIENTBUFFER=WorkerParameter('clientBuffer',65536,type=WorkerParameter.T_NUMBER,
+                                 description='max bytes waiting for a client, older data will be dropped',
+                                 condition={P_MULTIPLEX.name:True})
   @classmethod
   def getConfigParam(cls, child=None):
     if child is None:
@@ -72,6 +134,8 @@ class AVNSocketWriter(AVNWorker):
           cls.REPLY_RECEIVED.copy(condition={cls.P_READ.name:True}),
           cls.P_MINTIME.copy(condition={cls.P_READ.name:True}),
           cls.BLACKLIST_PARAM,
+          cls.P_MULTIPLEX,
+          cls.P_CLIENTBUFFER,
           cls.AVAHI_ENABLED,
           cls.AVAHI_NAME,
           ]
@@ -93,6 +157,9 @@ class AVNSocketWriter(AVNWorker):
     self.maplock = threading.Lock()
     self.startSequence=0
     self.version='unset'
+    #new clients for the multiplexer
+    self.newClients=[]
+    self.multiplexer=None
 
 
   def sequenceChanged(self,seq):
@@ -170,6 +237,145 @@ class AVNSocketWriter(AVNWorker):
       ownsource=ownsource)
 
 
+  def addMultiplexClient(self,sock,addr):
+    with self.maplock:
+      self.newClients.append((sock,addr))
+      if self.multiplexer is None or not self.multiplexer.is_alive():
+        self.multiplexer=threading.Thread(target=self.multiplex,name="%s-multiplexer"%self.getName())
+        self.multiplexer.daemon=True
+        self.multiplexer.start()
+
+  def _openMultiplexClient(self,selector,sock,addr):
+    infoName="SocketWriter-%s"%(str(addr),)
+    subsource=self.getSubSource(addr)
+    ownsource=subsource if not self.getWParam(self.REPLY_RECEIVED) else None
+    reader=SocketReader(sock,self.queue,SubInfoHandler(self,infoName,track=False),
+                        sourcePriority=self.PRIORITY_PARAM_DESCRIPTION.fromDict(self.param))
+    client=MultiplexClient(sock,addr,reader,subsource,ownsource,self.P_CLIENTBUFFER.fromDict(self.param))
+    rd=self.P_READ.fromDict(self.param)
+    if rd:
+      client.framer=NMEALineFramer(SocketReader.RECEIVE_SIZE,SocketReader.MAX_LINE_LEN)
+    sock.setblocking(False)
+    client.enqueue(("avnav_server %s\r\n" % (self.version)).encode('utf-8'))
+    client.events=selectors.EVENT_WRITE|(selectors.EVENT_READ if rd else 0)
+    selector.register(sock,client.events,client)
+    self.setInfo(infoName,"sending%s data (multiplexed)"%("/receiving" if rd else ""),WorkerStatus.RUNNING)
+    AVNLog.info("multiplexing client %s",str(addr))
+    return client
+
+  def _closeMultiplexClient(self,selector,client:MultiplexClient):
+    AVNLog.info("client %s disconnected",str(client.addr))
+    try:
+      selector.unregister(client.sock)
+    except:
+      pass
+    try:
+      client.sock.close()
+    except:
+      pass
+    self.removeHandler(client.addr)
+    self.deleteInfo("SocketWriter-%s"%(str(client.addr),))
+
+  def multiplex(self):
+    '''
+    serve all clients from one thread:
+    fetch each batch from the queue once and send it to all clients,
+    read from the clients if enabled
+    '''
+    fetcher=Fetcher(self.queue,self,
+                    nmeaFilter=self.FILTER_PARAM.fromDict(self.param),
+                    blackList=self.getWParam(self.BLACKLIST_PARAM),
+                    includeSource=True,
+                    maxEntries=100,
+                    sumKey='writer')
+    selector=selectors.DefaultSelector()
+    clients={}
+    pattern=AVNUtil.getNMEACheck()
+    try:
+      #we stop when all clients are gone (closed on stop/config change)
+      while True:
+        with self.maplock:
+          newClients=self.newClients
+          self.newClients=[]
+        for sock,addr in newClients:
+          try:
+            clients[addr]=self._openMultiplexClient(selector,sock,addr)
+          except Exception as e:
+            AVNLog.error("unable to add client %s: %s",str(addr),str(e))
+            self.removeHandler(addr)
+        if len(clients) < 1:
+          with self.maplock:
+            if len(self.newClients) < 1:
+              self.multiplexer=None
+              break
+          continue
+        fetcher.updateParam(nmeaFilter=self.FILTER_PARAM.fromDict(self.param),
+                            blackList=self.getWParam(self.BLACKLIST_PARAM))
+        entries=fetcher.fetch(waitTime=0.05)
+        fetcher.report()
+        if len(entries) > 0:
+          allData=None
+          for client in clients.values():
+            if client.ownsource is not None and any(e.subsource == client.ownsource for e in entries):
+              client.enqueue(''.join(e.data for e in entries if e.subsource != client.ownsource).encode('ascii',errors='ignore'))
+            else:
+              if allData is None:
+                allData=''.join(e.data for e in entries).encode('ascii',errors='ignore')
+              client.enqueue(allData)
+        closed=[]
+        for client in clients.values():
+          if client.sock.fileno() < 0:
+            closed.append(client)
+            continue
+          try:
+            done=client.flush()
+            events=client.events & selectors.EVENT_READ
+            if not done:
+              events|=selectors.EVENT_WRITE
+            if events != client.events and events != 0:
+              selector.modify(client.sock,events,client)
+              client.events=events
+          except Exception as e:
+            AVNLog.debug("error writing to %s: %s",str(client.addr),str(e))
+            closed.append(client)
+        readFilter=self.P_READFILTER.fromDict(self.param)
+        readFilter=readFilter.split(',') if readFilter else None
+        for key,mask in selector.select(0):
+          client=key.data
+          if client in closed:
+            continue
+          if mask & selectors.EVENT_READ:
+            try:
+              num=client.framer.recvFrom(client.sock)
+              if num == 0:
+                raise Exception("connection closed")
+              records=client.reader.filterLines(client.framer.getLines(),pattern,readFilter)
+              if len(records) > 0:
+                self.queue.addNMEABatch(records,source=self.getSourceName(),
+                                        sourcePriority=client.reader.sourcePriority,subsource=client.ownsource)
+            except BlockingIOError:
+              pass
+            except Exception as e:
+              AVNLog.debug("error reading from %s: %s",str(client.addr),str(e))
+              closed.append(client)
+        for client in closed:
+          clients.pop(client.addr,None)
+          self._closeMultiplexClient(selector,client)
+        for client in clients.values():
+          if client.dropped > 0:
+            AVNLog.debug("client %s too slow, dropped %d chunks",str(client.addr),client.dropped)
+            self.setInfo("SocketWriter-%s"%(str(client.addr),),"slow client, dropped %d"%client.dropped,WorkerStatus.ERROR)
+            client.dropped=0
+    except Exception as e:
+      AVNLog.error("multiplexer error: %s",traceback.format_exc())
+    for client in list(clients.values()):
+      self._closeMultiplexClient(selector,client)
+    with self.maplock:
+      if self.multiplexer == threading.current_thread():
+        self.multiplexer=None
+    selector.close()
+    fetcher.close()
+
   def _closeSockets(self):
     AVNLog.info("closing all sockets")
     self.startSequence+=1
@@ -267,7 +473,9 @@ class AVNSocketWriter(AVNWorker):
           AVNLog.info("connect from %s",str(addr))
           outsock.settimeout(None)
           allowAccept=self.checkAndAddHandler(addr,outsock)
-          if allowAccept:
+          if allowAccept and self.P_MULTIPLEX.fromDict(self.param):
+            self.addMultiplexClient(outsock,addr)
+          elif allowAccept:
             clientHandler=threading.Thread(
               target=self.client,
               args=(outsock, addr,self.startSequence),
@@ -25,7 +25,12 @@
 #  so refer to this BSD licencse also (see ais.py) or omit ais.py 
 ###############################################################################
 
+import array
+import bisect
+import concurrent.futures
 import glob
+import math
+import multiprocessing
 
 import avnav_handlerList
 from avnav_manager import AVNHandlerManager
@@ -64,6 +69,286 @@ class TrackPoint:
         ts+="Z"
     return "%s,%f,%f,%f,%f,%f\n"%(ts,self.lat,self.lon,self.course or 0,self.speed or 0,self.distance or 0)
 
+def parseTrackTime(tstr):
+  '''
+  parse the time of a track line
+  fast path for the format we write (2021-05-01T10:12:13Z)
+  '''
+  if len(tstr) == 20 and tstr[19] == 'Z':
+    try:
+      return datetime.datetime.fromisoformat(tstr[0:19])
+    except ValueError:
+      pass
+  return AVNUtil.gt(tstr)
+
+def parseTrackLines(lines,onError=None):
+  '''
+  parse lines of a track file (our csv syntax)
+  @param lines: iterable of strings
+  @param onError: callback(line) for unparseable lines
+  @return: list of TrackPoint
+  '''
+  rt=[]
+  for line in lines:
+    if '#' in line:
+      line=line[0:line.index('#')]
+    par=line.split(",")
+    if len(par) < 3:
+      continue
+    try:
+      rt.append(TrackPoint(parseTrackTime(par[0]),
+                    lat=float(par[1]),
+                    lon=float(par[2]),
+                    course=float(par[3]),
+                    speed=float(par[4])))
+    except:
+      if onError is not None:
+        onError(line)
+  return rt
+
+GPX_HEADER='''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
+           <gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="avnav" 
+                xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
+            xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd"> 
+            <trk>
+            <name>avnav-track-%s</name>
+            <trkseg>
+            '''
+GPX_FOOTER='''
+            </trkseg>
+            </trk>
+            </gpx>
+            '''
+GPX_TRKPT="""
+             <trkpt lat="%2.9f" lon="%2.9f" ><time>%s</time><course>%3.1f</course><speed>%3.2f</speed></trkpt>
+             """
+
+def formatGpxPoints(data):
+  rt=[]
+  for trackpoint in data:
+    ts=trackpoint.ts.isoformat()
+    if not ts[-1:]=="Z":
+      ts+="Z"
+    rt.append(GPX_TRKPT%(trackpoint.lat,trackpoint.lon,ts,trackpoint.course,trackpoint.speed))
+  return "".join(rt)
+
+class GpxState(object):
+  '''
+  the state of a gpx file converted from a track file
+  '''
+  def __init__(self,avtOffset=0,gpxOffset=0,gpxSize=0,avtMtime=None):
+    self.avtOffset=avtOffset #bytes of the track file already converted
+    self.gpxOffset=gpxOffset #start of the footer in the gpx file
+    self.gpxSize=gpxSize     #size of the gpx file after the conversion
+    self.avtMtime=avtMtime
+    self.numPoints=0         #points converted in the last run
+    self.numErrors=0         #unparseable lines in the last run
+
+def convertTrackFile(track,gpx,state:GpxState=None):
+  '''
+  convert a track file into a gpx file
+  if state matches the existing gpx file only the new track lines
+  are appended and the footer is rewritten, otherwise the gpx is rebuilt
+  runs in a process pool for bulk conversions - so no logging here
+  @return: the new GpxState
+  '''
+  try:
+    gpxSize=os.path.getsize(gpx)
+  except OSError:
+    gpxSize=None
+  avtMtime=os.stat(track).st_mtime
+  if state is not None and (gpxSize != state.gpxSize or os.path.getsize(track) < state.avtOffset):
+    state=None
+  with open(track,"rb") as f:
+    if state is not None:
+      f.seek(state.avtOffset)
+    raw=f.read()
+  #only convert complete lines
+  end=raw.rfind(b"\n")+1
+  raw=raw[0:end]
+  rt=GpxState(avtMtime=avtMtime)
+  rt.avtOffset=end if state is None else state.avtOffset+end
+  def onError(line):
+    rt.numErrors+=1
+  data=parseTrackLines(raw.decode('utf-8',errors='replace').splitlines(),onError)
+  rt.numPoints=len(data)
+  points=formatGpxPoints(data).encode('utf-8')
+  footer=GPX_FOOTER.encode('utf-8')
+  if state is None:
+    title,e=os.path.splitext(os.path.basename(gpx))
+    header=(GPX_HEADER%(title,)).encode('utf-8')
+    with open(gpx,"wb") as f:
+      f.write(header)
+      f.write(points)
+      f.write(footer)
+    rt.gpxOffset=len(header)+len(points)
+  else:
+    with open(gpx,"r+b") as f:
+      f.seek(state.gpxOffset)
+      f.write(points)
+      f.write(footer)
+      f.truncate()
+    rt.gpxOffset=state.gpxOffset+len(points)
+  rt.gpxSize=rt.gpxOffset+len(footer)
+  return rt
+
+class TrackStore(object):
+  '''
+  the in memory track as parallel arrays
+  (utc timestamp in s, lat, lon, speed, course - NaN for missing values)
+  sorted by timestamp
+  not thread safe - must be protected by the caller
+  '''
+  EPOCH=datetime.datetime(1970,1,1)
+  #m per degree latitude
+  DEG_M=AVNUtil.NM*60
+  #max number of cached interval selections
+  MAX_SELECTIONS=8
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    #interval -> selected indices, see selectInterval
+    self.selections={}
+    self.ts=array.array('d')
+    self.lat=array.array('d')
+    self.lon=array.array('d')
+    self.speed=array.array('d')
+    self.course=array.array('d')
+
+  def __len__(self):
+    return len(self.ts)
+
+  @classmethod
+  def _toFloat(cls,v):
+    return float(v) if v is not None else math.nan
+
+  @classmethod
+  def _fromFloat(cls,v):
+    return v if not math.isnan(v) else None
+
+  def append(self,tp: TrackPoint):
+    ts=AVNUtil.datetimeToTsUTC(tp.ts)
+    values=(ts,self._toFloat(tp.lat),self._toFloat(tp.lon),self._toFloat(tp.speed),self._toFloat(tp.course))
+    columns=(self.ts,self.lat,self.lon,self.speed,self.course)
+    if len(self.ts) < 1 or ts >= self.ts[-1]:
+      for column,value in zip(columns,values):
+        column.append(value)
+    else:
+      idx=bisect.bisect_right(self.ts,ts)
+      for column,value in zip(columns,values):
+        column.insert(idx,value)
+      self.selections.clear()
+
+  def removeOlder(self,dt):
+    '''
+    remove all entries with a timestamp <= dt
+    @return: the number of removed entries
+    '''
+    num=bisect.bisect_right(self.ts,AVNUtil.datetimeToTsUTC(dt))
+    if num > 0:
+      for column in (self.ts,self.lat,self.lon,self.speed,self.course):
+        del column[0:num]
+      self.selections.clear()
+    return num
+
+  def selectInterval(self,interval):
+    '''
+    select the indices of entries being more then interval seconds apart
+    starting with the first entry
+    the selection is kept and only extended for appended entries
+    @return: a list of indices - do not modify
+    '''
+    ts=self.ts
+    num=len(ts)
+    rt=self.selections.get(interval)
+    if rt is None:
+      if len(self.selections) >= self.MAX_SELECTIONS:
+        self.selections.clear()
+      rt=[]
+      self.selections[interval]=rt
+      idx=0
+    else:
+      idx=bisect.bisect_right(ts,ts[rt[-1]]+interval,rt[-1]+1) if len(rt) > 0 else 0
+    while idx < num:
+      rt.append(idx)
+      idx=bisect.bisect_right(ts,ts[idx]+interval,idx+1)
+    return rt
+
+  def simplify(self,indices,tolerance):
+    '''
+    Douglas-Peucker simplification of the entries given by indices
+    using a local equirectangular projection
+    @param tolerance: max deviation in m
+    @return: sorted list of the indices to keep
+    '''
+    num=len(indices)
+    if num < 3:
+      return list(indices)
+    coslat=math.cos(math.radians(self.lat[indices[0]]))
+    xs=[self.lon[i]*coslat*self.DEG_M for i in indices]
+    ys=[self.lat[i]*self.DEG_M for i in indices]
+    keep=[0,num-1]
+    stack=[(0,num-1)]
+    while len(stack) > 0:
+      first,last=stack.pop()
+      if last-first < 2:
+        continue
+      x1=xs[first]
+      y1=ys[first]
+      dx=xs[last]-x1
+      dy=ys[last]-y1
+      seglen2=dx*dx+dy*dy
+      maxDist=-1
+      maxIdx=None
+      for i in range(first+1,last):
+        x=xs[i]
+        y=ys[i]
+        if seglen2 > 0:
+          t=((x-x1)*dx+(y-y1)*dy)/seglen2
+          t=max(0,min(1,t))
+          ex=x-(x1+t*dx)
+          ey=y-(y1+t*dy)
+        else:
+          ex=x-x1
+          ey=y-y1
+        dist=ex*ex+ey*ey
+        if dist > maxDist:
+          maxDist=dist
+          maxIdx=i
+      if maxDist > tolerance*tolerance:
+        keep.append(maxIdx)
+        stack.append((first,maxIdx))
+        stack.append((maxIdx,last))
+    keep.sort()
+    return [indices[i] for i in keep]
+
+  def getFormatted(self,idx):
+    ts=self.ts[idx]
+    return {
+      'ts':ts,
+      'lat':self._fromFloat(self.lat[idx]),
+      'lon':self._fromFloat(self.lon[idx]),
+      'speed':self._fromFloat(self.speed[idx]),
+      'course':self._fromFloat(self.course[idx]),
+      'time':(self.EPOCH+datetime.timedelta(seconds=ts)).isoformat()
+    }
+
+  def getTrackFormatted(self,maxnum,interval,tolerance=None):
+    '''
+    get the track as list of dicts
+    @param maxnum: max number of entries (the newest)
+    @param interval: min time between entries (s)
+    @param tolerance: if set, additionally simplify the selected entries (Douglas-Peucker, m)
+    '''
+    selected=self.selectInterval(interval)
+    if maxnum is not None:
+      selected=selected[-maxnum:]
+    if tolerance is not None:
+      selected=self.simplify(selected,tolerance)
+    return [self.getFormatted(idx) for idx in selected]
+
+
 #a writer for our track
 class AVNTrackWriter(AVNDirectoryHandlerBase):
   P_CLEANUP=WorkerParameter('cleanup',25,type=WorkerParameter.T_FLOAT,
@@ -77,7 +362,7 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
                            description="write to track file (otherwise memory only)")
   def __init__(self,param):
     super(AVNTrackWriter,self).__init__(param,'track')
-    self.track=[]
+    self.track=TrackStore()
     self.tracklock=threading.Lock()
     self.baseDir=AVNHandlerManager.getDirWithDefault(self.param, self.P_TRACKDIR.name, 'tracks')
     self.fname=None
@@ -122,14 +407,8 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
   def cleanupTrack(self):
     numremoved=0
     cleanupTime=datetime.datetime.utcnow()-datetime.timedelta(hours=self.getWParam(self.P_CLEANUP))
-    self.tracklock.acquire()
-    while len(self.track) > 0:
-      if self.track[0].ts<=cleanupTime:
-        numremoved+=1
-        self.track.pop(0)
-      else:
-        break
-    self.tracklock.release()
+    with self.tracklock:
+      numremoved=self.track.removeOlder(cleanupTime)
     if numremoved > 0:
       AVNLog.debug("removed %d track entries older then %s",numremoved,cleanupTime.isoformat())
 
@@ -145,6 +424,7 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
       dist = None
       maxnum = 60  # with default settings this is one hour
       interval = 60
+      tolerance = None
       try:
         maxnumstr = AVNUtil.getHttpRequestParam(requestParam, 'maxnum')
         if not maxnumstr is None:
@@ -152,27 +432,24 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
         intervalstr = AVNUtil.getHttpRequestParam(requestParam, 'interval')
         if not intervalstr is None:
           interval = int(intervalstr)
+        tolerancestr = AVNUtil.getHttpRequestParam(requestParam, 'simplify')
+        if not tolerancestr is None:
+          tolerance = float(tolerancestr)
       except:
         pass
-      frt = self.getTrackFormatted(maxnum, interval)
+      frt = self.getTrackFormatted(maxnum, interval, tolerance)
       return frt
 
   #get the track as array of dicts
   #filter by maxnum and interval
-  def getTrackFormatted(self,maxnum,interval):
-    rt=[]
-    curts=None
-    intervaldt=datetime.timedelta(seconds=interval)
-    self.tracklock.acquire()
-    try:
-      for tp in self.track:
-        if curts is None or tp.ts > (curts + intervaldt):
-          rt.append(tp.getFormatted())
-          curts=tp.ts
-    except:
-      pass
-    self.tracklock.release()
-    return rt[-maxnum:]
+  #with tolerance (m) additionally simplify the track (Douglas-Peucker)
+  def getTrackFormatted(self,maxnum,interval,tolerance=None):
+    with self.tracklock:
+      try:
+        return self.track.getTrackFormatted(maxnum,interval,tolerance)
+      except:
+        AVNLog.debug("error formatting track: %s",traceback.format_exc())
+    return []
   #read in a track file (our csv syntax)
   #return an array of track data
   def readTrackFile(self,filename):
@@ -185,21 +462,10 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
       AVNLog.debug("unable to open track file %s",filename)
       return rt
     AVNLog.debug("reading track file %s",filename)
+    def onError(line):
+      AVNLog.warn("invalid line in track file %s: %s",filename,line.rstrip())
     try:
-      for line in f:
-        line=re.sub('#.*','',line)
-        par=line.split(",")
-        if len(par) < 3:
-          continue
-        try:
-          tp=TrackPoint(AVNUtil.gt(par[0]),
-                        lat=float(par[1]),
-                        lon=float(par[2]),
-                        course=float(par[3]),
-                        speed=float(par[4]))
-          rt.append(tp)
-        except:
-          AVNLog.warn("exception while reading track file %s: %s",filename,traceback.format_exc())
+      rt=parseTrackLines(f,onError)
     except:
       pass
     f.close()
@@ -209,22 +475,6 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
   #write track data to gpx file
   #input: current track data
   def writeGpx(self,filename,data):
-    header='''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-           <gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="avnav" 
-                xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" 
-            xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd"> 
-            <trk>
-            <name>avnav-track-%s</name>
-            <trkseg>
-            '''
-    footer='''
-            </trkseg>
-            </trk>
-            </gpx>
-            '''
-    trkpstr="""
-             <trkpt lat="%2.9f" lon="%2.9f" ><time>%s</time><course>%3.1f</course><speed>%3.2f</speed></trkpt>
-             """
     if os.path.exists(filename):
       os.unlink(filename)
     f=None
@@ -238,39 +488,102 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
     AVNLog.debug("writing gpx file %s",filename)
     title,e=os.path.splitext(os.path.basename(filename))
     try:
-      f.write(header%(title,))
-      for trackpoint in data:
-        ts=trackpoint.ts.isoformat()
-        if not ts[-1:]=="Z":
-          ts+="Z"
-        f.write(trkpstr%(trackpoint.lat,trackpoint.lon,ts,trackpoint.course,trackpoint.speed))
-      f.write(footer)
+      f.write(GPX_HEADER%(title,))
+      f.write(formatGpxPoints(data))
+      f.write(GPX_FOOTER)
     except:
       AVNLog.warn("Exception while writing gpx file %s: %s",filename,traceback.format_exc())
     f.close()
 
+  #min number of track files to be converted from scratch
+  #to use a process pool
+  BULK_CONVERT_MIN=4
+
+  def convertBulk(self,tracks,states):
+    '''
+    convert track files from scratch in a process pool
+    @param tracks: list of (track,gpx)
+    @param states: dict track->GpxState to be filled
+    @return: the list of (track,gpx) that could not be converted
+    '''
+    numProcesses=min(os.cpu_count() or 1,len(tracks))
+    AVNLog.info("converting %d track files with %d processes",len(tracks),numProcesses)
+    rt=[]
+    try:
+      #spawn as we are running in a multithreaded process
+      with concurrent.futures.ProcessPoolExecutor(max_workers=numProcesses,
+                                                  mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures={}
+        for track,gpx in tracks:
+          futures[pool.submit(convertTrackFile,track,gpx)]=(track,gpx)
+        for future in concurrent.futures.as_completed(futures):
+          track,gpx=futures[future]
+          try:
+            states[track]=future.result()
+          except:
+            AVNLog.debug("unable to convert %s: %s",track,traceback.format_exc())
+    except:
+      AVNLog.error("process pool for track conversion failed: %s",traceback.format_exc())
+    return [t for t in tracks if not t[0] in states]
+
   #a converter running in a separate thread
   #will convert all found track files to gpx if the gpx file does not exist or is older
+  #gpx files converted by this thread are only appended
   def converter(self,sequence):
     infoName="TrackWriter:converter"
     AVNLog.info("%s thread started",infoName)
+    states={}
     while self.startSequence == sequence:
-      currentTracks=glob.glob(os.path.join(self.baseDir,"*.avt"))
-      for track in currentTracks:
+      try:
+        currentTracks={}
+        with os.scandir(self.baseDir) as it:
+          for entry in it:
+            if entry.name.endswith(".avt") and entry.is_file():
+              currentTracks[entry.path]=entry.stat().st_mtime
+      except:
+        currentTracks={}
+      for track in list(states.keys()):
+        if not track in currentTracks:
+          del states[track]
+      fullConvert=[]
+      incremental=[]
+      for track,mtime in currentTracks.items():
         try:
-          gpx=re.sub(r"avt$","gpx",track)
-          doCreate=True
-          if os.path.exists(gpx):
-            trackstat=os.stat(track)
-            gpxstat=os.stat(gpx)
-            if trackstat.st_mtime <= gpxstat.st_mtime:
-              doCreate=False
-          if doCreate:
-            AVNLog.debug("creating gpx file %s",gpx)
-            data=self.readTrackFile(track)
-            self.writeGpx(gpx,data)
+          state=states.get(track)
+          gpx=track[0:-3]+"gpx"
+          if state is not None and state.avtMtime == mtime:
+            #the gpx could have been deleted or changed in between
+            try:
+              gpxSize=os.path.getsize(gpx)
+            except OSError:
+              gpxSize=None
+            if gpxSize == state.gpxSize:
+              continue
+            del states[track]
+            fullConvert.append((track,gpx))
+            continue
+          if state is None and os.path.exists(gpx):
+            if mtime <= os.stat(gpx).st_mtime:
+              continue
+          if state is None:
+            fullConvert.append((track,gpx))
+          else:
+            incremental.append((track,gpx))
         except:
           pass
+      if len(fullConvert) >= self.BULK_CONVERT_MIN and (os.cpu_count() or 1) > 1:
+        fullConvert=self.convertBulk(fullConvert,states)
+      for track,gpx in fullConvert+incremental:
+        if self.startSequence != sequence:
+          break
+        try:
+          AVNLog.debug("creating gpx file %s",gpx)
+          states[track]=convertTrackFile(track,gpx,states.get(track))
+          if states[track].numErrors > 0:
+            AVNLog.warn("%d invalid lines in track file %s",states[track].numErrors,track)
+        except:
+          states.pop(track,None)
+          AVNLog.debug("unable to convert %s: %s",track,traceback.format_exc())
       self.wait(60)
 
   def onPreRun(self):
@@ -319,8 +632,9 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
             if os.path.exists(realfilename):
               self.setInfo('main', "reading old track data", WorkerStatus.STARTED)
               data = self.readTrackFile(realfilename)
-              for trkpoint in data:
-                self.track.append(trkpoint)
+              with self.tracklock:
+                for trkpoint in data:
+                  self.track.append(trkpoint)
             self.initial = False
         if newFile:
           self.currentFile = open(realfilename, "a",encoding='utf-8')
@@ -332,7 +646,7 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
       if self.loopCount >= 10:
         self.cleanupTrack()
         self.loopCount = 0
-      gpsdata = self.navdata.getDataByPrefix(AVNStore.BASE_KEY_GPS, 1)
+      gpsdata = self.navdata.getSnapshot(AVNStore.BASE_KEY_GPS).data
       lat = gpsdata.get('lat')
       lon = gpsdata.get('lon')
       if not lat is None and not lon is None:
@@ -342,7 +656,8 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
           AVNLog.ld("write track entry", gpsdata)
           if self.currentFile is not None:
             self.writeLine(self.currentFile,tp)
-          self.track.append(tp)
+          with self.tracklock:
+            self.track.append(tp)
           self.lastlat = lat
           self.lastlon = lon
         else:
@@ -352,7 +667,8 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
             AVNLog.ld("write track entry", gpsdata)
             if self.currentFile is not None:
               self.writeLine(self.currentFile,tp)
-            self.track.append(tp)
+            with self.tracklock:
+              self.track.append(tp)
             self.lastlat = lat
             self.lastlon = lon
     except Exception as e:
@@ -364,7 +680,8 @@ class AVNTrackWriter(AVNDirectoryHandlerBase):
     if name.endswith(".gpx"):
       if self.fname == name[:-4]:
         AVNLog.info("deleting current track!")
-        self.track=[]
+        with self.tracklock:
+          self.track.clear()
     return rt
 
   LISTED_EXTENSIONS=['.nmea','.nmea.gz','.gpx']
@@ -26,6 +26,7 @@
 # read mbtiles files and provide them for access via http
 
 import os
+import pathlib
 import sqlite3
 import sys
 import threading
@@ -39,54 +40,27 @@ from avnav_util import AVNLog, AVNUtil, ChartFile
 #tile_column => x
 #tile_row => 2^^z-1-y
 
-class QueueEntry(object):
-  def __init__(self,tile):
-    self.cond=threading.Condition()
-    self.tile=tile
-    self.data=None
-    self.dataAvailable=False
-
-  def waitAndGet(self):
-    while True:
-      self.cond.acquire()
-      if self.dataAvailable:
-        self.cond.release()
-        return self.data
-      self.cond.wait(5)
-      self.cond.release()
-
-  def wakeUp(self):
-    self.cond.acquire()
-    try:
-      self.cond.notifyAll()
-    finally:
-      self.cond.release()
-  def setData(self,data):
-    self.cond.acquire()
-    self.data=data
-    self.dataAvailable=True
-    self.cond.notify_all()
-    self.cond.release()
-
-
-
 class MBTilesFile(ChartFile):
-  def __init__(self,filename,timeout=300):
+  #max number of concurrent readers per file
+  MAX_CONNECTIONS=4
+  #memory map this number of bytes of the file for reading
+  MMAP_SIZE=256*1024*1024
+  TILE_QUERY="select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?"
+  def __init__(self,filename,timeout=300,maxConnections=None):
     self.filename=filename
     self.isOpen=False
     self.cond=threading.Condition()
-    self.connection=None
     self.zoomlevels=[]
     self.zoomLevelBoundings={}
     self.schemeTMS=True
     self.originalScheme=None
     self.schemeInconsistent=False #if there is a scheme entry in the DB but no avnav_schema
-    self.requestQueue=[]
     self.timeout=timeout
     self.stop=False
-    self.handler=threading.Thread(target=self.handleRequests)
-    self.handler.setDaemon(True)
-    self.handler.start()
+    #read only connections not in use
+    self.connections=[]
+    self.numConnections=0
+    self.maxConnections=maxConnections if maxConnections is not None else self.MAX_CONNECTIONS
     self.changeCount=AVNUtil.utcnow()
 
   def getOriginalScheme(self):
@@ -101,22 +75,62 @@ class MBTilesFile(ChartFile):
     finally:
       self.cond.release()
 
-  def handleRequests(self):
-    connection=sqlite3.connect(self.filename)
-    while not self.stop:
-      self.cond.acquire()
-      request=None
-      if len(self.requestQueue) > 0:
-        request=self.requestQueue.pop(0)
-      else:
+  def openReadConnection(self):
+    '''
+    open a read only connection that can be used from any thread
+    the tile query is kept as a prepared statement in the statement cache
+    '''
+    uri=pathlib.Path(os.path.abspath(self.filename)).as_uri()+"?mode=ro"
+    connection=sqlite3.connect(uri,uri=True,check_same_thread=False,cached_statements=16)
+    try:
+      connection.execute("PRAGMA mmap_size=%d"%self.MMAP_SIZE)
+    except Exception as e:
+      AVNLog.debug("unable to set mmap_size for %s: %s",self.filename,str(e))
+    return connection
+
+  def acquireConnection(self):
+    '''
+    get a connection from the pool, wait if all are in use
+    @return: the connection or None if closed
+    '''
+    with self.cond:
+      while not self.stop:
+        if len(self.connections) > 0:
+          return self.connections.pop()
+        if self.numConnections < self.maxConnections:
+          self.numConnections+=1
+          break
         self.cond.wait(5)
-      self.cond.release()
-      if request is not None:
-        data=self.getTileDataInternal(request.tile,connection)
-        request.setData(data)
-    connection.close()
+      if self.stop:
+        return None
+    try:
+      return self.openReadConnection()
+    except:
+      with self.cond:
+        self.numConnections-=1
+        self.cond.notify()
+      raise
 
+  def releaseConnection(self,connection):
+    with self.cond:
+      if not self.stop:
+        self.connections.append(connection)
+        self.cond.notify()
+        return
+      self.numConnections-=1
+    connection.close()
 
+  def closeConnections(self):
+    with self.cond:
+      connections=self.connections
+      self.connections=[]
+      self.numConnections-=len(connections)
+      self.cond.notify_all()
+    for connection in connections:
+      try:
+        connection.close()
+      except:
+        pass
 
   #tile is (z,x,y)
   def zxyToZoomColRow(self,tile):
@@ -145,23 +159,18 @@ class MBTilesFile(ChartFile):
   def getTileData(self,tile,source):
     if not self.isOpen:
       raise Exception("not open")
-    request=QueueEntry(tile)
-    self.cond.acquire()
+    connection=self.acquireConnection()
+    if connection is None:
+      return None
     try:
-      self.requestQueue.append(request)
-      self.cond.notify_all()
-    except:
-      pass
-    self.cond.release()
-    AVNLog.debug("waiting for tile")
-    data=request.waitAndGet()
-    AVNLog.debug("tile received")
-    return data
+      return self.getTileDataInternal(tile,connection)
+    finally:
+      self.releaseConnection(connection)
 
   def getTileDataInternal(self,tile,connection):
     cu=None
     try:
-      cu=connection.execute("select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?",self.zxyToZoomColRow(tile))
+      cu=connection.execute(self.TILE_QUERY,self.zxyToZoomColRow(tile))
       t=cu.fetchone()
       cu.close()
       return t[0]
@@ -277,17 +286,8 @@ class MBTilesFile(ChartFile):
     if not self.isOpen:
       return
     self.stop=True
-    #cancel all requests by returning None
-    self.cond.acquire()
-    requests=self.requestQueue
-    self.requestQueue=[]
-    self.cond.notify_all()
-    self.cond.release()
-    for rq in requests:
-      try:
-        rq.setData(None)
-      except:
-        pass
+    #connections still in use are closed when released
+    self.closeConnections()
 
   def deleteFiles(self):
     self.close()
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+#AIS decoding benchmark against recorded AIVDM logs
+#usage: bench_ais.py [nmeafile...]
+#defaults to the recorded logs in the top level test directory
+#compares the instruction table interpreter (aivdm_unpack)
+#with the precompiled decoders (aivdm_unpack_compiled)
+#and the string based conversion for the store
+#with the native conversion in NMEAParser.storeAISdata
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import ais
+from avnav_nmea import NMEAParser
+from avnav_store import AVNStore
+from avnav_util import AVNUtil
+
+def readPayloads(files):
+  rt=[]
+  payloads={}
+  for fn in files:
+    with open(fn,errors='replace') as fh:
+      for line in fh:
+        if not line.startswith('!AIVDM'):
+          continue
+        fields=line.strip().split(',')
+        if len(fields) < 7:
+          continue
+        try:
+          pad=int(fields[6].split('*')[0])
+        except ValueError:
+          pad=0
+        channel=fields[4]
+        if fields[2] == '1':
+          payloads[channel]=''
+        payloads[channel]=payloads.get(channel,'')+fields[5]
+        if fields[2] == fields[1]:
+          rt.append((payloads[channel],pad))
+          payloads[channel]=''
+  return rt
+
+def decode(messages,unpack):
+  ok=0
+  for payload,pad in messages:
+    bits=ais.BitVector()
+    bits.from_sixbit(payload,pad)
+    bits.extend_to(168)
+    try:
+      unpack(bits,{})
+      ok+=1
+    except Exception:
+      pass
+  return ok
+
+def run(files):
+  messages=readPayloads(files)
+  print("%d AIS messages from %d files"%(len(messages),len(files)))
+  variants=[
+    ('aivdm_unpack',lambda bits,values: ais.aivdm_unpack(0,bits,0,values,ais.aivdm_decode)),
+    ('aivdm_unpack_compiled',lambda bits,values: ais.aivdm_unpack_compiled(0,bits,values))
+  ]
+  for name,unpack in variants:
+    start=time.monotonic()
+    ok=decode(messages,unpack)
+    duration=time.monotonic()-start
+    print("%-22s: %d decoded in %.3fs, %.0f msg/s"%(name,ok,duration,len(messages)/duration))
+
+def storeLegacy(parser,bitfield):
+  #the former string based conversion
+  rt={'class':'AIS'}
+  for bfe in bitfield:
+    name=bfe[0].name
+    tname=parser.aisFieldTranslations.get(name)
+    if tname is not None:
+      name=tname
+    rt[name]=str(bfe[1])
+  parser.navdata.setAisValue(rt.get('mmsi'),AVNUtil.convertAIS(rt))
+
+def storeNative(parser,bitfield):
+  parser.storeAISdata(bitfield)
+
+def runStore(messages,numTargets=2000):
+  decoded=[]
+  for payload,pad in messages:
+    bits=ais.BitVector()
+    bits.from_sixbit(payload,pad)
+    bits.extend_to(168)
+    try:
+      bitfield=ais.aivdm_unpack_compiled(0,bits,{})
+    except Exception:
+      continue
+    #spread the recorded targets to get a realistic store size
+    bitfield[2][1]=bitfield[2][1]*10+len(decoded)%(numTargets//300+1)
+    decoded.append(bitfield)
+  for name,store in (('string conversion',storeLegacy),('native conversion',storeNative)):
+    navdata=AVNStore(1200,1200,'',False)
+    parser=NMEAParser(navdata)
+    start=time.monotonic()
+    for bitfield in decoded:
+      store(parser,bitfield)
+    duration=time.monotonic()-start
+    #temporary memory per message
+    peak=0
+    tracemalloc.start()
+    for bitfield in decoded[0:5000]:
+      tracemalloc.reset_peak()
+      before=tracemalloc.get_traced_memory()[0]
+      store(parser,bitfield)
+      peak+=tracemalloc.get_traced_memory()[1]-before
+    tracemalloc.stop()
+    print("%-22s: %d targets, %.0f msg/s, %.0f bytes temporary memory/msg"%(
+      name,navdata.getAisCounter(),len(decoded)/duration,peak/min(len(decoded),5000)))
+
+if __name__ == '__main__':
+  files=sys.argv[1:]
+  if len(files) < 1:
+    base=os.path.join(os.path.dirname(__file__),'..','..','test')
+    files=glob.glob(os.path.join(base,'*.nmea'))+glob.glob(os.path.join(base,'*.log'))
+  run(files)
+  runStore(readPayloads(files))
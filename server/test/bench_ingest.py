@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+#NMEA ingestion benchmark: socket -> SocketReader -> AVNQueue
+#usage: bench_ingest.py [rate] [seconds] [nmeafile]
+#sends recorded NMEA lines through a socket pair at rate lines/s
+#(0: as fast as possible) and measures the reader thread cpu time
+import glob
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','handler'))
+from avnav_worker import InfoHandler
+from avnqueue import AVNQueue
+from socketbase import SocketReader
+
+def readLines(filename):
+  rt=[]
+  with open(filename,'rb') as fh:
+    for line in fh:
+      line=line.rstrip(b'\r\n')
+      if line.startswith(b'$') or line.startswith(b'!'):
+        rt.append(line+b'\r\n')
+  return rt
+
+def send(sock,lines,rate,seconds):
+  total=int(rate*seconds) if rate > 0 else len(lines)*5
+  #send in 10ms slices
+  perSlice=max(1,rate//100) if rate > 0 else 100
+  start=time.monotonic()
+  sent=0
+  while sent < total:
+    chunk=b''.join(lines[(sent+i) % len(lines)] for i in range(0,perSlice))
+    sock.sendall(chunk)
+    sent+=perSlice
+    if rate > 0:
+      delay=start+sent/rate-time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+  sock.shutdown(socket.SHUT_WR)
+  return sent
+
+def run(rate,seconds,filename):
+  lines=readLines(filename)
+  queue=AVNQueue({'maxList':10000,'maxAge':1000})
+  #one consumer channel like a socket writer with a filter
+  queue.subscribe(['$RMC','!AIVDM'],None)
+  firstSequence=queue.sequence
+  rsock,wsock=socket.socketpair()
+  reader=SocketReader(rsock,queue,InfoHandler())
+  cpu=[0]
+  def readerThread():
+    reader.readSocket('bench')
+    cpu[0]=time.thread_time()
+  thread=threading.Thread(target=readerThread)
+  thread.start()
+  start=time.monotonic()
+  sent=send(wsock,lines,rate,seconds)
+  thread.join()
+  duration=time.monotonic()-start
+  wsock.close()
+  received=queue.sequence-firstSequence
+  print("rate=%s: sent %d, queued %d lines in %.3fs, %.0f lines/s, reader cpu %.3fs (%.1f us/line)"%(
+    rate if rate > 0 else 'max',sent,received,duration,received/duration,cpu[0],cpu[0]*1e6/max(received,1)))
+
+if __name__ == '__main__':
+  rate=int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  seconds=float(sys.argv[2]) if len(sys.argv) > 2 else 5
+  filename=sys.argv[3] if len(sys.argv) > 3 else os.path.join(os.path.dirname(__file__),'..','..','test','20130801.nmea')
+  run(rate,seconds,filename)
+  if rate > 0:
+    run(0,seconds,filename)
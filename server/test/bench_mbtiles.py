@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+#concurrent tile read benchmark for MBTiles files
+#usage: bench_mbtiles.py [mbtilesfile] [numRequests]
+#without a file a temporary one with random tiles is created
+#fetches random tiles with 1,2,4 and 8 client threads
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from mbtiles_reader import MBTilesFile
+
+def createFile(filename,zoom=12,size=64,tileSize=20000):
+  con=sqlite3.connect(filename)
+  con.execute("create table metadata (name text, value text)")
+  con.execute("create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+  con.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row)")
+  rows=[]
+  for x in range(0,size):
+    for y in range(0,size):
+      rows.append((zoom,x,y,os.urandom(tileSize)))
+  con.executemany("insert into tiles values (?,?,?,?)",rows)
+  con.commit()
+  con.close()
+
+def run(filename,numRequests):
+  chart=MBTilesFile(filename,maxConnections=8)
+  chart.open()
+  tiles=[]
+  for zoom in chart.zoomlevels:
+    b=chart.zoomLevelBoundings[zoom]
+    for x in range(b['xmin'],b['xmax']+1):
+      for y in range(b['ymin'],b['ymax']+1):
+        tiles.append((zoom,x,y))
+  print("%s: %d tiles"%(filename,len(tiles)))
+  for numThreads in (1,2,4,8):
+    errors=[0]
+    def fetch(count):
+      rnd=random.Random(count)
+      for i in range(0,count):
+        if chart.getTileData(rnd.choice(tiles),None) is None:
+          errors[0]+=1
+    threads=[threading.Thread(target=fetch,args=(numRequests//numThreads,)) for i in range(0,numThreads)]
+    start=time.monotonic()
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    duration=time.monotonic()-start
+    print("%d threads: %d tiles in %.3fs, %.0f tiles/s, %d errors"%(numThreads,numRequests,duration,numRequests/duration,errors[0]))
+  chart.close()
+
+if __name__ == '__main__':
+  numRequests=int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+  if len(sys.argv) > 1:
+    run(sys.argv[1],numRequests)
+  else:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      filename=os.path.join(tmpdir,'bench.mbtiles')
+      createFile(filename)
+      run(filename,numRequests)
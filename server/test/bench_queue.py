@@ -0,0 +1,36 @@
+#! /usr/bin/env python3
+#throughput benchmark for the NMEA queue
+#usage: bench_queue.py [maxList] [numRecords]
+#measures addNMEA on a full queue and fetchFromHistory
+#with sequences spread over the whole history
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','handler'))
+from avnqueue import AVNQueue
+
+SENTENCE="!AIVDM,1,1,,A,13aEOK?P00PD2wVMdLDRhgvL289?,0*26"
+
+def run(maxList,numRecords):
+  queue=AVNQueue({'maxList':maxList,'maxAge':1000})
+  for i in range(0,maxList):
+    queue.addNMEA(SENTENCE,source='bench')
+  start=time.monotonic()
+  for i in range(0,numRecords):
+    queue.addNMEA(SENTENCE,source='bench')
+  duration=time.monotonic()-start
+  print("addNMEA maxList=%d: %d records in %.3fs, %.0f/s"%(maxList,numRecords,duration,numRecords/duration))
+  numFetch=numRecords//10
+  start=time.monotonic()
+  for i in range(0,numFetch):
+    sequence=queue.sequence-(i % maxList)
+    queue.fetchFromHistory(sequence,maxEntries=10,waitTime=0.001)
+  duration=time.monotonic()-start
+  print("fetchFromHistory maxList=%d: %d fetches in %.3fs, %.0f/s"%(maxList,numFetch,duration,numFetch/duration))
+
+if __name__ == '__main__':
+  maxList=int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  numRecords=int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+  run(maxList,numRecords)
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+#SignalK delta ingestion benchmark
+#usage: bench_signalk.py [deltafile] [numMessages]
+#deltafile: recorded SignalK stream, one delta message (json) per line
+#  e.g. recorded with: wscat -c ws://localhost:3000/signalk/v1/stream > deltas.txt
+#without a file a stream with the navigation paths of a typical N2K setup is generated
+#compares writing each value with setValue (former handling)
+#with writing each message with one setValues call
+#and measures storing complete vessels/self trees (REST query)
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','handler'))
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','..','libraries'))
+from avnav_nmea import NMEAParser
+from avnav_store import AVNStore
+from signalkhandler import AVNSignalKHandler
+
+def readDeltas(filename):
+  rt=[]
+  with open(filename) as fh:
+    for line in fh:
+      try:
+        data=json.loads(line)
+      except ValueError:
+        continue
+      if data.get('updates') is not None:
+        rt.append(data)
+  return rt
+
+def getPaths():
+  paths=[]
+  for k in NMEAParser.GPS_DATA:
+    sk=k.signalK
+    if sk is None:
+      continue
+    if type(sk) is not list:
+      sk=[sk]
+    paths+=[p for p in sk if not p.startswith('navigation.position')]
+  #some not mapped paths like engine and battery data
+  paths+=['electrical.batteries.%d.voltage'%i for i in range(0,4)]
+  paths+=['propulsion.port.%s'%n for n in ('revolutions','temperature','oilPressure')]
+  return paths
+
+def getTimestamp(now,i):
+  #like a real stream: the same few timestamps repeat
+  return time.strftime('%Y-%m-%dT%H:%M:%S',time.gmtime(now-(i//1000)%10))+'.%03dZ'%(i%12)
+
+def generateDeltas(numMessages):
+  paths=getPaths()
+  rt=[]
+  now=time.time()
+  for i in range(0,numMessages):
+    timestamp=getTimestamp(now,i)
+    values=[{'path':p,'value':random.random()*math.pi} for p in random.sample(paths,min(8,len(paths)))]
+    values.append({'path':'navigation.position','value':{'latitude':54+random.random(),'longitude':10+random.random()}})
+    rt.append({'context':'vessels.self','updates':[{'$source':'n2k.1','timestamp':timestamp,'values':values}]})
+  return rt
+
+def generateTree(numValues=200):
+  #a vessels/self tree as returned by the REST api
+  rt={}
+  now=time.time()
+  paths=getPaths()
+  for i in range(0,numValues):
+    path=paths[i % len(paths)]
+    if i >= len(paths):
+      path='sensors.sub%d.'%(i//len(paths))+path
+    node=rt
+    for part in path.split('.'):
+      node=node.setdefault(part,{})
+    node.update({'value':random.random(),'$source':'n2k.1','timestamp':getTimestamp(now,i)})
+  return rt
+
+class Config(object):
+  decode=True
+  ignoreTs=False
+  priority=NMEAParser.DEFAULT_SOURCE_PRIORITY-10
+
+def createHandler():
+  navdata=AVNStore(30,30,'',False)
+  NMEAParser.registerKeys(navdata)
+  navdata.registerKey(AVNSignalKHandler.PATH+".*",'signalK','signalk')
+  handler=AVNSignalKHandler.__new__(AVNSignalKHandler)
+  handler.navdata=navdata
+  handler.config=Config()
+  handler.sourceName='signalk'
+  handler.timeOffset=None
+  handler.createMappings()
+  return handler
+
+def storeSingle(handler,data):
+  #the former handling: setValue for every value and every decoded value
+  navdata=handler.navdata
+  for update in data.get('updates'):
+    for item in update.get('values') or []:
+      path=item.get('path')
+      value=item.get('value')
+      if path is None or value is None or path.startswith('notifications'):
+        continue
+      values=[]
+      handler.addValue(path,value,values)
+      for key,dvalue,priority in values:
+        navdata.setValue(key,dvalue,source=handler.sourceName,priority=priority)
+
+def storeBatch(handler,data):
+  handler.webSocketMessage(data,None,False)
+
+def run(deltas):
+  numValues=sum(len(u.get('values') or []) for d in deltas for u in d.get('updates'))
+  print("%d messages with %d values"%(len(deltas),numValues))
+  for name,store in (('setValue',storeSingle),('setValues',storeBatch)):
+    handler=createHandler()
+    start=time.monotonic()
+    for data in deltas:
+      store(handler,data)
+    duration=time.monotonic()-start
+    print("%-10s: %.3fs, %.0f msg/s, %.0f values/s"%(name,duration,len(deltas)/duration,numValues/duration))
+
+def runTree(numTrees=500):
+  tree=generateTree()
+  handler=createHandler()
+  start=time.monotonic()
+  for i in range(0,numTrees):
+    handler.storeData(tree,handler.config.priority)
+  duration=time.monotonic()-start
+  print("storeData : %.3fs, %.0f trees/s"%(duration,numTrees/duration))
+
+if __name__ == '__main__':
+  numMessages=int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+  if len(sys.argv) > 1 and sys.argv[1] != '-':
+    deltas=readDeltas(sys.argv[1])[0:numMessages]
+  else:
+    deltas=generateDeltas(numMessages)
+  run(deltas)
+  runTree()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python3
+#benchmark for the in memory track
+#usage: bench_track.py [days] [interval]
+#compares the former list of TrackPoint objects
+#with the columnar TrackStore for memory and track request latency
+import datetime
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..','handler'))
+from trackwriter import TrackPoint,TrackStore
+
+def createPoints(days,interval):
+  rt=[]
+  start=datetime.datetime(2024,6,1)
+  num=int(days*24*3600/interval)
+  for i in range(0,num):
+    rt.append(TrackPoint(start+datetime.timedelta(seconds=i*interval),
+                         lat=54+0.1*math.sin(i/1000),lon=10+i*0.00001,
+                         speed=3+math.sin(i/100),course=(i/10)%360))
+  return rt
+
+def legacyFormatted(track,maxnum,interval):
+  #the former implementation
+  rt=[]
+  curts=None
+  intervaldt=datetime.timedelta(seconds=interval)
+  for tp in track:
+    if curts is None or tp.ts > (curts + intervaldt):
+      rt.append(tp.getFormatted())
+      curts=tp.ts
+  return rt[-maxnum:]
+
+def measure(name,create):
+  tracemalloc.start()
+  before=tracemalloc.get_traced_memory()[0]
+  track=create()
+  used=tracemalloc.get_traced_memory()[0]-before
+  tracemalloc.stop()
+  print("%-8s: %d points, %.1f MB"%(name,len(track),used/1024/1024))
+  return track
+
+def timeRequest(name,fetch,num=10):
+  start=time.monotonic()
+  for i in range(0,num):
+    rt=fetch()
+  duration=(time.monotonic()-start)/num
+  print("  %-34s: %4d points, %8.2f ms/request"%(name,len(rt),duration*1000))
+  return rt
+
+def run(days,interval):
+  points=createPoints(days,interval)
+  legacy=measure('list',lambda: list(TrackPoint(p.ts,p.lat,p.lon,p.speed,p.course,p.distance) for p in points))
+  def createStore():
+    store=TrackStore()
+    for p in points:
+      store.append(p)
+    return store
+  store=measure('columnar',createStore)
+  del points
+  for maxnum,requestInterval in ((60,60),(1000,10),(2000,300)):
+    print("maxnum=%d interval=%d"%(maxnum,requestInterval))
+    old=timeRequest('list',lambda: legacyFormatted(legacy,maxnum,requestInterval))
+    new=timeRequest('columnar',lambda: store.getTrackFormatted(maxnum,requestInterval))
+    if old != new:
+      print("  ERROR: results differ")
+    timeRequest('columnar simplify 10m',lambda: store.getTrackFormatted(maxnum,requestInterval,10))
+
+if __name__ == '__main__':
+  days=float(sys.argv[1]) if len(sys.argv) > 1 else 3
+  interval=float(sys.argv[2]) if len(sys.argv) > 2 else 10
+  run(days,interval)
@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+#tests for NMEALineFramer
+#run: python3 -m unittest test_framer (in this directory) or python3 test_framer.py
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+from avnav_nmea import NMEALineFramer
+
+
+class RecvOnlySocket(object):
+  '''
+  a socket like object that only has recv (like the bluetooth sockets)
+  '''
+  def __init__(self,chunks):
+    self.chunks=list(chunks)
+    self.requested=[]
+
+  def recv(self,numbytes):
+    self.requested.append(numbytes)
+    if len(self.chunks) < 1:
+      return b''
+    chunk=self.chunks.pop(0)
+    if isinstance(chunk,Exception):
+      raise chunk
+    return chunk[0:numbytes]
+
+
+class TestLineFramer(unittest.TestCase):
+  def testRecvOnlySocket(self):
+    sock=RecvOnlySocket([b'$GPRMC,1*00\r\n$GPG',b'GA,2*00\r\n',socket.timeout(),b'!AIVDM,3\n'])
+    framer=NMEALineFramer(1024,512)
+    lines=[]
+    self.assertEqual(framer.recvFrom(sock),17)
+    lines+=framer.getLines()
+    self.assertEqual(lines,['$GPRMC,1*00'])
+    self.assertEqual(framer.recvFrom(sock),9)
+    lines+=framer.getLines()
+    self.assertRaises(socket.timeout,framer.recvFrom,sock)
+    framer.recvFrom(sock)
+    lines+=framer.getLines()
+    self.assertEqual(lines,['$GPRMC,1*00','$GPGGA,2*00','!AIVDM,3'])
+    self.assertEqual(framer.recvFrom(sock),0)
+    #never read more than fits into the buffer
+    self.assertTrue(all(n <= 1024 for n in sock.requested))
+
+  def testNativeSocket(self):
+    rsock,wsock=socket.socketpair()
+    try:
+      wsock.sendall(b'$GPRMC,1*00\r\n$GPGGA')
+      framer=NMEALineFramer(1024,512)
+      framer.recvFrom(rsock)
+      self.assertEqual(framer.getLines(),['$GPRMC,1*00'])
+      wsock.sendall(b',2*00\r\n')
+      framer.recvFrom(rsock)
+      self.assertEqual(framer.getLines(),['$GPGGA,2*00'])
+      wsock.close()
+      self.assertEqual(framer.recvFrom(rsock),0)
+    finally:
+      rsock.close()
+
+
+if __name__ == '__main__':
+  unittest.main()